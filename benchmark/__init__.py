@@ -0,0 +1,3 @@
+from .pacs import *
+from .runner import *
+from .scenarios import *
\ No newline at end of file
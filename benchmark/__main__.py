@@ -0,0 +1,27 @@
+import sys
+import json
+import argparse
+from .runner import run_benchmarks
+from .scenarios import SCENARIOS
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m benchmark',
+        description='Runs pydicombatch extractions against a local stand-in PACS and reports their throughput')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run, all of them by default')
+    parser.add_argument('--output', help='JSON file of the results, standard output by default')
+    parser.add_argument('--directory', help='working directory of the runs, a temporary directory by default')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies the number of patients of the scenarios')
+    parser.add_argument('--list', action='store_true', help='list the scenarios')
+    args = parser.parse_args()
+
+    if args.list:
+        for name, scenario in SCENARIOS.items():
+            print('{:28} {}'.format(name, scenario['description']))
+        sys.exit(0)
+
+    results = run_benchmarks(args.scenarios, args.directory, args.scale)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
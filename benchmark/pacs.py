@@ -0,0 +1,258 @@
+import copy
+import time
+import threading
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.dataset import Dataset
+from pydicom.encaps import encapsulate, generate_pixel_data_frame
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian
+from pynetdicom import AE, evt
+from pynetdicom.sop_class import (
+    VerificationSOPClass,
+    PatientRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelFind,
+    PatientRootQueryRetrieveInformationModelMove,
+    StudyRootQueryRetrieveInformationModelMove,
+    PatientRootQueryRetrieveInformationModelGet,
+    StudyRootQueryRetrieveInformationModelGet
+)
+
+# Keys of the instances at each query level
+LEVEL_KEYS = {
+    'PATIENT': 'PatientID',
+    'STUDY': 'StudyInstanceUID',
+    'SERIES': 'SeriesInstanceUID',
+    'IMAGE': 'SOPInstanceUID'
+}
+
+
+class SyntheticInstance(object):
+    """ SyntheticInstance class
+    The identifiers of an instance of the synthetic archive, its dataset is built when it is sent
+    """
+    __slots__ = ['PatientID', 'PatientName', 'StudyInstanceUID', 'StudyDate', 'SeriesInstanceUID',
+        'SeriesNumber', 'SOPInstanceUID', 'InstanceNumber']
+
+    def __init__(self, **values):
+        for key, value in values.items():
+            setattr(self, key, value)
+
+
+class SyntheticArchive(object):
+    """ SyntheticArchive class
+    The patients, studies, series and instances of the stand-in PACS, generated from a seed so that
+    runs with the same options are identical. Instances are uncompressed images of about
+    instance_kilobytes, or JPEG Baseline multi-frame images of about the same size with compressed=True.
+    """
+
+    def __init__(self, patients=10, studies_per_patient=2, series_per_study=2, instances_per_series=10,
+            instance_kilobytes=64, compressed=False, seed=0):
+        self.compressed = compressed
+        self.instances = []
+        for p in range(patients):
+            patient_id = 'BENCH{:06d}'.format(p)
+            for st in range(studies_per_patient):
+                study_uid = generate_uid(entropy_srcs=[str(seed), patient_id, str(st)])
+                study_date = '20{:02d}{:02d}{:02d}'.format(10 + st % 10, 1 + p % 12, 1 + st % 28)
+                for se in range(series_per_study):
+                    series_uid = generate_uid(entropy_srcs=[study_uid, str(se)])
+                    for i in range(instances_per_series):
+                        self.instances.append(SyntheticInstance(PatientID=patient_id,
+                            PatientName='BENCH^{}'.format(p), StudyInstanceUID=study_uid,
+                            StudyDate=study_date, SeriesInstanceUID=series_uid, SeriesNumber=se + 1,
+                            SOPInstanceUID=generate_uid(entropy_srcs=[series_uid, str(i)]),
+                            InstanceNumber=i + 1))
+        # Instances by the value of each key, so that requests with unique keys are not a full scan
+        self.index = {keyword: {} for keyword in LEVEL_KEYS.values()}
+        for instance in self.instances:
+            for keyword, index in self.index.items():
+                index.setdefault(getattr(instance, keyword), []).append(instance)
+        self.template = self.create_template(int(instance_kilobytes) * 1024)
+
+    def create_template(self, size):
+        if self.compressed:
+            ds = dcmread(get_testdata_file('SC_rgb_jpeg_dcmtk.dcm'))
+            frame = next(generate_pixel_data_frame(ds.PixelData))
+            frames = max(1, size // len(frame))
+            ds.NumberOfFrames = frames
+            ds.PixelData = encapsulate([frame] * frames)
+        else:
+            ds = dcmread(get_testdata_file('CT_small.dcm'))
+            side = max(8, int((size / 2) ** 0.5))
+            ds.Rows = side
+            ds.Columns = side
+            ds.PixelData = bytes(range(256)) * (side * side * 2 // 256) + bytes(side * side * 2 % 256)
+            ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+            ds.is_implicit_VR = False
+        ds.Modality = ds.get('Modality', 'OT')
+        ds.BodyPartExamined = 'CHEST'
+        # The pixel data is shared by all the datasets instead of being copied
+        self.pixel_data = ds.PixelData
+        del ds.PixelData
+        return ds
+
+    def dataset(self, instance):
+        ds = copy.deepcopy(self.template)
+        ds.PixelData = self.pixel_data
+        ds['PixelData'].VR = 'OB' if self.compressed else 'OW'
+        for key in SyntheticInstance.__slots__:
+            setattr(ds, key, getattr(instance, key))
+        ds.file_meta.MediaStorageSOPInstanceUID = instance.SOPInstanceUID
+        return ds
+
+    def match(self, identifier, level):
+        """
+        Returns the instances matching the unique keys and PatientID of an identifier, up to the
+        query level
+        """
+        keys = ['PatientID']
+        for key in ['PATIENT', 'STUDY', 'SERIES', 'IMAGE']:
+            keys.append(LEVEL_KEYS[key])
+            if key == level:
+                break
+        candidates = None
+        conditions = []
+        for keyword in keys:
+            if keyword not in identifier or identifier[keyword].VM == 0:
+                continue
+            value = identifier[keyword].value
+            values = [str(x) for x in value] if identifier[keyword].VM > 1 else [str(value)]
+            if len(values) == 1 and values[0].endswith('*'):
+                prefix = values[0].rstrip('*')
+                conditions.append(lambda x, keyword=keyword, prefix=prefix: getattr(x, keyword).startswith(prefix))
+            elif values != ['']:
+                conditions.append(lambda x, keyword=keyword, values=set(values): getattr(x, keyword) in values)
+                # The most specific exact key gives the candidates
+                candidates = [x for value in values for x in self.index[keyword].get(value, [])]
+        if candidates is None:
+            candidates = self.instances
+        return [x for x in candidates if all(condition(x) for condition in conditions)]
+
+
+class StandInPACS(object):
+    """ StandInPACS class
+    A Query/Retrieve SCP serving a SyntheticArchive for benchmarks. It answers C-ECHO, C-FIND, C-MOVE
+    and C-GET requests (patient and study root) after latency seconds, with response_latency seconds
+    between the responses. C-MOVE instances are sent to the move destinations given as AE title:
+    (host, port), C-GET instances on the association of the request. The time from the reception of
+    each request to its final response is recorded.
+    """
+
+    def __init__(self, archive, port, destinations=None, aet='BENCH_PACS', latency=0.0, response_latency=0.0):
+        self.archive = archive
+        self.port = port
+        self.destinations = destinations or {}
+        self.aet = aet
+        self.latency = float(latency)
+        self.response_latency = float(response_latency)
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.server = None
+
+    def start(self):
+        ae = AE(ae_title=self.aet)
+        for sop_class in [VerificationSOPClass, PatientRootQueryRetrieveInformationModelFind,
+                StudyRootQueryRetrieveInformationModelFind, PatientRootQueryRetrieveInformationModelMove,
+                StudyRootQueryRetrieveInformationModelMove, PatientRootQueryRetrieveInformationModelGet,
+                StudyRootQueryRetrieveInformationModelGet]:
+            ae.add_supported_context(sop_class)
+        # The instances are sent in the transfer syntax of the template, e.g. JPEG Baseline
+        template = self.archive.template
+        ae.add_requested_context(template.SOPClassUID, template.file_meta.TransferSyntaxUID)
+        # C-GET requestors propose the SCP role for the storage SOP class
+        ae.add_supported_context(template.SOPClassUID, template.file_meta.TransferSyntaxUID,
+            scu_role=False, scp_role=True)
+        ae.maximum_associations = 64
+        handlers = [(evt.EVT_C_ECHO, self.handle_echo), (evt.EVT_C_FIND, self.handle_find),
+            (evt.EVT_C_MOVE, self.handle_move), (evt.EVT_C_GET, self.handle_get)]
+        self.server = ae.start_server(('', self.port), block=False, evt_handlers=handlers)
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server = None
+
+    def record(self, request_type, time_start):
+        with self.lock:
+            self.latencies.setdefault(request_type, []).append(time.perf_counter() - time_start)
+
+    def handle_echo(self, event):
+        time_start = time.perf_counter()
+        time.sleep(self.latency)
+        self.record('c-echo', time_start)
+        return 0x0000
+
+    def handle_find(self, event):
+        time_start = time.perf_counter()
+        identifier = event.identifier
+        level = str(identifier.get('QueryRetrieveLevel', 'STUDY')).upper()
+        time.sleep(self.latency)
+        seen = set()
+        for instance in self.archive.match(identifier, level):
+            key = getattr(instance, LEVEL_KEYS[level])
+            if key in seen:
+                continue
+            seen.add(key)
+            if event.is_cancelled:
+                yield 0xFE00, None
+                return
+            yield 0xFF00, self.find_response(identifier, level, instance)
+            if self.response_latency:
+                time.sleep(self.response_latency)
+        self.record('c-find', time_start)
+
+    def find_response(self, identifier, level, instance):
+        ds = Dataset()
+        for elem in identifier:
+            keyword = elem.keyword
+            if keyword in SyntheticInstance.__slots__:
+                setattr(ds, keyword, getattr(instance, keyword))
+            elif keyword == 'NumberOfStudyRelatedInstances':
+                ds.NumberOfStudyRelatedInstances = len(self.archive.match(instance_identifier(instance, 'STUDY'), 'STUDY'))
+            elif keyword == 'NumberOfSeriesRelatedInstances':
+                ds.NumberOfSeriesRelatedInstances = len(self.archive.match(instance_identifier(instance, 'SERIES'), 'SERIES'))
+            elif keyword:
+                ds.add_new(elem.tag, elem.VR, None)
+        ds.QueryRetrieveLevel = level
+        return ds
+
+    def handle_move(self, event):
+        time_start = time.perf_counter()
+        destination = event.move_destination.decode('ascii').strip()
+        if destination not in self.destinations:
+            # Move destination unknown
+            yield None, None
+            return
+        yield self.destinations[destination]
+        level = str(event.identifier.get('QueryRetrieveLevel', 'STUDY')).upper()
+        instances = self.archive.match(event.identifier, level)
+        time.sleep(self.latency)
+        yield len(instances)
+        for instance in instances:
+            if event.is_cancelled:
+                yield 0xFE00, None
+                return
+            yield 0xFF00, self.archive.dataset(instance)
+        self.record('c-move', time_start)
+
+    def handle_get(self, event):
+        time_start = time.perf_counter()
+        level = str(event.identifier.get('QueryRetrieveLevel', 'STUDY')).upper()
+        instances = self.archive.match(event.identifier, level)
+        time.sleep(self.latency)
+        yield len(instances)
+        for instance in instances:
+            if event.is_cancelled:
+                yield 0xFE00, None
+                return
+            yield 0xFF00, self.archive.dataset(instance)
+        self.record('c-get', time_start)
+
+
+def instance_identifier(instance, level):
+    ds = Dataset()
+    ds.PatientID = instance.PatientID
+    ds.StudyInstanceUID = instance.StudyInstanceUID
+    if level in ['SERIES', 'IMAGE']:
+        ds.SeriesInstanceUID = instance.SeriesInstanceUID
+    return ds
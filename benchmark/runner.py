@@ -0,0 +1,195 @@
+import os
+import csv
+import sys
+import json
+import time
+import copy
+import socket
+import tempfile
+import subprocess
+import yaml
+from pydicombatch.scp import listener_addresses
+from .pacs import SyntheticArchive, StandInPACS, LEVEL_KEYS
+from .scenarios import SCENARIOS
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOCAL_AET = 'BENCH_SCU'
+
+
+def free_port(count=1):
+    """
+    Returns the first of count consecutive free ports
+    """
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(('', 0))
+            port = sock.getsockname()[1]
+        try:
+            for following in range(port + 1, port + count):
+                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+                    sock.bind(('', following))
+        except OSError:
+            continue
+        return port
+
+def percentile(values, fraction):
+    """
+    Returns the percentile of a list of values with linear interpolation, None if it is empty
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def metric_total(snapshot, name):
+    return sum(x['value'] for x in snapshot.get('counters', []) if x['name'] == name)
+
+
+class BenchmarkRun(object):
+    """ BenchmarkRun class
+    This class runs one scenario: it starts the stand-in PACS, writes the batch file and the
+    configuration of the extraction to a working directory, runs the extraction in a separate
+    process with the pydicombatch command and reports its throughput, the latencies measured by the
+    PACS and the peak RSS of the extraction process.
+    """
+
+    def __init__(self, name, scenario, directory, scale=1.0):
+        self.name = name
+        self.scenario = copy.deepcopy(scenario)
+        self.directory = os.path.join(directory, name)
+        archive_options = self.scenario['archive']
+        archive_options['patients'] = max(1, int(archive_options.get('patients', 10) * scale))
+        self.archive = SyntheticArchive(**archive_options)
+        self.pacs_port = free_port()
+        # Storage SCP listeners use the ports following the local port
+        self.local_port = free_port(int(self.scenario.get('local', {}).get('listeners', 1)))
+
+    def batch_rows(self):
+        level = self.scenario.get('batch_level', 'SERIES')
+        keywords = ['PatientID']
+        if level in ['STUDY', 'SERIES', 'IMAGE']:
+            keywords.append('StudyInstanceUID')
+        if level in ['SERIES', 'IMAGE']:
+            keywords.append('SeriesInstanceUID')
+        seen = set()
+        rows = []
+        for instance in self.archive.instances:
+            key = getattr(instance, LEVEL_KEYS[level])
+            if key not in seen:
+                seen.add(key)
+                rows.append([getattr(instance, keyword) for keyword in keywords])
+        return keywords, rows
+
+    def create_config(self):
+        output = os.path.join(self.directory, 'output')
+        keywords, rows = self.batch_rows()
+        batch_file = os.path.join(self.directory, 'batch.csv')
+        with open(batch_file, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(keywords)
+            writer.writerows(rows)
+
+        request = {
+            'model': 'patient',
+            'threads': 1,
+            'throttle_time': 0.0,
+            'elements_batch_file': batch_file,
+            'elements': keywords + ['QueryRetrieveLevel={}'.format(self.scenario.get('batch_level', 'SERIES'))]
+        }
+        request.update(self.scenario.get('request', {}))
+        config = {
+            'pacs': {'hostname': 'localhost', 'port': self.pacs_port, 'aet': 'BENCH_PACS'},
+            'local': {'aet': LOCAL_AET, 'port': self.local_port},
+            'request': request,
+            'anonymization': {'enabled': False},
+            'output': {
+                'directory': output,
+                'database_file': os.path.join(output, 'database.csv'),
+                'directory_structure': 'PatientID/StudyInstanceUID/SeriesInstanceUID',
+                'filename': 'SOPInstanceUID',
+                'decompress': False,
+                'progress': False
+            },
+            'metrics': {'enabled': True, 'interval': 60}
+        }
+        config['local'].update(self.scenario.get('local', {}))
+        config['output'].update(self.scenario.get('output', {}))
+        if self.scenario.get('anonymization'):
+            lookup_table = os.path.join(self.directory, 'lookup-table.properties')
+            with open(lookup_table, 'w') as file:
+                for i, patient_id in enumerate(sorted(set(x.PatientID for x in self.archive.instances))):
+                    file.write('ptid/{} = ANON{:06d}\n'.format(patient_id, i))
+            config['anonymization'] = {
+                'enabled': True,
+                'engine': 'native',
+                'script': os.path.join(REPOSITORY, 'config', 'sample-dicom-anonymizer.script'),
+                'lookup_table': lookup_table
+            }
+        filepath = os.path.join(self.directory, 'config.yml')
+        with open(filepath, 'w') as file:
+            yaml.dump(config, file)
+        return filepath, config, len(rows)
+
+    def run(self):
+        os.makedirs(self.directory, exist_ok=True)
+        config_file, config, request_count = self.create_config()
+        pacs = StandInPACS(self.archive, self.pacs_port,
+            {aet: ('localhost', port) for aet, port in listener_addresses(config)}, **self.scenario.get('pacs', {}))
+        pacs.start()
+        try:
+            with open(os.path.join(self.directory, 'extraction.log'), 'w') as log:
+                time_start = time.perf_counter()
+                process = subprocess.Popen([sys.executable, '-m', 'pydicombatch', config_file],
+                    cwd=REPOSITORY, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+                # The resource usage of the extraction process only, not of the stand-in PACS
+                _, status, rusage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+                elapsed = time.perf_counter() - time_start
+        finally:
+            pacs.stop()
+
+        metrics_file = os.path.join(config['output']['directory'], 'metrics.json')
+        snapshot = {}
+        if os.path.isfile(metrics_file):
+            with open(metrics_file) as file:
+                snapshot = json.load(file)
+        latencies = pacs.latencies.get(config['request']['type'], [])
+        received_bytes = metric_total(snapshot, 'received_bytes_total')
+        received_instances = metric_total(snapshot, 'received_instances_total')
+        requests = metric_total(snapshot, 'requests_total')
+        return {
+            'scenario': self.name,
+            'description': self.scenario.get('description', ''),
+            'request_type': config['request']['type'],
+            'exit_code': process.returncode,
+            'batch_requests': request_count,
+            'requests': requests,
+            'seconds': elapsed,
+            'requests_per_second': requests / elapsed,
+            'instances': received_instances,
+            'instances_per_second': received_instances / elapsed,
+            'megabytes_per_second': received_bytes / 1e6 / elapsed,
+            'latency_p50_seconds': percentile(latencies, 0.50),
+            'latency_p99_seconds': percentile(latencies, 0.99),
+            # Kilobytes on Linux
+            'peak_rss_megabytes': rusage.ru_maxrss / 1024,
+            'directory': self.directory
+        }
+
+
+def run_benchmarks(names=None, directory=None, scale=1.0):
+    """
+    Runs the given scenarios, all of them by default, and returns their results
+    """
+    directory = directory or tempfile.mkdtemp(prefix='pydicombatch-benchmark-')
+    results = []
+    for name in names or list(SCENARIOS):
+        if name not in SCENARIOS:
+            raise KeyError('Unknown scenario: {}'.format(name))
+        result = BenchmarkRun(name, SCENARIOS[name], directory, scale).run()
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+    return results
@@ -0,0 +1,72 @@
+# Benchmark scenarios: the synthetic archive, the stand-in PACS latencies and the extraction
+# settings of each workload. The batch file has one row per patient, study or series (batch_level).
+SCENARIOS = {
+    'echo': {
+        'description': 'C-ECHO requests, association and request overhead',
+        'archive': {'patients': 2000, 'studies_per_patient': 1, 'series_per_study': 1, 'instances_per_series': 1},
+        'pacs': {'latency': 0.0},
+        'request': {'type': 'c-echo', 'threads': 4},
+        'batch_level': 'PATIENT'
+    },
+    'find': {
+        'description': 'Study-level C-FIND requests per patient',
+        'archive': {'patients': 500, 'studies_per_patient': 4, 'series_per_study': 2, 'instances_per_series': 1},
+        'pacs': {'latency': 0.01, 'response_latency': 0.001},
+        'request': {'type': 'c-find', 'threads': 4, 'elements': ['PatientID', 'StudyInstanceUID',
+            'StudyDate', 'PatientName', 'NumberOfStudyRelatedInstances', 'QueryRetrieveLevel=STUDY']},
+        'batch_level': 'PATIENT'
+    },
+    'move-uncompressed': {
+        'description': 'Series-level C-MOVE of uncompressed instances, stored as received',
+        'archive': {'patients': 10, 'studies_per_patient': 2, 'series_per_study': 2, 'instances_per_series': 25,
+            'instance_kilobytes': 512},
+        'pacs': {'latency': 0.01},
+        'request': {'type': 'c-move', 'threads': 4},
+        'batch_level': 'SERIES'
+    },
+    'move-listeners': {
+        'description': 'Series-level C-MOVE of uncompressed instances received by 2 storage SCP listeners',
+        'archive': {'patients': 10, 'studies_per_patient': 2, 'series_per_study': 2, 'instances_per_series': 25,
+            'instance_kilobytes': 512},
+        'pacs': {'latency': 0.01},
+        'request': {'type': 'c-move', 'threads': 4},
+        'local': {'listeners': 2},
+        'batch_level': 'SERIES'
+    },
+    'get-uncompressed': {
+        'description': 'Series-level C-GET of uncompressed instances, stored as received',
+        'archive': {'patients': 10, 'studies_per_patient': 2, 'series_per_study': 2, 'instances_per_series': 25,
+            'instance_kilobytes': 512},
+        'pacs': {'latency': 0.01},
+        'request': {'type': 'c-get', 'threads': 4},
+        'batch_level': 'SERIES'
+    },
+    'move-compressed': {
+        'description': 'Series-level C-MOVE of JPEG compressed instances, decompressed',
+        'archive': {'patients': 10, 'studies_per_patient': 2, 'series_per_study': 2, 'instances_per_series': 25,
+            'instance_kilobytes': 128, 'compressed': True},
+        'pacs': {'latency': 0.01},
+        'request': {'type': 'c-move', 'threads': 4},
+        'output': {'decompress': True},
+        'batch_level': 'SERIES'
+    },
+    'move-anonymized': {
+        'description': 'Series-level C-MOVE of uncompressed instances, anonymized with the native engine',
+        'archive': {'patients': 10, 'studies_per_patient': 2, 'series_per_study': 2, 'instances_per_series': 25,
+            'instance_kilobytes': 512},
+        'pacs': {'latency': 0.01},
+        'request': {'type': 'c-move', 'threads': 4},
+        'anonymization': True,
+        'batch_level': 'SERIES'
+    },
+    'move-compressed-anonymized': {
+        'description': 'Series-level C-MOVE of JPEG compressed instances, decompressed and anonymized',
+        'archive': {'patients': 10, 'studies_per_patient': 2, 'series_per_study': 2, 'instances_per_series': 25,
+            'instance_kilobytes': 128, 'compressed': True},
+        'pacs': {'latency': 0.01},
+        'request': {'type': 'c-move', 'threads': 4},
+        'output': {'decompress': True},
+        'anonymization': True,
+        'batch_level': 'SERIES'
+    }
+}
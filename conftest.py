@@ -0,0 +1 @@
+# Makes the pydicombatch package importable by the tests when pytest is run from the repository
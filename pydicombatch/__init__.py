@@ -1,3 +1,19 @@
 from .scp import *
 from .scu import *
-from .common import *
\ No newline at end of file
+from .common import *
+from .writer import *
+from .state import *
+from .association import *
+from .ratelimit import *
+from .anonymizer import *
+from .postprocess import *
+from .tracking import *
+from .cache import *
+from .splitting import *
+from .planning import *
+from .ingest import *
+from .distributed import *
+from .manifest import *
+from .metrics import *
+from .profiling import *
+from .columnar import *
\ No newline at end of file
@@ -1,12 +1,15 @@
-
 import sys
-from .common import pydicombatch
+from .common import pydicombatch, pydicombatch_worker
 
-print("\n█▀█ █▄█ █▀▄ █ █▀▀ █▀█ █▀▄▀█   █▄▄ ▄▀█ ▀█▀ █▀▀ █░█\n█▀▀ ░█░ █▄▀ █ █▄▄ █▄█ █░▀░█   █▄█ █▀█ ░█░ █▄▄ █▀█\n")
+if __name__ == '__main__':
+    print("\n█▀█ █▄█ █▀▄ █ █▀▀ █▀█ █▀▄▀█   █▄▄ ▄▀█ ▀█▀ █▀▀ █░█\n█▀▀ ░█░ █▄▀ █ █▄▄ █▄█ █░▀░█   █▄█ █▀█ ░█░ █▄▄ █▀█\n")
 
-if len(sys.argv) != 2:
-    help_string = 'Usage: pydicombatch.py <config file>'
-    print(help_string)
-else:
-    config_file = sys.argv[1]
-    pydicombatch(config_file)
+    if len(sys.argv) == 4 and sys.argv[2] == 'worker':
+        # Worker of a distributed extraction started on another host
+        pydicombatch_worker(sys.argv[1], int(sys.argv[3]))
+    elif len(sys.argv) != 2:
+        help_string = 'Usage: pydicombatch.py <config file> [worker <index>]'
+        print(help_string)
+    else:
+        config_file = sys.argv[1]
+        pydicombatch(config_file)
@@ -0,0 +1,304 @@
+import re
+import datetime
+import hashlib
+import xml.etree.ElementTree as ElementTree
+from pydicom.datadict import dictionary_VR, tag_for_keyword
+from pydicom.tag import Tag
+from pydicom.multival import MultiValue
+
+
+class AnonymizationError(Exception):
+    """
+    Raised when a dataset cannot be anonymized (e.g. missing look up table key), the file must not be
+    kept as if it was anonymized
+    """
+    pass
+
+
+KEEP = object()
+REMOVE = object()
+
+
+def usmd5(value):
+    """
+    Returns the MD5 hash of a string as a string of decimal digits, as done by the RSNA anonymizer
+    """
+    return str(int.from_bytes(hashlib.md5(value.encode('utf-8')).digest(), 'big'))
+
+def element_string(value):
+    """
+    Returns the value of an element as a string, multiple values are separated by backslashes as in
+    the DICOM encoding
+    """
+    if value is None:
+        return ''
+    if isinstance(value, (MultiValue, list)):
+        return '\\'.join(str(x) for x in value)
+    return str(value)
+
+def load_lookup_table(filepath):
+    """
+    Returns the key / value pairs of a Java .properties look up table
+    """
+    lookup_table = {}
+    if filepath:
+        with open(filepath, encoding='utf-8') as lut_file:
+            for line in lut_file:
+                line = line.strip()
+                if not line or line[0] in '#!':
+                    continue
+                match = re.match(r'^(.*?)\s*[=:]\s*(.*)$', line)
+                if match:
+                    lookup_table[match.group(1).strip()] = match.group(2).strip()
+    return lookup_table
+
+
+class Anonymizer(object):
+    """ Anonymizer class
+    This class applies an RSNA DICOM Anonymizer (DAT) script and look up table to in-memory datasets,
+    without starting a Java process for every file. The supported functions are: @keep, @remove,
+    @empty, @require, @always, @param, @hash, @hashuid, @hashptid, @hashdate, @incrementdate,
+    @lookup, @append, @date, @time and @if.
+    """
+
+    def __init__(self, script, lookup_table=None):
+        self.params = {}
+        self.scripts = {}
+        self.keep_groups = set()
+        self.remove = set()
+        self.lookup_table = load_lookup_table(lookup_table)
+
+        root = ElementTree.parse(script).getroot()
+        for node in root:
+            enabled = node.get('en', 'T') == 'T'
+            if node.tag == 'p':
+                self.params[node.get('t')] = node.text or ''
+            elif node.tag == 'e' and enabled:
+                self.scripts[Tag(int(node.get('t'), 16))] = node.text or ''
+            elif node.tag == 'k' and enabled:
+                self.keep_groups.add(int(node.get('t'), 16))
+            elif node.tag == 'r' and enabled:
+                self.remove.add(node.get('t'))
+
+    def anonymize(self, ds):
+        """
+        Anonymize a dataset in place
+        """
+        self.anonymize_dataset(ds, ds)
+        if hasattr(ds, 'file_meta') and 'SOPInstanceUID' in ds:
+            ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        return ds
+
+    def anonymize_dataset(self, ds, root):
+        # Functions refer to the values of the original dataset
+        values = {}
+        for elem in ds:
+            if elem.VR != 'SQ':
+                values[elem.tag] = element_string(elem.value)
+
+        for tag in list(ds.keys()):
+            elem = ds[tag]
+            if tag in self.scripts:
+                result = self.evaluate(self.scripts[tag], tag, values, root)
+                if result is REMOVE:
+                    del ds[tag]
+                elif result is KEEP:
+                    if elem.VR == 'SQ':
+                        for item in elem.value:
+                            self.anonymize_dataset(item, root)
+                else:
+                    self.set_value(ds, tag, result)
+            elif tag.group in self.keep_groups:
+                continue
+            elif self.is_removed(tag):
+                del ds[tag]
+            elif elem.VR == 'SQ':
+                for item in elem.value:
+                    self.anonymize_dataset(item, root)
+
+        # Elements created even if they are not in the dataset
+        if ds is root:
+            for tag, script in self.scripts.items():
+                if tag in ds:
+                    continue
+                if script.startswith('@always()') or script.startswith('@append()'):
+                    result = self.evaluate(script, tag, values, root)
+                    if result is not REMOVE and result is not KEEP:
+                        self.set_value(ds, tag, result)
+                elif script.startswith('@require()'):
+                    self.set_value(ds, tag, '')
+
+    def is_removed(self, tag):
+        if 'privategroups' in self.remove and tag.is_private:
+            return True
+        if 'curves' in self.remove and 0x5000 <= tag.group <= 0x501E:
+            return True
+        if 'overlays' in self.remove and 0x6000 <= tag.group <= 0x601E:
+            return True
+        if 'unspecifiedelements' in self.remove and tag.group > 0x0002:
+            return True
+        return False
+
+    def set_value(self, ds, tag, value):
+        if tag in ds:
+            if ds[tag].VR == 'SQ':
+                return
+            ds[tag].value = value
+        else:
+            try:
+                vr = dictionary_VR(tag)
+            except KeyError:
+                vr = 'LO'
+            ds.add_new(tag, vr.split(' or ')[0], value)
+
+    def element_value(self, name, tag, values, root):
+        """
+        Returns the value of an element referenced by name: 'this', a keyword or a tag [gggg,eeee]
+        """
+        if name == 'this':
+            return values.get(tag, '')
+        if name.startswith('@'):
+            return self.params.get(name[1:], '')
+        match = re.match(r'^[\[\(]?([0-9a-fA-F]{4}),?([0-9a-fA-F]{4})[\]\)]?$', name)
+        if match:
+            ref_tag = Tag(int(match.group(1), 16), int(match.group(2), 16))
+        else:
+            ref_tag = tag_for_keyword(name)
+            if ref_tag is None:
+                return ''
+            ref_tag = Tag(ref_tag)
+        if ref_tag in values:
+            return values[ref_tag]
+        if ref_tag in root and root[ref_tag].VR != 'SQ':
+            return element_string(root[ref_tag].value)
+        return ''
+
+    def parse_call(self, script, position):
+        """
+        Returns the name, arguments, brace blocks and end position of the function call at position
+        """
+        match = re.compile(r'@(\w+)\(([^)]*)\)').match(script, position)
+        if not match:
+            return None
+        name = match.group(1)
+        args = [x.strip() for x in match.group(2).split(',')] if match.group(2).strip() else []
+        position = match.end()
+        blocks = []
+        while position < len(script) and script[position] == '{' and len(blocks) < self.block_count(name):
+            depth = 0
+            for end in range(position, len(script)):
+                if script[end] == '{':
+                    depth += 1
+                elif script[end] == '}':
+                    depth -= 1
+                    if depth == 0:
+                        break
+            blocks.append(script[position + 1:end])
+            position = end + 1
+        return name, args, blocks, position
+
+    def block_count(self, name):
+        return {'if': 2, 'append': 1}.get(name, 0)
+
+    def evaluate(self, script, tag, values, root):
+        """
+        Evaluates a script, returns the new value of the element, KEEP or REMOVE
+        """
+        script = script.strip()
+        if not script:
+            return KEEP
+        output = ''
+        position = 0
+        while position < len(script):
+            call = self.parse_call(script, position) if script[position] == '@' else None
+            if call is None:
+                output += script[position]
+                position += 1
+                continue
+            name, args, blocks, position = call
+            result = self.call(name, args, blocks, tag, values, root)
+            if result is KEEP or result is REMOVE:
+                return result
+            output += result
+        return output
+
+    def call(self, name, args, blocks, tag, values, root):
+        value = lambda i: self.element_value(args[i], tag, values, root)
+        if name == 'keep':
+            return KEEP
+        if name == 'remove':
+            return REMOVE
+        if name == 'empty':
+            return ''
+        if name == 'require':
+            # Missing elements are created empty in anonymize_dataset
+            return KEEP
+        if name == 'always':
+            # The rest of the script gives the value, the element is created if missing
+            return ''
+        if name == 'param':
+            return self.params.get(args[0].lstrip('@'), '')
+        if name == 'hash':
+            text = value(0)
+            hashed = usmd5(text) if text else ''
+            return hashed[:int(args[1])] if len(args) > 1 else hashed
+        if name == 'hashuid':
+            uid = value(1)
+            if not uid:
+                return uid
+            prefix = value(0).strip()
+            if prefix and not prefix.endswith('.'):
+                prefix += '.'
+            return (prefix + usmd5(uid))[:64]
+        if name == 'hashptid':
+            return usmd5('[' + value(0) + ']' + value(1))
+        if name in ['hashdate', 'incrementdate']:
+            date = value(0)[:8]
+            if not date:
+                return ''
+            if name == 'hashdate':
+                days = -(int(usmd5(value(1))[:4]) % 3652)
+            else:
+                days = int(value(1) or 0)
+            try:
+                shifted = datetime.datetime.strptime(date, '%Y%m%d') + datetime.timedelta(days=days)
+            except ValueError:
+                return ''
+            return shifted.strftime('%Y%m%d')
+        if name == 'lookup':
+            key = args[1] + '/' + value(0)
+            if key in self.lookup_table:
+                return self.lookup_table[key]
+            action = args[2].lower() if len(args) > 2 else ''
+            if action in ['keep', 'remove', 'empty']:
+                return {'keep': KEEP, 'remove': REMOVE, 'empty': ''}[action]
+            raise AnonymizationError('Key {} not found in the look up table'.format(key))
+        if name == 'date':
+            return datetime.datetime.now().strftime('%Y{0}%m{0}%d'.format(args[0] if args else ''))
+        if name == 'time':
+            return datetime.datetime.now().strftime('%H{0}%M{0}%S'.format(args[0] if args else ''))
+        if name == 'append':
+            text = self.evaluate(blocks[0], tag, values, root) if blocks else ''
+            current = values.get(tag, '')
+            return current + '\\' + text if current else text
+        if name == 'if':
+            if self.condition(args, tag, values, root):
+                return self.evaluate(blocks[0], tag, values, root) if blocks else KEEP
+            return self.evaluate(blocks[1], tag, values, root) if len(blocks) > 1 else KEEP
+        raise AnonymizationError('Unsupported anonymizer function @{}'.format(name))
+
+    def condition(self, args, tag, values, root):
+        text = self.element_value(args[0], tag, values, root)
+        condition = args[1] if len(args) > 1 else 'exists'
+        operand = args[2].strip('"') if len(args) > 2 else ''
+        if condition == 'isblank':
+            return not text.strip()
+        if condition == 'exists':
+            return args[0] == 'this' and tag in values or bool(text)
+        if condition == 'equals':
+            return text == operand
+        if condition == 'contains':
+            return operand in text
+        if condition == 'matches':
+            return re.match(operand, text) is not None
+        raise AnonymizationError('Unsupported anonymizer condition {}'.format(condition))
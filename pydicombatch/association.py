@@ -0,0 +1,165 @@
+import time
+import random
+import threading
+
+
+class AssociationError(Exception):
+    """
+    Raised when an association is lost during a request or cannot be (re-)established
+    """
+    pass
+
+
+class PooledAssociation(object):
+    """ PooledAssociation class
+    An association of the pool with the bookkeeping needed to recycle it
+    """
+
+    def __init__(self, association):
+        self.association = association
+        self.created = time.time()
+        self.last_used = self.created
+        self.request_count = 0
+
+    @property
+    def is_established(self):
+        return self.association is not None and self.association.is_established
+
+
+class AssociationPool(object):
+    """ AssociationPool class
+    This class keeps a pool of associations to the PACS shared by the SCU threads. Idle associations
+    are kept alive with C-ECHO requests, associations are recycled after a maximum lifetime or number
+    of requests and lost associations are re-established with a jittered exponential backoff.
+    """
+
+    def __init__(self, config, establish_association, should_continue=None):
+        options = config.get('association') or {}
+        self.size = int(options.get('pool_size', config['request']['threads']))
+        self.max_lifetime = float(options.get('max_lifetime', 0))
+        self.max_requests = int(options.get('max_requests', 0))
+        self.keepalive_interval = float(options.get('keepalive_interval', 60))
+        self.backoff_initial = float(options.get('backoff_initial', 1))
+        self.backoff_max = float(options.get('backoff_max', 300))
+        self.max_retries = options.get('max_retries')
+        self.establish_association = establish_association
+        self.should_continue = should_continue or (lambda: True)
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.idle = []
+        self.open_count = 0
+        # Set by the requests batch to record the association setup times
+        self.metrics = None
+        self.keepalive_thread = None
+        if self.keepalive_interval > 0:
+            self.keepalive_thread = threading.Thread(target=self.keepalive)
+            self.keepalive_thread.daemon = True
+            self.keepalive_thread.start()
+
+    def acquire(self):
+        """
+        Returns an established association, waits for one to be released if the pool is full
+        """
+        with self.condition:
+            while True:
+                if self.stopped.is_set():
+                    raise AssociationError('Association pool closed')
+                while self.idle:
+                    pooled = self.idle.pop()
+                    if pooled.is_established and not self.expired(pooled):
+                        return pooled
+                    self.close_association(pooled)
+                if self.open_count < self.size:
+                    self.open_count += 1
+                    break
+                self.condition.wait()
+
+        try:
+            return self.connect()
+        except Exception:
+            with self.condition:
+                self.open_count -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, pooled, healthy=True):
+        """
+        Returns an association to the pool, unhealthy or expired associations are closed
+        """
+        pooled.request_count += 1
+        pooled.last_used = time.time()
+        with self.condition:
+            if healthy and pooled.is_established and not self.expired(pooled) and not self.stopped.is_set():
+                self.idle.append(pooled)
+            else:
+                self.close_association(pooled)
+            self.condition.notify()
+
+    def close(self):
+        self.stopped.set()
+        with self.condition:
+            while self.idle:
+                self.close_association(self.idle.pop())
+            self.condition.notify_all()
+
+    def expired(self, pooled):
+        if self.max_lifetime and time.time() - pooled.created > self.max_lifetime:
+            return True
+        if self.max_requests and pooled.request_count >= self.max_requests:
+            return True
+        return False
+
+    def close_association(self, pooled):
+        # Called with the condition held
+        self.open_count -= 1
+        if pooled.is_established:
+            try:
+                pooled.association.release()
+            except Exception:
+                pooled.association.abort()
+
+    def backoff_delay(self, attempt):
+        """
+        Returns a random delay between 0 and the exponential backoff limit (full jitter)
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_initial * 2 ** attempt))
+
+    def connect(self):
+        attempt = 0
+        while True:
+            time_start = time.time()
+            association = self.establish_association()
+            if self.metrics:
+                self.metrics.observe('association_setup_seconds', time.time() - time_start)
+            if association.is_established:
+                return PooledAssociation(association)
+            if self.metrics:
+                self.metrics.inc('association_failures_total')
+            if self.max_retries is not None and attempt >= int(self.max_retries):
+                raise AssociationError('Unable to establish association after {} attempts'.format(attempt + 1))
+            delay = self.backoff_delay(attempt)
+            print('Association failed, re-trying in {:.1f} seconds'.format(delay))
+            attempt += 1
+            if self.stopped.wait(delay) or not self.should_continue():
+                raise AssociationError('Extraction stopped while re-trying association')
+
+    def keepalive(self):
+        """
+        Sends C-ECHO requests on associations that have been idle for longer than keepalive_interval
+        """
+        while not self.stopped.wait(self.keepalive_interval / 2):
+            with self.condition:
+                now = time.time()
+                stale = [x for x in self.idle if now - x.last_used >= self.keepalive_interval]
+                self.idle = [x for x in self.idle if x not in stale]
+                # Checked out while the echo is sent
+            for pooled in stale:
+                healthy = False
+                if pooled.is_established:
+                    try:
+                        status = pooled.association.send_c_echo()
+                        healthy = bool(status) and status.Status == 0x0000
+                    except Exception:
+                        healthy = False
+                pooled.request_count -= 1
+                self.release(pooled, healthy)
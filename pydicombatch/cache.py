@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from pydicom.dataset import Dataset
+
+USE = 'use'
+REFRESH = 'refresh'
+CACHE_ONLY = 'cache_only'
+# Number of cache hits whose last use is kept in memory before it is written
+LAST_USED_BATCH = 1000
+
+
+def canonical_identifier(ds):
+    """
+    Returns a JSON serializable form of an identifier that does not depend on the order in which
+    its elements were added or on the spaces around their values
+    """
+    elements = []
+    for elem in ds:
+        if elem.VR == 'SQ':
+            value = [canonical_identifier(item) for item in elem.value]
+        else:
+            value = '' if elem.value is None else str(elem.value).strip()
+        elements.append(['{:08X}'.format(elem.tag), value])
+    return sorted(elements)
+
+
+class FindCache(object):
+    """ FindCache class
+    This class keeps the responses of successful C-FIND requests in a SQLite database, keyed on the
+    query model, the remote AE and the identifier of the request. Entries older than the time to live
+    of the run are ignored and the least recently used entries are evicted above the size limit. The
+    size of the entries is kept as a running total and the last use of the entries is written in
+    batches.
+    """
+
+    def __init__(self, config):
+        options = config.get('find_cache') or {}
+        self.filepath = options.get('file', os.path.join(config['output']['directory'], 'find-cache.db'))
+        self.ttl = float(options.get('ttl', 7 * 24 * 3600))
+        self.max_bytes = int(float(options.get('max_megabytes', 512)) * 1e6)
+        self.policy = str(options.get('policy', USE)).lower()
+        self.remote = [config['pacs']['aet'], config['pacs']['hostname'], config['pacs']['port']]
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.filepath)), exist_ok=True)
+        self.connection = sqlite3.connect(self.filepath, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, created REAL, last_used REAL, size INTEGER, responses TEXT)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        self.connection.commit()
+        self.total = self.total_size()
+        self.last_used = {}
+
+    def close(self):
+        with self.lock:
+            self.write_last_used()
+            self.connection.commit()
+            self.connection.close()
+
+    def total_size(self):
+        return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def write_last_used(self):
+        # Called with the lock held, committed by the caller
+        self.connection.executemany('UPDATE responses SET last_used = ? WHERE key = ?',
+            ((last_used, key) for key, last_used in self.last_used.items()))
+        self.last_used = {}
+
+    def key(self, identifier, query_model):
+        canonical = [str(query_model)] + self.remote + [canonical_identifier(identifier)]
+        return hashlib.sha1(json.dumps(canonical).encode('utf-8')).hexdigest()
+
+    def get(self, identifier, query_model):
+        """
+        Returns the cached response identifiers of a request, None if they are missing or expired
+        """
+        if self.policy == REFRESH:
+            return None
+        key = self.key(identifier, query_model)
+        with self.lock:
+            row = self.connection.execute('SELECT created, responses FROM responses WHERE key = ?',
+                (key,)).fetchone()
+            if row is None or time.time() - row[0] > self.ttl:
+                return None
+            self.last_used[key] = time.time()
+            if len(self.last_used) >= LAST_USED_BATCH:
+                self.write_last_used()
+                self.connection.commit()
+        return [Dataset.from_json(x) for x in json.loads(row[1])]
+
+    def put(self, identifier, query_model, responses):
+        """
+        Store the response identifiers of a successful request
+        """
+        key = self.key(identifier, query_model)
+        data = json.dumps([x.to_json_dict() for x in responses])
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                (key, now, now, len(data), data))
+            self.last_used.pop(key, None)
+            self.total += len(data) - (row[0] if row else 0)
+            if self.total > self.max_bytes:
+                self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        # Called with the lock held, the cache may also be written by other processes
+        self.write_last_used()
+        self.total = self.total_size()
+        while self.total > self.max_bytes:
+            rows = self.connection.execute('SELECT key, size FROM responses ORDER BY last_used LIMIT 100').fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.total -= size
+                if self.total <= self.max_bytes:
+                    break
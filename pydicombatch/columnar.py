@@ -0,0 +1,206 @@
+import os
+import time
+import uuid
+import datetime
+from pydicom.datadict import tag_for_keyword, dictionary_VR, dictionary_VM
+from pydicom.valuerep import DA, TM, DT
+from pydicom.multival import MultiValue
+
+# Output formats of the database_file and the extension of their parts
+COLUMNAR_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+INTEGER_VRS = ['IS', 'US', 'SS', 'UL', 'SL', 'UV', 'SV']
+FLOAT_VRS = ['DS', 'FL', 'FD']
+
+
+def import_pyarrow(database_format):
+    """
+    Returns the pyarrow module, which is only needed for the columnar formats
+    """
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError as exc:
+        raise ImportError('output.database_format {} requires pyarrow (pip install pyarrow)'.format(database_format)) from exc
+    return pyarrow
+
+def column_kind(keyword):
+    """
+    Returns the VR of the column of an element keyword and whether it holds lists of values. Elements
+    that are not in the DICOM dictionary and command elements such as Status are strings.
+    """
+    tag = tag_for_keyword(keyword)
+    if tag is None or tag >> 16 == 0x0000:
+        return 'LO', False
+    try:
+        return dictionary_VR(tag), dictionary_VM(tag) != '1'
+    except KeyError:
+        return 'LO', False
+
+def convert_value(value, vr):
+    """
+    Returns a value as the Python type of its column, None if it is empty or cannot be parsed
+    """
+    if value is None or value == '':
+        return None
+    try:
+        if vr == 'DA':
+            value = DA(value)
+            return datetime.date(value.year, value.month, value.day)
+        if vr == 'TM':
+            value = TM(value)
+            return datetime.time(value.hour, value.minute, value.second, value.microsecond)
+        if vr == 'DT':
+            # Local time of the PACS, the offset is dropped
+            return DT(value).replace(tzinfo=None)
+        if vr in INTEGER_VRS:
+            return int(value)
+        if vr in FLOAT_VRS:
+            return float(value)
+    except (ValueError, TypeError, OverflowError):
+        return None
+    return str(value)
+
+def dataset_to_row(ds, fieldnames):
+    """
+    Returns the elements of a response as typed values, multi-valued elements as lists
+    """
+    row = {}
+    for key in fieldnames:
+        vr, multiple = column_kind(key)
+        value = ds[key].value
+        if multiple:
+            if value is None or value == '':
+                row[key] = None
+            else:
+                values = value if isinstance(value, (MultiValue, list, tuple)) else [value]
+                row[key] = [convert_value(x, vr) for x in values]
+        else:
+            row[key] = convert_value(value, vr)
+    return row
+
+def arrow_type(pa, keyword):
+    vr, multiple = column_kind(keyword)
+    if vr == 'DA':
+        value_type = pa.date32()
+    elif vr == 'TM':
+        value_type = pa.time64('us')
+    elif vr == 'DT':
+        value_type = pa.timestamp('us')
+    elif vr in INTEGER_VRS:
+        value_type = pa.int64()
+    elif vr in FLOAT_VRS:
+        value_type = pa.float64()
+    else:
+        value_type = pa.string()
+    return pa.list_(value_type) if multiple else value_type
+
+def row_key(row, keys):
+    return tuple(tuple(row[key]) if isinstance(row[key], list) else row[key] for key in keys)
+
+
+class ColumnarResultFile(object):
+    """ ColumnarResultFile class
+    The database_file of an extraction as a Parquet or Arrow IPC dataset: a directory of part files
+    read as a single table (e.g. pyarrow.dataset.dataset(path) or pandas.read_parquet(path)). Rows
+    are buffered as typed columns and each part is written as one row group of row_group_size
+    rows, or of the rows received in the last row_group_interval seconds. Parts are complete files
+    as soon as they appear, a part is never modified and a resumed extraction adds new parts. With
+    deduplicate, the rows already in the dataset or in the previous_results datasets are skipped.
+    """
+
+    def __init__(self, config, filepath, fieldnames):
+        options = config['output']
+        self.database_format = str(options.get('database_format', 'parquet')).lower()
+        self.pa = import_pyarrow(self.database_format)
+        self.filepath = filepath
+        self.fieldnames = sorted(fieldnames)
+        self.schema = self.pa.schema([(key, arrow_type(self.pa, key)) for key in self.fieldnames])
+        self.row_group_size = int(options.get('row_group_size', 100000))
+        self.row_group_interval = float(options.get('row_group_interval', 60))
+        self.compression = options.get('compression')
+        self.fsync = bool(options.get('fsync', False))
+        self.columns = {key: [] for key in self.fieldnames}
+        self.buffered = 0
+        self.first_buffered = None
+        self.part_count = 0
+        # Parts of different runs and workers never have the same name
+        self.part_prefix = 'part-{}-{}'.format(time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8])
+        self.duplicates = 0
+        os.makedirs(self.filepath, exist_ok=True)
+        self.keys = None
+        if options.get('deduplicate', False):
+            self.keys = sorted(options.get('deduplicate_keys') or self.fieldnames)
+            self.seen = set()
+            previous = options.get('previous_results') or []
+            for path in [self.filepath] + ([previous] if isinstance(previous, str) else list(previous)):
+                self.load_keys(path)
+
+    def load_keys(self, path):
+        """
+        Add the rows of a previous result set, a Parquet or Arrow IPC file or directory, to the
+        rows skipped by deduplication
+        """
+        if not os.path.exists(path):
+            print('Previous results not found: {}'.format(path))
+            return
+        file_format = 'ipc' if path.endswith('.arrow') or (path == self.filepath and self.database_format == 'arrow') else 'parquet'
+        try:
+            table = self.pa.dataset.dataset(path, format=file_format).to_table(columns=self.keys)
+        except Exception as exc:
+            print('Loading previous results from {} failed: {}'.format(path, exc))
+            return
+        columns = [table.column(key).to_pylist() for key in self.keys]
+        for values in zip(*columns):
+            self.seen.add(tuple(tuple(x) if isinstance(x, list) else x for x in values))
+
+    def writerow(self, row):
+        if self.keys is not None:
+            key = row_key(row, self.keys)
+            if key in self.seen:
+                self.duplicates += 1
+                return
+            self.seen.add(key)
+        for key in self.fieldnames:
+            self.columns[key].append(row.get(key))
+        if self.first_buffered is None:
+            self.first_buffered = time.time()
+        self.buffered += 1
+
+    def flush(self, force=False):
+        """
+        Write the buffered rows as a new part if there are row_group_size of them, if the oldest one
+        was received row_group_interval seconds ago, or if force is True
+        """
+        if not self.buffered:
+            return
+        if not force and self.buffered < self.row_group_size and time.time() - self.first_buffered < self.row_group_interval:
+            return
+        table = self.pa.table({key: self.pa.array(self.columns[key], type=self.schema.field(key).type)
+            for key in self.fieldnames}, schema=self.schema)
+        name = '{}-{:05d}{}'.format(self.part_prefix, self.part_count, COLUMNAR_FORMATS[self.database_format])
+        part = os.path.join(self.filepath, name)
+        # Hidden until it is complete, dataset readers skip files starting with a dot
+        tmp_part = os.path.join(self.filepath, '.' + name + '.tmp')
+        if self.database_format == 'arrow':
+            options = self.pa.ipc.IpcWriteOptions(compression=self.compression)
+            with self.pa.OSFile(tmp_part, 'wb') as sink:
+                with self.pa.ipc.new_file(sink, self.schema, options=options) as writer:
+                    writer.write_table(table, max_chunksize=self.row_group_size)
+        else:
+            self.pa.parquet.write_table(table, tmp_part, row_group_size=self.row_group_size,
+                compression=self.compression or 'snappy')
+        if self.fsync:
+            with open(tmp_part, 'rb') as file:
+                os.fsync(file.fileno())
+        os.replace(tmp_part, part)
+        self.part_count += 1
+        self.columns = {key: [] for key in self.fieldnames}
+        self.buffered = 0
+        self.first_buffered = None
+
+    def close(self):
+        self.flush(force=True)
+        if self.duplicates:
+            print('{} rows already in the results of {} were skipped'.format(self.duplicates, self.filepath))
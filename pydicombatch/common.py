@@ -1,6 +1,8 @@
 import yaml
-from .scu import process_request_batch
+from .scu import process_request_batch, has_failed_requests
 from .scp import SCP
+from .ratelimit import RateLimiter
+from .distributed import coordinate, run_worker
 import os
 import sys
 
@@ -10,18 +12,38 @@ def pydicombatch(config_file):
 
         print('Running extraction defined in: ', config_file)
 
-        if config['request']['type'].lower() == 'c-move':
-            scp = SCP(config)
-            scp.start_server()
+        if (config.get('distributed') or {}).get('enabled', False):
+            # The requests are sent by worker processes leasing them from the request store
+            try:
+                coordinate(config)
+            except KeyboardInterrupt:
+                print('\nExtraction stopped. To resume extraction, please re-execute the script.')
+            return
+
+        # The rate limiter is shared by the SCU workers and the storage SCP
+        limiter = RateLimiter(config)
+
+        scp = None
+        if config['request']['type'].lower() in ['c-move', 'c-get']:
+            # C-GET receives the instances on the associations of the SCU, without a listening server
+            scp = SCP(config, limiter)
+            scp.start_server(listen=config['request']['type'].lower() == 'c-move')
         try:
-            process_request_batch(config)
+            # The received files are post-processed before the batch returns
+            process_request_batch(config, limiter, scp)
         except KeyboardInterrupt:
             print('\b\b\r')
             print('\nExtraction stopped. To resume extraction, please re-execute the script.')
-            if config['request']['type'].lower() == 'c-move':
+            if scp:
                 scp.stop_server()
 
-            filepath_requests_failed = os.path.join(config['output']['directory'], 'requests.failed')
-            if os.path.exists(filepath_requests_failed):
+            if has_failed_requests(config):
                 print('Failed requests detected. To re-try failed request, re-run batch request.')
-            sys.exit(0)
\ No newline at end of file
+            sys.exit(0)
+
+def pydicombatch_worker(config_file, index):
+    with open(config_file) as file:
+        config = yaml.load(file, Loader=yaml.FullLoader)
+
+        print('Running worker {} of extraction defined in: '.format(index), config_file)
+        run_worker(config, index, spawned=False)
@@ -0,0 +1,141 @@
+import os
+import copy
+import time
+import socket
+import multiprocessing
+import tqdm
+from .scu import (
+    process_request_batch, create_requests, pending_requests, failed_requests, has_failed_requests
+)
+from .scp import SCP, listener_addresses, indexed_aet
+from .ratelimit import RateLimiter
+from .ingest import read_requests
+from .state import RequestStore, request_store_path, PENDING, IN_FLIGHT, COMPLETED, FAILED
+
+
+def worker_config(config, index, spawned=True):
+    """
+    Returns the configuration of a worker of a distributed extraction. Each worker has its own
+    local AE and port for its storage SCP, its own database_file and its own temporary directory.
+    """
+    config = copy.deepcopy(config)
+    options = config.get('distributed') or {}
+    aets = options.get('worker_aets') or []
+    ports = options.get('worker_ports') or []
+    listeners = len(listener_addresses(config))
+    if len(set(aets)) != len(aets):
+        raise ValueError('distributed.worker_aets must be different AE titles: {}'.format(', '.join(aets)))
+    aet = config['local']['aet']
+    config['local']['aet'] = aets[index] if index < len(aets) else indexed_aet(aet, index)
+    config['local']['port'] = int(ports[index]) if index < len(ports) else int(config['local']['port']) + (index + 1) * listeners
+    # The listeners of a worker follow its own AE title and port, the other ones are numbered with the
+    # worker and listener indexes so that they are different across the workers
+    config['local']['listeners'] = [{'aet': config['local']['aet'], 'port': config['local']['port']}] + [
+        {'aet': indexed_aet(aet, '{}-{}'.format(index, i)), 'port': config['local']['port'] + i}
+        for i in range(1, listeners)]
+    root, ext = os.path.splitext(config['output']['database_file'])
+    config['output']['database_file'] = '{}-worker{}{}'.format(root, index, ext)
+    config['output']['tmp_directory'] = os.path.join(config['output']['directory'], 'tmp', 'worker{}'.format(index))
+    if config.get('metrics'):
+        metrics = config['metrics']
+        directory = config['output']['directory']
+        root, ext = os.path.splitext(metrics.get('prometheus_file', os.path.join(directory, 'metrics.prom')))
+        metrics['prometheus_file'] = '{}-worker{}{}'.format(root, index, ext)
+        root, ext = os.path.splitext(metrics.get('json_file', os.path.join(directory, 'metrics.json')))
+        metrics['json_file'] = '{}-worker{}{}'.format(root, index, ext)
+        metrics['labels'] = dict(metrics.get('labels') or {}, worker=index)
+    if config.get('profiling'):
+        profiling = config['profiling']
+        directory = config['output']['directory']
+        root, ext = os.path.splitext(profiling.get('trace_file', os.path.join(directory, 'trace.json')))
+        profiling['trace_file'] = '{}-worker{}{}'.format(root, index, ext)
+        profiling['cprofile_directory'] = '{}-worker{}'.format(
+            profiling.get('cprofile_directory', os.path.join(directory, 'cprofile')), index)
+    if spawned:
+        # Progress is reported by the coordinator
+        config['output']['progress'] = False
+    return config
+
+def run_worker(config, index, spawned=True):
+    """
+    Sends the requests leased from the request store of the coordinator until none is left
+    """
+    config = worker_config(config, index, spawned)
+    if not os.path.isfile(request_store_path(config)):
+        print('Worker {}: no request store found in {}'.format(index, config['output']['directory']))
+        return
+    owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), index)
+    limiter = RateLimiter(config)
+    scp = None
+    if config['request']['type'].lower() in ['c-move', 'c-get']:
+        scp = SCP(config, limiter)
+        scp.start_server(listen=config['request']['type'].lower() == 'c-move')
+    try:
+        process_request_batch(config, limiter, scp, owner)
+    except KeyboardInterrupt:
+        # Leases that were not released expire and are leased by the other workers
+        if scp:
+            scp.stop_server()
+
+def coordinate(config):
+    """
+    Prepares the request store of a distributed extraction and runs distributed.workers local
+    worker processes. Workers started on other hosts with the same configuration lease requests
+    from the same request store.
+    """
+    filepath_store = request_store_path(config)
+    states = None
+    if os.path.isfile(filepath_store):
+        # Previous extraction detected
+        if has_failed_requests(config):
+            states = failed_requests(config)
+        else:
+            states = pending_requests(config)
+    if states is None:
+        # No previous extraction detected, or overwritten
+        create_requests(config)
+        store = RequestStore(filepath_store)
+        added = 0
+        for chunk in read_requests(config, int(config['request'].get('chunk_size', 10000))):
+            added += len(store.add(chunk))
+        store.close()
+        print('{} requests added to the request store'.format(added))
+    elif not states:
+        print('No further requests pending')
+        return
+
+    store = RequestStore(filepath_store)
+    if states and FAILED in states:
+        store.requeue(FAILED)
+    # No worker is running yet
+    store.reset_in_flight()
+    store.release_leases()
+
+    options = config.get('distributed') or {}
+    context = multiprocessing.get_context('spawn')
+    workers = []
+    for index in range(int(options.get('workers', 0))):
+        worker = context.Process(target=run_worker, args=(config, index))
+        worker.start()
+        workers.append(worker)
+
+    print('To stop extraction, press CTRL-C. Extraction can be resumed at a later time.')
+    pbar = tqdm.tqdm(total=store.count(PENDING, IN_FLIGHT, COMPLETED, FAILED),
+        desc='Sending {} requests '.format(config['request']['type']),
+        unit='rqst',
+        disable=not config['output'].get('progress', True))
+    pbar.update(store.count(COMPLETED, FAILED))
+    try:
+        while True:
+            # Split C-FIND requests add requests to the store
+            pbar.total = store.count(PENDING, IN_FLIGHT, COMPLETED, FAILED)
+            pbar.update(store.count(COMPLETED, FAILED) - pbar.n)
+            if store.count(PENDING, IN_FLIGHT) == 0 or (workers and not any(worker.is_alive() for worker in workers)):
+                break
+            time.sleep(1.0)
+    finally:
+        for worker in workers:
+            worker.join()
+        pbar.update(store.count(COMPLETED, FAILED) - pbar.n)
+        pbar.close()
+        store.close()
@@ -0,0 +1,211 @@
+import os
+import csv
+import time
+import itertools
+import threading
+from queue import Queue
+from .state import Request, PENDING, IN_FLIGHT
+
+
+class RequestTemplate(object):
+    """ RequestTemplate class
+    The request elements compiled once for the columns of the elements_batch_file, so that the
+    identifier of a row is built by filling the values in place instead of searching the element
+    list for every column.
+    """
+
+    def __init__(self, config, fieldnames=None):
+        self.elements = list(config['request']['elements'])
+        priority_column = config['request'].get('priority_column')
+        keys = [x.partition('=')[0] for x in self.elements]
+        self.priority_index = None
+        self.columns = []
+        for i, name in enumerate(fieldnames or []):
+            keyword = name.strip()
+            if keyword == priority_column:
+                # Used to order the requests, not sent to the PACS
+                self.priority_index = i
+                continue
+            if keyword in keys:
+                index = keys.index(keyword)
+            else:
+                index = len(self.elements)
+                self.elements.append(keyword)
+                keys.append(keyword)
+            self.columns.append((i, index, keyword))
+
+    def create_request(self, row=None):
+        elements = list(self.elements)
+        for i, index, keyword in self.columns:
+            # Identical identifiers are identical requests, whatever their spacing
+            value = row[i].strip() if i < len(row) else ''
+            elements[index] = '{}={}'.format(keyword, value)
+        priority = 0.0
+        if self.priority_index is not None:
+            value = row[self.priority_index].strip() if self.priority_index < len(row) else ''
+            priority = float(value) if value else 0.0
+        # The elements that are not read from the row are shared by all the requests
+        return Request(elements, priority=priority)
+
+
+def read_requests(config, chunk_size=10000):
+    """
+    Yields the requests of the elements_batch_file in chunks, or the request of the configuration
+    if there is no batch file
+    """
+    filepath = config['request'].get('elements_batch_file')
+    if not filepath or not os.path.exists(filepath):
+        yield [RequestTemplate(config).create_request()]
+        return
+    with open(filepath, newline='') as csvfile:
+        reader = csv.reader(csvfile, dialect='excel')
+        fieldnames = next(reader, None)
+        if fieldnames is None:
+            return
+        template = RequestTemplate(config, fieldnames)
+        while True:
+            chunk = [template.create_request(row) for row in itertools.islice(reader, chunk_size) if row]
+            if not chunk:
+                return
+            yield chunk
+
+
+class WorkQueue(Queue):
+    """ WorkQueue class
+    The queue of requests shared by the SCU workers. Requests are fed by the RequestFeeder up to
+    max_queued requests ahead of the workers, the queue is drained once the feeder is done and no
+    request is in flight (a C-FIND request being split adds requests to the queue).
+    """
+
+    def __init__(self, max_queued=0):
+        super().__init__()
+        self.max_queued = max_queued
+        self.feeding = False
+        self.closed = False
+        # Requests are leased from a request store shared with other processes
+        self.leased = False
+
+    def feed(self, request):
+        """
+        Put a request in the queue once there is room for it. Returns False if the queue was closed
+        """
+        with self.not_full:
+            while self.max_queued and self._qsize() >= self.max_queued and not self.closed:
+                self.not_full.wait()
+        if self.closed:
+            return False
+        self.put(request)
+        return True
+
+    def close(self):
+        with self.not_full:
+            self.closed = True
+            self.not_full.notify_all()
+
+    def is_drained(self):
+        return not self.feeding and self.unfinished_tasks == 0
+
+
+class RequestFeeder(object):
+    """ RequestFeeder class
+    This class feeds the work queue from a thread while the workers send requests. A new extraction
+    is read from the elements_batch_file in chunks that are added to the request store and queued
+    immediately, so that the first requests are sent before the whole file is read. Resumed
+    extractions, and new extractions ordered by priority_column, are read from the request store
+    in chunks. A worker of a distributed extraction (owner) leases the requests from the request
+    store shared with the other workers and keeps its leases alive while it sends them.
+    """
+
+    def __init__(self, config, store, work_queue, states, ingest=False, pbar=None, plan=None, owner=None):
+        self.config = config
+        self.store = store
+        self.work_queue = work_queue
+        self.states = states
+        self.ingest = ingest
+        self.pbar = pbar
+        self.plan = plan
+        self.chunk_size = int(config['request'].get('chunk_size', 10000))
+        self.owner = owner
+        options = config.get('distributed') or {}
+        self.lease_size = int(options.get('lease_size', 100))
+        self.lease_duration = float(options.get('lease_duration', 300))
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.work_queue.feeding = True
+        self.work_queue.leased = self.owner is not None
+        self.thread = threading.Thread(target=self.run if self.owner is None else self.run_leases)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.work_queue.close()
+        if self.thread:
+            self.thread.join()
+
+    def run_leases(self):
+        """
+        Lease batches of requests until no request is left in the store, the leases of the requests
+        queued or in flight are renewed every third of their duration
+        """
+        renewed = time.time()
+        try:
+            while not self.stopped.is_set():
+                if time.time() - renewed > self.lease_duration / 3:
+                    self.store.renew(self.owner, self.lease_duration)
+                    renewed = time.time()
+                # At most one batch is queued ahead, so that the other workers lease the rest
+                with self.work_queue.mutex:
+                    room = self.lease_size - self.work_queue._qsize()
+                if room <= 0:
+                    self.stopped.wait(0.5)
+                    continue
+                rows = self.store.lease(self.owner, min(room, self.lease_size), self.lease_duration)
+                if rows:
+                    self.feed([Request(elements, request_id) for request_id, elements in rows])
+                    continue
+                if self.store.count(PENDING, IN_FLIGHT) == 0:
+                    return
+                # Requests leased by other workers, leased again if their worker stops
+                self.stopped.wait(1.0)
+        except Exception as exc:
+            print('Leasing requests failed: {}'.format(exc))
+        finally:
+            self.work_queue.feeding = False
+            self.store.release_leases(self.owner)
+
+    def run(self):
+        try:
+            ordered = self.config['request'].get('priority_column') is not None
+            if self.ingest:
+                for chunk in read_requests(self.config, self.chunk_size):
+                    if self.work_queue.closed:
+                        return
+                    chunk = self.store.add(chunk)
+                    if ordered:
+                        # Requests are queued once they can be sorted
+                        continue
+                    if not self.feed(chunk):
+                        return
+            if ordered or not self.ingest:
+                for rows in self.store.iterate(self.states, self.chunk_size):
+                    chunk = [Request(elements, request_id) for request_id, elements in rows]
+                    if not self.feed(chunk):
+                        return
+        except Exception as exc:
+            print('Reading requests failed: {}'.format(exc))
+        finally:
+            self.work_queue.feeding = False
+
+    def feed(self, chunk):
+        if self.plan:
+            chunk = self.plan(chunk)
+        if self.pbar is not None:
+            self.pbar.total += len(chunk)
+            self.pbar.refresh()
+        for request in chunk:
+            if not self.work_queue.feed(request):
+                return False
+        return True
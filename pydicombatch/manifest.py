@@ -0,0 +1,257 @@
+import os
+import copy
+import time
+import sqlite3
+import threading
+from pydicom.dataset import Dataset
+from pynetdicom.sop_class import (
+    PatientRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelFind
+)
+
+
+class InstanceManifest(object):
+    """ InstanceManifest class
+    This class keeps the original identifiers of every instance written to the output directory in a
+    SQLite database, so that later extractions know which instances of a study or series are
+    already on disk. Inserts are committed in batches every commit_interval seconds by a background
+    thread, so that the write lock of the database, shared by the workers of a distributed
+    extraction, is never held longer than that.
+    """
+
+    def __init__(self, config):
+        options = config.get('manifest') or {}
+        self.filepath = options.get('file', os.path.join(config['output']['directory'], 'manifest.db'))
+        self.commit_interval = float(options.get('commit_interval', 1.0))
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.stopped = threading.Event()
+        os.makedirs(os.path.dirname(os.path.abspath(self.filepath)), exist_ok=True)
+        # Shared by the workers of a distributed extraction
+        self.connection = sqlite3.connect(self.filepath, check_same_thread=False, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS instances ('
+            'sop_instance_uid TEXT PRIMARY KEY, patient_id TEXT, study_instance_uid TEXT, '
+            'series_instance_uid TEXT, path TEXT, received REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS instances_series ON instances '
+            '(study_instance_uid, series_instance_uid)')
+        self.connection.commit()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.commit_interval):
+            self.commit()
+
+    def commit(self):
+        with self.lock:
+            if self.uncommitted:
+                self.connection.commit()
+                self.uncommitted = 0
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+    def add(self, uids, filepath):
+        """
+        Record an instance written to the output directory, uids are its original identifiers
+        """
+        if not uids.get('SOPInstanceUID'):
+            return
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?, ?, ?)',
+                (uids['SOPInstanceUID'], uids.get('PatientID'), uids.get('StudyInstanceUID'),
+                uids.get('SeriesInstanceUID'), filepath, time.time()))
+            self.uncommitted += 1
+
+    def count(self, study, series=None):
+        """
+        Returns the number of instances of a study, or of one of its series, on disk
+        """
+        with self.lock:
+            if series is None:
+                return self.connection.execute('SELECT COUNT(*) FROM instances WHERE study_instance_uid = ?',
+                    (study,)).fetchone()[0]
+            return self.connection.execute('SELECT COUNT(*) FROM instances '
+                'WHERE study_instance_uid = ? AND series_instance_uid = ?', (study, series)).fetchone()[0]
+
+    def sop_instances(self, study, series):
+        """
+        Returns the SOPInstanceUIDs of a series on disk
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT sop_instance_uid FROM instances '
+                'WHERE study_instance_uid = ? AND series_instance_uid = ?', (study, series)).fetchall()
+        return set(row[0] for row in rows)
+
+    def contains(self, sop_instance):
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM instances WHERE sop_instance_uid = ?',
+                (sop_instance,)).fetchone() is not None
+
+
+class ManifestFilter(object):
+    """ ManifestFilter class
+    This class compares the instances of a C-MOVE or C-GET request already on disk, according to the
+    manifest, to the number of instances of the PACS (NumberOfStudyRelatedInstances and
+    NumberOfSeriesRelatedInstances from a C-FIND). A request whose instances are all on disk is not
+    sent, a request with missing instances is narrowed to the incomplete series or to the missing
+    instances (IMAGE level, at most max_instances of them).
+    """
+
+    def __init__(self, config, manifest, limiter=None):
+        options = config.get('manifest') or {}
+        self.manifest = manifest
+        self.limiter = limiter
+        self.max_instances = int(options.get('max_instances', 1000))
+        self.enabled = config['request']['model'] != 'psonly'
+        if config['request']['model'] == 'patient':
+            self.query_model = PatientRootQueryRetrieveInformationModelFind
+        else:
+            self.query_model = StudyRootQueryRetrieveInformationModelFind
+
+    def single_value(self, identifier, keyword):
+        if keyword not in identifier or identifier[keyword].VM != 1:
+            return None
+        return str(identifier[keyword].value)
+
+    def narrow(self, association, identifier):
+        """
+        Returns the identifier of the instances to retrieve, None if all of them are on disk
+        """
+        if not self.enabled:
+            return identifier
+        level = str(identifier.get('QueryRetrieveLevel', '')).upper()
+        study = self.single_value(identifier, 'StudyInstanceUID')
+        if level == 'IMAGE':
+            if 'SOPInstanceUID' not in identifier or identifier['SOPInstanceUID'].VM == 0:
+                return identifier
+            value = identifier['SOPInstanceUID'].value
+            sop_instances = [str(x) for x in (value if identifier['SOPInstanceUID'].VM > 1 else [value])]
+            missing = [x for x in sop_instances if not self.manifest.contains(x)]
+            if not missing:
+                return None
+            narrowed = copy.deepcopy(identifier)
+            narrowed.SOPInstanceUID = missing if len(missing) > 1 else missing[0]
+            return narrowed
+        if study is None:
+            return identifier
+
+        if level == 'SERIES':
+            series = self.single_value(identifier, 'SeriesInstanceUID')
+            if series is None:
+                return identifier
+            local = self.manifest.count(study, series)
+            if local == 0:
+                # Nothing on disk, no need to query the PACS
+                return identifier
+            remote = self.related_instances(association, identifier, 'SERIES', series)
+            if remote is None:
+                return identifier
+            if local >= remote:
+                return None
+            return self.missing_instances(association, identifier, study, series)
+
+        if level == 'STUDY':
+            local = self.manifest.count(study)
+            if local == 0:
+                return identifier
+            remote = self.related_instances(association, identifier, 'STUDY')
+            if remote is None:
+                return identifier
+            if local >= remote:
+                return None
+            incomplete = [series for series, count in self.study_series(association, identifier, study)
+                if self.manifest.count(study, series) < count]
+            if not incomplete:
+                return identifier
+            if len(incomplete) == 1:
+                return self.missing_instances(association, identifier, study, incomplete[0])
+            narrowed = self.base_identifier(identifier, 'SERIES', study)
+            narrowed.SeriesInstanceUID = incomplete
+            return narrowed
+        return identifier
+
+    def base_identifier(self, identifier, level, study):
+        ds = Dataset()
+        ds.QueryRetrieveLevel = level
+        if 'PatientID' in identifier and identifier.PatientID:
+            ds.PatientID = identifier.PatientID
+        ds.StudyInstanceUID = study
+        return ds
+
+    def find(self, association, ds):
+        """
+        Returns the response identifiers of a C-FIND, None if it failed
+        """
+        if self.limiter:
+            self.limiter.acquire_request()
+        responses = []
+        for (status, rsp_identifier) in association.send_c_find(ds, self.query_model):
+            if 'Status' not in status or status.Status not in [0x0000, 0xFF00, 0xFF01]:
+                return None
+            if status.Status in [0xFF00, 0xFF01] and rsp_identifier:
+                responses.append(rsp_identifier)
+        return responses
+
+    def related_instances(self, association, identifier, level, series=None):
+        """
+        Returns the number of instances of a study or series on the PACS, None if it is unknown
+        """
+        keyword = 'NumberOfSeriesRelatedInstances' if level == 'SERIES' else 'NumberOfStudyRelatedInstances'
+        ds = self.base_identifier(identifier, level, str(identifier.StudyInstanceUID))
+        if series:
+            ds.SeriesInstanceUID = series
+        setattr(ds, keyword, None)
+        responses = self.find(association, ds)
+        if not responses or keyword not in responses[0] or responses[0][keyword].value in [None, '']:
+            return None
+        return int(responses[0][keyword].value)
+
+    def study_series(self, association, identifier, study):
+        """
+        Returns the SeriesInstanceUID and number of instances of the series of a study on the PACS
+        """
+        ds = self.base_identifier(identifier, 'SERIES', study)
+        ds.SeriesInstanceUID = ''
+        ds.NumberOfSeriesRelatedInstances = None
+        series = []
+        for rsp_identifier in self.find(association, ds) or []:
+            if 'SeriesInstanceUID' not in rsp_identifier:
+                continue
+            count = rsp_identifier.get('NumberOfSeriesRelatedInstances')
+            # A series without a count is retrieved entirely
+            series.append((str(rsp_identifier.SeriesInstanceUID), int(count) if count not in [None, ''] else float('inf')))
+        return series
+
+    def missing_instances(self, association, identifier, study, series):
+        """
+        Returns an IMAGE-level identifier of the instances of a series that are not on disk, or a
+        SERIES-level identifier if there are too many of them
+        """
+        narrowed = self.base_identifier(identifier, 'SERIES', study)
+        narrowed.SeriesInstanceUID = series
+        local = self.manifest.sop_instances(study, series)
+        if not local:
+            return narrowed
+        ds = self.base_identifier(identifier, 'IMAGE', study)
+        ds.SeriesInstanceUID = series
+        ds.SOPInstanceUID = ''
+        responses = self.find(association, ds)
+        if responses is None:
+            return narrowed
+        missing = sorted(set(str(x.SOPInstanceUID) for x in responses if 'SOPInstanceUID' in x) - local)
+        if not missing:
+            # The count of the PACS includes instances it does not list
+            return None
+        if len(missing) > self.max_instances:
+            return narrowed
+        narrowed.QueryRetrieveLevel = 'IMAGE'
+        narrowed.SOPInstanceUID = missing if len(missing) > 1 else missing[0]
+        return narrowed
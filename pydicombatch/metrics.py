@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import bisect
+import threading
+
+# Upper bounds in seconds of the latency histograms
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0]
+
+# Counters whose rate per second is included in the JSON snapshot
+RATE_COUNTERS = ['received_bytes_total', 'received_instances_total', 'requests_total']
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in labels) + '}'
+
+
+class Histogram(object):
+    """ Histogram class
+    The number of observations per bucket, their count and sum
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+
+class Metrics(object):
+    """ Metrics class
+    This class collects the counters, gauges and latency histograms of an extraction (request
+    latencies by type, final DIMSE statuses, data received by the storage SCP, queue depths and
+    post-processing times) and rewrites them every interval seconds as a Prometheus text file and a
+    JSON snapshot. Counters and histograms are updated from any thread under a single lock.
+    """
+
+    def __init__(self, config):
+        options = config.get('metrics') or {}
+        directory = config['output']['directory']
+        self.prometheus_file = options.get('prometheus_file', os.path.join(directory, 'metrics.prom'))
+        self.json_file = options.get('json_file', os.path.join(directory, 'metrics.json'))
+        self.interval = float(options.get('interval', 10))
+        self.prefix = str(options.get('prefix', 'pydicombatch_'))
+        # Labels added to every metric, e.g. the worker of a distributed extraction
+        self.labels = tuple(sorted((str(key), str(value)) for key, value in (options.get('labels') or {}).items()))
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.time_start = time.time()
+        self.last_snapshot = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def key(self, name, labels):
+        return (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+    def inc(self, name, amount=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def gauge(self, name, function, **labels):
+        """
+        Register a gauge whose value is read from function when the metrics are written
+        """
+        with self.lock:
+            self.gauges[self.key(name, labels)] = function
+
+    def start(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.prometheus_file)), exist_ok=True)
+        os.makedirs(os.path.dirname(os.path.abspath(self.json_file)), exist_ok=True)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the periodic writes and write the final metrics
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.write()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except Exception as exc:
+                print('Writing metrics failed: {}'.format(exc))
+
+    def gauge_values(self):
+        values = {}
+        for key, function in self.gauges.items():
+            try:
+                values[key] = float(function())
+            except Exception:
+                # The object measured by the gauge is gone
+                continue
+        return values
+
+    def snapshot(self):
+        """
+        Returns the current values of the metrics and the rates of RATE_COUNTERS since the
+        previous snapshot
+        """
+        now = time.time()
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = self.gauge_values()
+            histograms = {key: {'buckets': list(zip(x.buckets + [float('inf')], x.cumulative_counts())),
+                'count': x.count, 'sum': x.sum} for key, x in self.histograms.items()}
+        totals = {}
+        for (name, labels), value in counters.items():
+            if name in RATE_COUNTERS:
+                totals[name] = totals.get(name, 0) + value
+        rates = {}
+        if self.last_snapshot is not None:
+            last_time, last_totals = self.last_snapshot
+            elapsed = max(now - last_time, 1e-6)
+            rates = {name + '_per_second': (value - last_totals.get(name, 0)) / elapsed
+                for name, value in totals.items()}
+        self.last_snapshot = (now, totals)
+        return now, counters, gauges, histograms, rates
+
+    def prometheus_text(self, counters, gauges, histograms):
+        lines = []
+        for kind, values in [('counter', counters), ('gauge', gauges)]:
+            for name in sorted(set(name for name, labels in values)):
+                lines.append('# TYPE {}{} {}'.format(self.prefix, name, kind))
+                for (other, labels), value in sorted(values.items()):
+                    if other == name:
+                        lines.append('{}{}{} {}'.format(self.prefix, name, format_labels(self.labels + labels), value))
+        for name in sorted(set(name for name, labels in histograms)):
+            lines.append('# TYPE {}{} histogram'.format(self.prefix, name))
+            for (other, labels), histogram in sorted(histograms.items()):
+                if other != name:
+                    continue
+                for bound, count in histogram['buckets']:
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{}{}_bucket{} {}'.format(self.prefix, name,
+                        format_labels(self.labels + labels + (('le', le),)), count))
+                lines.append('{}{}_sum{} {}'.format(self.prefix, name, format_labels(self.labels + labels), histogram['sum']))
+                lines.append('{}{}_count{} {}'.format(self.prefix, name, format_labels(self.labels + labels), histogram['count']))
+        lines.append('# TYPE {}uptime_seconds gauge'.format(self.prefix))
+        lines.append('{}uptime_seconds{} {}'.format(self.prefix, format_labels(self.labels), time.time() - self.time_start))
+        return '\n'.join(lines) + '\n'
+
+    def json_snapshot(self, now, counters, gauges, histograms, rates):
+        entry = lambda name, labels, value: dict(name=name, labels=dict(self.labels + labels), value=value)
+        return {
+            'time': now,
+            'uptime_seconds': now - self.time_start,
+            'counters': [entry(name, labels, value) for (name, labels), value in sorted(counters.items())],
+            'gauges': [entry(name, labels, value) for (name, labels), value in sorted(gauges.items())],
+            'histograms': [entry(name, labels, {'count': x['count'], 'sum': x['sum'],
+                'buckets': [['+Inf' if bound == float('inf') else bound, count] for bound, count in x['buckets']]})
+                for (name, labels), x in sorted(histograms.items())],
+            'rates': rates
+        }
+
+    def write(self):
+        """
+        Rewrite the Prometheus text file and the JSON snapshot, atomically for their readers
+        """
+        now, counters, gauges, histograms, rates = self.snapshot()
+        self.write_file(self.prometheus_file, self.prometheus_text(counters, gauges, histograms))
+        self.write_file(self.json_file, json.dumps(self.json_snapshot(now, counters, gauges, histograms, rates), indent=2))
+
+    def write_file(self, filepath, content):
+        tmp_filepath = filepath + '.tmp'
+        with open(tmp_filepath, 'w') as file:
+            file.write(content)
+        os.replace(tmp_filepath, filepath)
@@ -0,0 +1,141 @@
+from pydicom.dataset import Dataset
+from pynetdicom.apps.common import ElementPath
+from pynetdicom.sop_class import (
+    PatientRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelFind
+)
+from .state import Request
+
+# Elements that may remain in a study-level C-MOVE identifier
+STUDY_KEYWORDS = ['PatientID', 'StudyInstanceUID']
+
+
+def element_dict(elements):
+    """
+    Returns the keyword / value pairs of a list of elements in the format Keyword=value
+    """
+    return {key.strip(): value.strip() for key, _, value in (x.partition('=') for x in elements)}
+
+
+class RequestPlanner(object):
+    """ RequestPlanner class
+    This class plans the C-MOVE requests of a batch before they are dispatched. Series-level requests
+    that cover all the series of a study, according to a C-FIND, are combined into a single
+    study-level request. A combined request keeps the ids of the requests it replaces (members), so
+    that the state of every row of the batch is still journaled individually.
+    """
+
+    def __init__(self, config, establish_association, limiter=None):
+        self.config = config
+        self.establish_association = establish_association
+        self.limiter = limiter
+        if config['request']['model'] == 'patient':
+            self.query_model = PatientRootQueryRetrieveInformationModelFind
+        else:
+            self.query_model = StudyRootQueryRetrieveInformationModelFind
+
+    def study_key(self, request, level='SERIES'):
+        """
+        Returns the study elements of a request at the given level that can be combined, None otherwise
+        """
+        elements = element_dict(request.elements)
+        if elements.pop('QueryRetrieveLevel', '').upper() != level:
+            return None
+        if level == 'SERIES':
+            series = elements.pop('SeriesInstanceUID', '')
+            if not series or '\\' in series:
+                return None
+        if not elements.get('StudyInstanceUID') or '\\' in elements['StudyInstanceUID']:
+            return None
+        if any(keyword not in STUDY_KEYWORDS for keyword in elements):
+            return None
+        return tuple(sorted(elements.items()))
+
+    def plan(self, requests):
+        """
+        Returns the requests to dispatch, in the order of the original requests
+        """
+        if self.config['request']['model'] == 'psonly':
+            # The patient/study only model has no series level
+            return requests
+
+        # Series already moved by a study-level request of the batch
+        studies = {}
+        for request in requests:
+            key = self.study_key(request, 'STUDY')
+            if key is not None:
+                studies.setdefault(key, request)
+
+        groups = {}
+        for request in requests:
+            key = self.study_key(request)
+            if key is not None:
+                groups.setdefault(key, []).append(request)
+
+        combined = {}
+        for key, group in groups.items():
+            if key in studies:
+                combined[key] = self.combine(key, group, studies[key])
+        candidates = {key: group for key, group in groups.items() if len(group) > 1 and key not in combined}
+        if candidates:
+            association = self.establish_association()
+            if association.is_established:
+                try:
+                    for key, group in candidates.items():
+                        requested = set(element_dict(x.elements)['SeriesInstanceUID'] for x in group)
+                        series = self.study_series(association, key)
+                        if series and series <= requested:
+                            combined[key] = self.combine(key, group)
+                finally:
+                    association.release()
+            else:
+                print('Association failed, series requests are sent without combining them')
+        if not combined:
+            return requests
+
+        planned = []
+        for request in requests:
+            key = self.study_key(request)
+            if key is None and self.study_key(request, 'STUDY') in combined:
+                key = self.study_key(request, 'STUDY')
+            if key in combined:
+                if combined[key] is not None:
+                    # The combined request takes the place of the first request of the study
+                    planned.append(combined[key])
+                    combined[key] = None
+            else:
+                planned.append(request)
+        print('Series requests combined, {} of {} requests to send'.format(len(planned), len(requests)))
+        return planned
+
+    def study_series(self, association, key):
+        """
+        Returns the SeriesInstanceUIDs of a study, None if the C-FIND failed
+        """
+        if self.limiter:
+            self.limiter.acquire_request()
+        identifier = Dataset()
+        for keyword, value in key:
+            identifier = ElementPath('{}={}'.format(keyword, value)).update(identifier)
+        identifier.QueryRetrieveLevel = 'SERIES'
+        identifier.SeriesInstanceUID = ''
+
+        series = set()
+        for (status, rsp_identifier) in association.send_c_find(identifier, self.query_model):
+            if 'Status' not in status or status.Status not in [0x0000, 0xFF00, 0xFF01]:
+                return None
+            if status.Status in [0xFF00, 0xFF01] and rsp_identifier and 'SeriesInstanceUID' in rsp_identifier:
+                series.add(str(rsp_identifier.SeriesInstanceUID))
+        return series
+
+    def combine(self, key, group, study=None):
+        """
+        Returns a study-level request replacing the series requests of a group, and the study-level
+        request of the batch if there is one
+        """
+        if study is not None:
+            elements = study.elements
+            group = [study] + group
+        else:
+            elements = ['{}={}'.format(keyword, value) for keyword, value in key] + ['QueryRetrieveLevel=STUDY']
+        return Request(elements, priority=max(x.priority for x in group), members=[x.id for x in group])
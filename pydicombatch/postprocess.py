@@ -0,0 +1,251 @@
+import os
+import re
+import time
+import signal
+import threading
+from queue import Queue
+from pydicom import dcmread
+from pydicom.tag import Tag
+from pynetdicom.apps.common import ElementPath
+from .anonymizer import Anonymizer
+from .tracking import TRACKING_KEYWORDS
+
+SOP_INSTANCE_UID = Tag(0x0008, 0x0018)
+TRACKING_TAGS = [ElementPath(x).tag for x in TRACKING_KEYWORDS]
+
+
+class OutputPathTemplate(object):
+    """ OutputPathTemplate class
+    The output directory_structure and filename compiled once into a list of tags. Path components are
+    sanitized, created directories are cached and files of different instances that would have the same
+    name (e.g. duplicate InstanceNumber in a study) are given a suffix instead of being overwritten.
+    """
+
+    def __init__(self, config):
+        self.directory = config['output']['directory']
+        components = [x for x in config['output']['directory_structure'].split('/') if x]
+        self.directory_tags = [ElementPath(x).tag for x in components]
+        self.filename_tag = ElementPath(config['output']['filename']).tag
+        self.tags = self.directory_tags + [self.filename_tag, SOP_INSTANCE_UID] + TRACKING_TAGS
+        self.fsync = bool(config['output'].get('fsync', False))
+        self.created_directories = set()
+
+    def sanitize(self, value):
+        value = re.sub(r'[\x00-\x1f<>:"/\\|?*]', '_', str(value)).strip().rstrip('.')
+        if value in ['', '.', '..']:
+            return 'UNKNOWN'
+        return value
+
+    def element_value(self, ds, tag):
+        if tag in ds and ds[tag].value is not None:
+            return ds[tag].value
+        return ''
+
+    def makedirs(self, filedir):
+        if filedir not in self.created_directories:
+            os.makedirs(filedir, exist_ok = True)
+            self.created_directories.add(filedir)
+
+    def move(self, tmp_filename, ds):
+        """
+        Move a file to its path in the output directory structure and return this path
+        """
+        sop_instance = str(self.element_value(ds, SOP_INSTANCE_UID))
+        filedir = os.path.join(self.directory, 
+            *[self.sanitize(self.element_value(ds, tag)) for tag in self.directory_tags])
+        name = self.element_value(ds, self.filename_tag)
+        name = self.sanitize(name if name != '' else sop_instance)
+        self.makedirs(filedir)
+
+        suffix = 0
+        while True:
+            filepath = os.path.join(filedir, name + ('_{}'.format(suffix) if suffix else '') + '.dcm')
+            try:
+                # Reserve the name, atomically across threads and processes
+                os.close(os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                if self.same_instance(filepath, sop_instance):
+                    # The same instance was received again
+                    break
+                suffix += 1
+        if self.fsync:
+            # The file is durable before its request can be journaled as completed
+            fd = os.open(tmp_filename, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        os.replace(tmp_filename, filepath)
+        return filepath
+
+    def same_instance(self, filepath, sop_instance):
+        try:
+            existing = dcmread(filepath, stop_before_pixels=True, specific_tags=[SOP_INSTANCE_UID])
+            return str(existing.SOPInstanceUID) == sop_instance
+        except Exception:
+            # Reserved by another worker and not written yet
+            return False
+
+
+class ReceptionBudget(object):
+    """ ReceptionBudget class
+    The number of files and bytes received and not post-processed yet, bounded by max_files and
+    max_bytes. With a multiprocessing context, the budget is shared with the listener processes of
+    the storage SCP.
+    """
+
+    def __init__(self, max_files=0, max_bytes=0, context=None):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        if context is None:
+            self.pending = [0, 0]
+            self.condition = threading.Condition()
+        else:
+            self.pending = context.RawArray('q', 2)
+            self.condition = context.Condition()
+
+    def within_budget(self, size):
+        if self.pending[0] == 0:
+            # A single file larger than the budget is always accepted
+            return True
+        if self.max_files and self.pending[0] + 1 > self.max_files:
+            return False
+        if self.max_bytes and self.pending[1] + size > self.max_bytes:
+            return False
+        return True
+
+    def reserve(self, size, timeout=None):
+        """
+        Wait until a file of the given size fits in the budget. Returns False after the timeout
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.within_budget(size), timeout):
+                return False
+            self.pending[0] += 1
+            self.pending[1] += size
+            return True
+
+    def release(self, size):
+        with self.condition:
+            self.pending[0] -= 1
+            self.pending[1] -= size
+            self.condition.notify_all()
+
+
+class PostProcessingQueue(Queue):
+    """ PostProcessingQueue class
+    A queue of received file paths bounded by a number of files and a number of bytes. The budget of a
+    file is reserved by the C-STORE handler before the file is written and released once it has been
+    post-processed, so that reception slows down when the post-processing cannot keep up.
+    """
+
+    def __init__(self, max_files=0, max_bytes=0, context=None):
+        super().__init__()
+        self.budget = ReceptionBudget(max_files, max_bytes, context)
+
+    def reserve(self, size, timeout=None):
+        return self.budget.reserve(size, timeout)
+
+    def release(self, size):
+        self.budget.release(size)
+
+
+class PostProcessor(object):
+    """ PostProcessor class
+    This class applies the post-processing of a received file (anonymization, decompression) and moves
+    it to the output directory structure. It only needs the path of the file, so that it can run in
+    the SCP worker threads or in separate processes.
+    """
+
+    def __init__(self, config, anonymization_enabled):
+        self.config = config
+        self.anonymization_enabled = anonymization_enabled
+        self.anonymizer = self.create_anonymizer()
+        self.output_path = OutputPathTemplate(config)
+
+    def anon_engine(self):
+        """
+        Returns the anonymization engine: 'dat' (RSNA DICOM Anonymizer JAR) or 'native' (in-process)
+        """
+        return str(self.config['anonymization'].get('engine', 'dat')).lower()
+
+    def create_anonymizer(self):
+        """
+        Return the in-process anonymizer if the native engine is used, None otherwise
+        """
+        if not self.anonymization_enabled or self.anon_engine() != 'native':
+            return None
+        anon_lut = self.config['anonymization']['lookup_table']
+        if not os.path.isfile(anon_lut):
+            anon_lut = None
+        return Anonymizer(self.config['anonymization']['script'], anon_lut)
+
+    def anon_cmd(self, file):
+        return 'cd ./DicomAnonymizerTool && java -jar DAT.jar -da {anon_script} -lut {anon_lut} -in {file} -out {file}  >/dev/null 2>&1'.format(
+            file = file,
+            anon_script = self.config['anonymization']['script'],
+            anon_lut = self.config['anonymization']['lookup_table'])
+
+    def tracking_uids(self, ds):
+        """
+        Returns the original identifiers used to correlate the file to its C-MOVE request
+        """
+        return {keyword: str(ds[keyword].value) for keyword in TRACKING_KEYWORDS if keyword in ds}
+
+    def process_file(self, tmp_filename):
+        """
+        Post-process a file of the temporary directory and returns its path in the output directory,
+        its original identifiers and the time in seconds spent in each stage
+        """
+        timings = {}
+        time_start = time.perf_counter()
+        if self.anonymizer or self.config['output']['decompress']:
+            ds = dcmread(tmp_filename)
+        else:
+            # Only read the elements needed for the output path
+            ds = dcmread(tmp_filename, stop_before_pixels=True, specific_tags=self.output_path.tags)
+        uids = self.tracking_uids(ds)
+        timings['read'] = time.perf_counter() - time_start
+        modified = False
+        # Anonymize file if enabled
+        if self.anonymization_enabled:
+            time_start = time.perf_counter()
+            if self.anonymizer:
+                self.anonymizer.anonymize(ds)
+                modified = True
+            else:
+                os.system(self.anon_cmd(tmp_filename))
+                if self.config['output']['decompress']:
+                    ds = dcmread(tmp_filename)
+                else:
+                    # The file is not modified further, only read the elements needed for the output path
+                    ds = dcmread(tmp_filename, stop_before_pixels=True, specific_tags=self.output_path.tags)
+            timings['anonymization'] = time.perf_counter() - time_start
+        # Apply decompression if enabled
+        if self.config['output']['decompress']:
+            time_start = time.perf_counter()
+            ds.decompress()
+            modified = True
+            timings['decompression'] = time.perf_counter() - time_start
+        if modified:
+            time_start = time.perf_counter()
+            ds.save_as(tmp_filename, write_like_original=False)
+            timings['save'] = time.perf_counter() - time_start
+        # Move file to desired directory_structure
+        time_start = time.perf_counter()
+        filepath = self.output_path.move(tmp_filename, ds)
+        timings['move'] = time.perf_counter() - time_start
+        return filepath, uids, timings
+
+# Post-processor of a worker process, created once by the process pool initializer
+worker_postprocessor = None
+
+def init_postprocess_worker(config, anonymization_enabled):
+    global worker_postprocessor
+    # CTRL-C is handled by the main process, which drains the queue before stopping the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker_postprocessor = PostProcessor(config, anonymization_enabled)
+
+def postprocess_worker(tmp_filename):
+    return worker_postprocessor.process_file(tmp_filename)
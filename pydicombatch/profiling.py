@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import random
+import cProfile
+import threading
+
+
+def profiling_file(config, option, default, suffix=None):
+    """
+    Returns the path of a profiling output, with a suffix for the files of a listener process
+    """
+    options = config.get('profiling') or {}
+    filepath = options.get(option, os.path.join(config['output']['directory'], default))
+    if suffix is None:
+        return filepath
+    root, ext = os.path.splitext(filepath)
+    return '{}-{}{}'.format(root, suffix, ext)
+
+
+class NullSpan(object):
+    """ NullSpan class
+    The span returned when profiling is disabled, entering and leaving it does nothing
+    """
+    sampled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add_stages(self, timings):
+        pass
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    """ Span class
+    A timed section of a thread. Whether a span is recorded is decided by the outermost span of the
+    thread, so that the spans of a sampled request or file are all recorded.
+    """
+    __slots__ = ['profiler', 'name', 'args', 'start', 'sampled']
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+        self.start = 0.0
+        self.sampled = False
+
+    def __enter__(self):
+        local = self.profiler.local
+        depth = getattr(local, 'depth', 0)
+        if depth == 0:
+            local.sampled = random.random() < self.profiler.sample_rate
+            local.profiling = local.sampled and self.profiler.cprofile and self.profiler.enable_profile()
+        local.depth = depth + 1
+        self.sampled = local.sampled
+        if self.sampled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        local = self.profiler.local
+        local.depth -= 1
+        if self.sampled:
+            if exc_type is not None:
+                self.args['error'] = exc_type.__name__
+            self.profiler.record(self.name, self.start, time.perf_counter() - self.start, self.args)
+            if local.depth == 0 and local.profiling:
+                self.profiler.thread_profile().disable()
+        return False
+
+    def add_stages(self, timings):
+        """
+        Record the stages of a post-processed file, measured in seconds by the post-processor, as
+        consecutive spans from the start of this span
+        """
+        if not self.sampled:
+            return
+        start = self.start
+        for stage, seconds in timings.items():
+            self.profiler.record(stage, start, seconds, {})
+            start += seconds
+
+
+class Profiler(object):
+    """ Profiler class
+    This class records timed spans around the requests of the SCU and the instances of the storage
+    SCP, and writes them as a Chrome trace (trace_file, opened with chrome://tracing or Perfetto).
+    Only sample_rate of the requests and files are recorded. With cprofile, the sampled spans are
+    also profiled with cProfile, one profile per thread written to cprofile_directory. Since Python
+    3.12 only one profile can be active at a time and it records all the threads, so the spans
+    sampled while the profile of another thread is active are not profiled. When profiling is
+    disabled, span() returns a shared span that does nothing.
+    """
+
+    def __init__(self, config=None, suffix=None):
+        options = (config or {}).get('profiling') or {}
+        self.enabled = bool(options.get('enabled', False))
+        self.sample_rate = float(options.get('sample_rate', 0.01))
+        self.cprofile = self.enabled and bool(options.get('cprofile', False))
+        # Spans past this number are dropped, the trace is kept in memory until the end
+        self.max_events = int(options.get('max_events', 1000000))
+        if self.enabled:
+            self.trace_file = profiling_file(config, 'trace_file', 'trace.json', suffix)
+            self.cprofile_directory = profiling_file(config, 'cprofile_directory', 'cprofile', suffix)
+        self.suffix = suffix
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.events = []
+        self.dropped = 0
+        self.thread_names = {}
+        self.profiles = {}
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def record(self, name, start, duration, args):
+        thread = threading.current_thread()
+        event = {'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6,
+            'pid': os.getpid(), 'tid': thread.ident}
+        if args:
+            event['args'] = {key: str(value) for key, value in args.items()}
+        with self.lock:
+            if len(self.events) >= self.max_events:
+                self.dropped += 1
+                return
+            self.events.append(event)
+            self.thread_names[thread.ident] = thread.name
+
+    def thread_profile(self):
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            profile = cProfile.Profile()
+            self.local.profile = profile
+            thread = threading.current_thread()
+            with self.lock:
+                self.profiles[(thread.name, thread.ident)] = profile
+        return profile
+
+    def enable_profile(self):
+        """
+        Enable the profile of the current thread, returns False if another profile is active
+        """
+        try:
+            self.thread_profile().enable()
+        except ValueError:
+            # Another profiling tool is already active (Python 3.12 and later)
+            return False
+        return True
+
+    def stop(self):
+        """
+        Write the trace and the cProfile dumps
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            events = list(self.events)
+            thread_names = dict(self.thread_names)
+            profiles = dict(self.profiles)
+        pid = os.getpid()
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+            'args': {'name': 'pydicombatch' if self.suffix is None else 'pydicombatch {}'.format(self.suffix)}}]
+        metadata += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+            for tid, name in thread_names.items()]
+        os.makedirs(os.path.dirname(os.path.abspath(self.trace_file)), exist_ok=True)
+        tmp_filepath = self.trace_file + '.tmp'
+        with open(tmp_filepath, 'w') as file:
+            json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms',
+                'otherData': {'sample_rate': self.sample_rate, 'dropped_events': self.dropped}}, file)
+        os.replace(tmp_filepath, self.trace_file)
+        if self.dropped:
+            print('Profiling: {} spans dropped past max_events'.format(self.dropped))
+        if profiles:
+            os.makedirs(self.cprofile_directory, exist_ok=True)
+        for (name, ident), profile in profiles.items():
+            try:
+                profile.dump_stats(os.path.join(self.cprofile_directory, '{}-{}.prof'.format(name, ident)))
+            except Exception as exc:
+                # The thread is still in a sampled span
+                print('Writing the profile of thread {} failed: {}'.format(name, exc))
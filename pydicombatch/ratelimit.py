@@ -0,0 +1,106 @@
+import time
+import threading
+
+
+class TokenBucket(object):
+    """ TokenBucket class
+    A thread-safe token bucket. Tokens can be borrowed, in which case the caller sleeps until the
+    debt is repaid, so that an amount larger than the bucket (e.g. a large instance) never blocks forever.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst) if burst else max(self.rate, 1.0)
+        self.tokens = self.burst
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        # Called with the lock held
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.refill()
+            self.rate = float(rate)
+
+    def consume(self, amount=1.0):
+        with self.lock:
+            self.refill()
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RateLimiter(object):
+    """ RateLimiter class
+    This class enforces a process-wide ceiling on the request rate (requests/s) sent by all the SCU
+    workers and on the data rate (MB/s) received by the storage SCP. In adaptive mode, the request
+    rate is decreased multiplicatively when the latency or the failure statuses of the PACS increase
+    and increased additively while it responds normally (AIMD).
+    """
+
+    def __init__(self, config):
+        options = config.get('rate_limit') or {}
+        self.max_rate = options.get('requests_per_second')
+        self.request_bucket = TokenBucket(self.max_rate, options.get('burst')) if self.max_rate else None
+        megabytes_per_second = options.get('megabytes_per_second')
+        self.byte_bucket = TokenBucket(megabytes_per_second * 1e6) if megabytes_per_second else None
+
+        self.adaptive = bool(options.get('adaptive', False)) and self.request_bucket is not None
+        self.min_rate = float(options.get('min_requests_per_second', 0.1))
+        self.increase_step = float(options.get('increase_step', 0.1))
+        self.decrease_factor = float(options.get('decrease_factor', 0.5))
+        self.latency_threshold = options.get('latency_threshold')
+        self.latency_factor = float(options.get('latency_factor', 2.0))
+        self.rate = float(self.max_rate) if self.max_rate else None
+        self.latency = None
+        self.best_latency = None
+        self.last_decrease = 0
+        self.lock = threading.Lock()
+
+    def acquire_request(self):
+        if self.request_bucket:
+            self.request_bucket.consume(1)
+
+    def acquire_bytes(self, size):
+        if self.byte_bucket:
+            self.byte_bucket.consume(size)
+
+    def is_congested(self, status):
+        """
+        Returns True for failure statuses that indicate the PACS is overloaded:
+        0xA7xx (out of resources) and 0xC0xx (unable to process)
+        """
+        return status is None or (status >> 8) in [0xA7, 0xC0]
+
+    def record(self, latency, status):
+        """
+        Record the latency (in seconds) and final status of a request, status is None if the
+        association was lost. The latency is the time until the first response of the PACS, which
+        does not depend on the number of matches of a C-FIND or the size of a C-MOVE.
+        """
+        if not self.adaptive:
+            return
+
+        with self.lock:
+            # Exponentially weighted moving average of the latency
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            if self.best_latency is None or self.latency < self.best_latency:
+                self.best_latency = self.latency
+
+            threshold = self.latency_threshold or self.latency_factor * self.best_latency
+            now = time.monotonic()
+            if self.is_congested(status) or self.latency > threshold:
+                # At most one decrease per second, the requests in flight report the same congestion
+                if now - self.last_decrease >= 1.0:
+                    self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                    self.last_decrease = now
+            else:
+                self.rate = min(float(self.max_rate), self.rate + self.increase_step)
+            rate = self.rate
+
+        self.request_bucket.set_rate(rate)
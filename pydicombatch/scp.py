@@ -1,15 +1,24 @@
 import os
 import sys
+import copy
 import uuid
 import time
+import signal
+import itertools
+import multiprocessing
 from queue import Queue
-from threading import Thread
+from threading import Thread, Lock
 import tqdm
 from pydicom import dcmread
 from pydicom.dataset import Dataset
+from pydicom.filewriter import write_file_meta_info
 from pynetdicom.apps.common import ElementPath
 import inquirer
 import shutil
+import concurrent.futures
+from .postprocess import PostProcessor, PostProcessingQueue, init_postprocess_worker, postprocess_worker
+from .ratelimit import RateLimiter
+from .profiling import Profiler
 
 from pydicom.uid import (
     ExplicitVRLittleEndian,
@@ -37,80 +46,109 @@ from pynetdicom.sop_class import (
 )
 
 
-class SCP(object):
-    """ SCP class
-    This class is used to run a local SCP (server) that handles DIMSE requests (c-store, c-echo)
+def indexed_aet(aet, index):
+    """
+    Returns an AE title followed by an index, the title is shortened to keep at most 16 characters
+    """
+    suffix = str(index)
+    return aet[:16 - len(suffix)] + suffix
+
+def listener_addresses(config):
+    """
+    Returns the (AE title, port) of the storage SCP listeners. local.listeners is either a number of
+    listeners, on the ports following local.port with the local AE title followed by their index, or
+    a list of aet / port pairs.
+    """
+    listeners = config['local'].get('listeners') or 1
+    if isinstance(listeners, list):
+        addresses = [(str(x['aet']), int(x['port'])) for x in listeners]
+    else:
+        aet = config['local']['aet']
+        port = int(config['local']['port'])
+        addresses = [(aet, port)] + [(indexed_aet(aet, i), port + i) for i in range(1, int(listeners))]
+    aets = [aet for aet, port in addresses]
+    if len(set(aets)) != len(aets):
+        # The C-MOVE requests would all be sent to the same listener
+        raise ValueError('The storage SCP listeners must have different AE titles: {}'.format(', '.join(aets)))
+    return addresses
+
+
+class ListenerQueue(object):
+    """ ListenerQueue class
+    The post-processing queue as seen from a listener process: the budget is shared with the storage
+    SCP and the received files are sent to it
     """
 
-    def __init__(self, config):
+    def __init__(self, budget, received):
+        self.budget = budget
+        self.received = received
+
+    def reserve(self, size, timeout=None):
+        return self.budget.reserve(size, timeout)
+
+    def release(self, size):
+        self.budget.release(size)
+
+    def put(self, item):
+        self.received.put(item)
+
+
+def run_listener(config, aet, port, budget, received, ready, stopped):
+    """
+    Receives instances on a storage SCP listener until the storage SCP is stopped
+    """
+    # CTRL-C is handled by the main process, which stops the listeners
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    config = copy.deepcopy(config)
+    options = config.get('rate_limit') or {}
+    if options.get('megabytes_per_second'):
+        # Each listener receives its share of the data rate
+        options['megabytes_per_second'] = float(options['megabytes_per_second']) / len(listener_addresses(config))
+    listener = StorageListener(config, RateLimiter(config), ListenerQueue(budget, received))
+    # Each listener process writes its own trace
+    listener.profiler = Profiler(config, suffix=aet)
+    handlers = [(evt.EVT_C_STORE, listener.handle_store), (evt.EVT_C_ECHO, listener.handle_echo)]
+    server = listener.create_ae(aet).start_server(('', port), block=False, evt_handlers=handlers)
+    ready.release()
+    stopped.wait()
+    server.shutdown()
+    listener.profiler.stop()
+    # No file is received after this one
+    received.put(None)
+
+
+class StorageListener(object):
+    """ StorageListener class
+    The C-STORE reception of the storage SCP: received datasets are written to the temporary directory
+    and queued for post-processing, within the budget of the post-processing queue. With several
+    listeners, each one runs in its own process and sends the paths of the files it received to the
+    storage SCP.
+    """
+
+    def __init__(self, config, limiter, writing_queue):
         self.config = config
-        self.anonymization_enabled = self.check_anon_engine()
-        self.ae = self.create_ae() 
-        self.scp = None
-        self.writing_queue = Queue()
-        self.start_file_writing_workers()
+        self.limiter = limiter
+        self.writing_queue = writing_queue
+        self.raw_store = self.check_raw_store()
+        # Temporary directory of the files received prior to anonymization
+        self.temp_dir = config['output'].get('tmp_directory', os.path.join(config['output']['directory'], 'tmp'))
+        self.queue_timeout = float(config['output'].get('queue_timeout', 60))
         self.file_count = 0
-        self.time_start =  time.time()
+        # C-STORE requests are handled by several threads
+        self.count_lock = Lock()
+        # Timing spans of the received instances, disabled unless set by the requests batch
+        self.profiler = Profiler()
 
-    def check_anon_engine(self):
+    def check_raw_store(self):
         """
-        Return True if anonymization is enabled and script / look up table file exist
+        Return True if received datasets are written as received, without decoding and re-encoding
+        them. The post-processing reads the files from disk in any case.
         """
-        if (self.config['anonymization'] and self.config['anonymization']['enabled']):
-            # Anonymization enabled
-            # Ensure that RSNA DICOM Anonymizer is found
-            if not os.path.isfile('./DicomAnonymizerTool/DAT.jar'):
-                questions = [
-                inquirer.List('anon_files',
-                                message="RSNA DICOM Anonymizer JAR file not found. Do you still want to proceed?",
-                                choices=['Continue without anonymization', 'Exit'],
-                            ),
-                ]
-                answers = inquirer.prompt(questions)
-                if answers['anon_files'] == 'Exit':
-                    sys.exit()
-                else:
-                    print('Anonymization DISABLED')
-                    return False
+        return bool(self.config['output'].get('raw_store', True))
 
-            # Ensure that anonymization scripts are found
-            anon_script = self.config['anonymization']['script']
-            anon_lut = self.config['anonymization']['lookup_table']
-            if not os.path.isfile(anon_script):
-                questions = [
-                inquirer.List('anon_files',
-                                message="Anonymization script not found. Do you still want to proceed?",
-                                choices=['Continue without anonymization', 'Exit'],
-                            ),
-                ]
-                answers = inquirer.prompt(questions)
-                if answers['anon_files'] == 'Exit':
-                    sys.exit()
-                else:
-                    print('Anonymization DISABLED')
-                    return False
-            
-            if not os.path.isfile(anon_lut):
-                questions = [
-                inquirer.List('anon_files',
-                                message="Anonymization look up table not found. Do you still want to proceed?",
-                                choices=['Continue without look up table', 'Exit'],
-                            ),
-                ]
-                answers = inquirer.prompt(questions)
-                if answers['anon_files'] == 'Exit':
-                    sys.exit()
-
-            print('Anonymization ENABLED')    
-            return True
-        else:
-            print('Anonymization DISABLED')
-            return False
-
-
-    def create_ae(self):
+    def create_ae(self, aet):
         # Create application entity
-        ae = AE(ae_title=self.config['local']['aet'])
+        ae = AE(ae_title=aet)
 
         # Set timeouts
         ae.acse_timeout = 300
@@ -129,73 +167,6 @@ class SCP(object):
 
         return ae
     
-    def anon_cmd(self, file):
-        return 'cd ./DicomAnonymizerTool && java -jar DAT.jar -da {anon_script} -lut {anon_lut} -in {file} -out {file}  >/dev/null 2>&1'.format(
-            file = file, 
-            anon_script = self.config['anonymization']['script'],
-            anon_lut = self.config['anonymization']['lookup_table'])
-
-    def write_file(self, i, q):
-        while True:
-            tmp_filename, tmp_ds = q.get()
-            # Anonymize file if enabled
-            if self.anonymization_enabled:
-                os.system(self.anon_cmd(tmp_filename))
-                ds = dcmread(tmp_filename)
-            else:
-                ds = tmp_ds
-            # Apply decompression if enabled
-            if self.config['output']['decompress']:
-                ds.decompress()
-                ds.save_as(tmp_filename, write_like_original=False)
-            # Move file to desired directory_structure 
-            dir_structure = self.config['output']['directory_structure'].split('/')
-            dir_structure = [str(ds[ElementPath(x).tag].value) for x in dir_structure if x]
-            filename = str(ds[ElementPath(self.config['output']['filename']).tag].value) + '.dcm'
-            filedir = os.path.join(self.config['output']['directory'], *dir_structure)
-            filepath = os.path.join(filedir, filename)
-            os.makedirs(filedir, exist_ok = True)
-            shutil.move(tmp_filename, filepath)
-            q.task_done()
-
-    def start_file_writing_workers(self):
-        self.file_writing_workers = []
-        for i in range(self.config['request']['threads']):
-            worker = Thread(target=self.write_file, args=(i,self.writing_queue,))
-            worker.setDaemon(True)
-            worker.start()
-            self.file_writing_workers.append(worker)
-
-    def start_server(self):
-        print('Starting local storage SCP server on port {}'.format(self.config['local']['port']))
-        # Create a temporary directory to store files prior to anonymization
-        temp_dir = os.path.join(self.config['output']['directory'],'tmp')
-        os.makedirs(temp_dir, exist_ok = True)
-        handlers = [(evt.EVT_C_STORE, self.handle_store), (evt.EVT_C_ECHO, self.handle_echo)]
-        self.scp = self.ae.start_server(('', self.config['local']['port']), block=False, evt_handlers=handlers)
-
-    def stop_server(self):
-        old_qsize = self.writing_queue.qsize()
-        pbar = tqdm.tqdm(total=old_qsize, 
-            desc='Post-processing ', 
-            unit='files')
-        while self.writing_queue.qsize():
-            qsize = self.writing_queue.qsize()
-            pbar.update(old_qsize-qsize)
-            old_qsize = qsize
-            time.sleep(0.1)
-        pbar.update(old_qsize-self.writing_queue.qsize())
-        pbar.close()    
-        self.writing_queue.join()
-        time_elapsed = time. time() - self.time_start
-        print('Stopping local storage SCP server: {} files transferred in {:.1f} seconds ({:.2f} files/s)'.format(self.file_count, time_elapsed, self.file_count/time_elapsed))
-        self.scp.shutdown()
-        temp_dir = os.path.join(self.config['output']['directory'],'tmp')
-        # Remove temporary directory if empty
-        if not os.listdir(temp_dir):
-            shutil.rmtree(temp_dir)
-
-
     def handle_echo(self, event):
         """Respond to a C-ECHO service request.
         
@@ -234,6 +205,44 @@ class SCP(object):
             ``StorageServiceClass`` implementation for the available statuses
         """
 
+        size = event.request.DataSet.getbuffer().nbytes
+        with self.profiler.span('handle_store', size=size):
+            if self.limiter:
+                # Received data counts against the MB/s ceiling, delaying the response slows down the sender
+                with self.profiler.span('rate_limit'):
+                    self.limiter.acquire_bytes(size)
+
+            # Wait for the post-processing to catch up, or ask the sender to re-try later
+            with self.profiler.span('reserve_queue'):
+                reserved = self.writing_queue.reserve(size, self.queue_timeout)
+            if not reserved:
+                print('Post-processing queue full, refusing instance')
+                self.file_refused()
+                return 0xA700
+
+            status_ds = Dataset()
+            with self.profiler.span('store_raw' if self.raw_store else 'store_decoded'):
+                status, filename = self.store_raw(event) if self.raw_store else self.store_decoded(event)
+            status_ds.Status = status
+            if status == 0x0000:
+                self.file_received(size)
+                self.writing_queue.put((filename, size))
+            else:
+                self.writing_queue.release(size)
+            return status_ds
+
+    def file_received(self, size):
+        with self.count_lock:
+            self.file_count += 1
+
+    def file_refused(self):
+        pass
+
+    def store_decoded(self, event):
+        """
+        Decode the dataset of a C-STORE request and write it with new file meta information.
+        Returns the status and the temporary file name.
+        """
         
         mode_prefixes = {'CT Image Storage' : 'CT',
             'Enhanced CT Image Storage' : 'CTE',
@@ -259,7 +268,7 @@ class SCP(object):
             sop_instance = ds.SOPInstanceUID
         except Exception as exc:
             # Unable to decode dataset
-            return 0xC210
+            return 0xC210, None
 
         try:
             # Get the elements we need
@@ -267,7 +276,7 @@ class SCP(object):
         except KeyError:
             mode_prefix = 'UN'
 
-        filename = os.path.join(self.config['output']['directory'],'tmp/{0!s}.dcm'.format(uuid.uuid4()))
+        filename = os.path.join(self.temp_dir, '{0!s}.dcm'.format(uuid.uuid4()))
 
         # Presentation context
         cx = event.context
@@ -283,19 +292,295 @@ class SCP(object):
         ds.is_little_endian = cx.transfer_syntax.is_little_endian
         ds.is_implicit_VR = cx.transfer_syntax.is_implicit_VR
 
-        status_ds = Dataset()
-        
         try:
             ds.save_as(filename, write_like_original=False)
-            self.file_count += 1
-            self.writing_queue.put((filename, ds))
-            status_ds.Status = 0x0000 # Success
+            return 0x0000, filename # Success
+        except IOError:
+            # Failed - Out of Resources - IOError
+            return 0xA700, None
+        except:
+            # Failed - Out of Resources - Miscellaneous error
+            return 0xA701, None
+
+    def store_raw(self, event):
+        """
+        Write the preamble, the file meta information and the encoded dataset of a C-STORE request 
+        as received, without decoding and re-encoding the dataset. Returns the status and the 
+        temporary file name.
+        """
+        filename = os.path.join(self.temp_dir, '{0!s}.dcm'.format(uuid.uuid4()))
+
+        meta = Dataset()
+        meta.MediaStorageSOPClassUID = event.request.AffectedSOPClassUID
+        meta.MediaStorageSOPInstanceUID = event.request.AffectedSOPInstanceUID
+        meta.TransferSyntaxUID = event.context.transfer_syntax
+
+        try:
+            with open(filename, 'wb') as fp:
+                fp.write(b'\x00' * 128)
+                fp.write(b'DICM')
+                write_file_meta_info(fp, meta, enforce_standard=True)
+                fp.write(event.request.DataSet.getbuffer())
+            return 0x0000, filename # Success
         except IOError:
             # Failed - Out of Resources - IOError
-            status_ds.Status = 0xA700
+            return 0xA700, None
         except:
             # Failed - Out of Resources - Miscellaneous error
-            status_ds.Status = 0xA701
+            return 0xA701, None
 
 
-        return status_ds
\ No newline at end of file
+class SCP(StorageListener):
+    """ SCP class
+    This class is used to run a local SCP (server) that handles DIMSE requests (c-store, c-echo)
+    """
+
+    def __init__(self, config, limiter=None):
+        self.config = config
+        # Set by the C-MOVE requests batch, correlates written files to their request
+        self.tracker = None
+        # Set by the requests batch, records the instances written to the output directory
+        self.manifest = None
+        self.metrics = None
+        self.pbar = None
+        self.anonymization_enabled = self.check_anon_engine()
+        self.postprocessor = PostProcessor(config, self.anonymization_enabled)
+        self.postprocess_pool = None
+        # Storage SCP listeners, the instances are received in other processes if there are several
+        self.listeners = listener_addresses(config)
+        self.context = multiprocessing.get_context('spawn') if len(self.listeners) > 1 else None
+        self.listener_processes = []
+        self.destinations = itertools.cycle([aet for aet, port in self.listeners])
+        self.destination_lock = Lock()
+        writing_queue = PostProcessingQueue(
+            int(config['output'].get('queue_max_files', 0)),
+            int(float(config['output'].get('queue_max_megabytes', 2048)) * 1e6),
+            self.context)
+        super().__init__(config, limiter, writing_queue)
+        self.ae = self.create_ae(config['local']['aet'])
+        self.scp = None
+        self.started = False
+        self.start_file_writing_workers()
+        self.time_start =  time.time()
+
+    def check_anon_engine(self):
+        """
+        Return True if anonymization is enabled and script / look up table file exist
+        """
+        if (self.config['anonymization'] and self.config['anonymization']['enabled']):
+            # Anonymization enabled
+            # Ensure that RSNA DICOM Anonymizer is found
+            if self.config['anonymization'].get('engine', 'dat') == 'dat' and not os.path.isfile('./DicomAnonymizerTool/DAT.jar'):
+                questions = [
+                inquirer.List('anon_files',
+                                message="RSNA DICOM Anonymizer JAR file not found. Do you still want to proceed?",
+                                choices=['Continue without anonymization', 'Exit'],
+                            ),
+                ]
+                answers = inquirer.prompt(questions)
+                if answers['anon_files'] == 'Exit':
+                    sys.exit()
+                else:
+                    print('Anonymization DISABLED')
+                    return False
+
+            # Ensure that anonymization scripts are found
+            anon_script = self.config['anonymization']['script']
+            anon_lut = self.config['anonymization']['lookup_table']
+            if not os.path.isfile(anon_script):
+                questions = [
+                inquirer.List('anon_files',
+                                message="Anonymization script not found. Do you still want to proceed?",
+                                choices=['Continue without anonymization', 'Exit'],
+                            ),
+                ]
+                answers = inquirer.prompt(questions)
+                if answers['anon_files'] == 'Exit':
+                    sys.exit()
+                else:
+                    print('Anonymization DISABLED')
+                    return False
+            
+            if not os.path.isfile(anon_lut):
+                questions = [
+                inquirer.List('anon_files',
+                                message="Anonymization look up table not found. Do you still want to proceed?",
+                                choices=['Continue without look up table', 'Exit'],
+                            ),
+                ]
+                answers = inquirer.prompt(questions)
+                if answers['anon_files'] == 'Exit':
+                    sys.exit()
+
+            print('Anonymization ENABLED')    
+            return True
+        else:
+            print('Anonymization DISABLED')
+            return False
+
+
+    def postprocess_mode(self):
+        """
+        Returns where received files are post-processed: 'thread' or 'process'
+        """
+        return str(self.config['output'].get('postprocess_mode', 'thread')).lower()
+
+    def write_file(self, i, q):
+        while True:
+            tmp_filename, size = q.get()
+            try:
+                with self.profiler.span('write_file', size=size) as span:
+                    if self.postprocess_pool:
+                        # Each worker thread feeds one process with file paths
+                        filepath, uids, timings = self.postprocess_pool.submit(postprocess_worker, tmp_filename).result()
+                    else:
+                        filepath, uids, timings = self.postprocessor.process_file(tmp_filename)
+                    # The stages are timed by the post-processor, possibly in another process
+                    span.add_stages(timings)
+                if self.metrics:
+                    for stage, seconds in timings.items():
+                        self.metrics.observe('postprocess_seconds', seconds, stage=stage)
+                    self.metrics.inc('postprocessed_instances_total')
+                if self.manifest:
+                    self.manifest.add(uids, filepath)
+                if self.tracker:
+                    self.tracker.instance_written(uids)
+            except Exception as exc:
+                # The file is left in the temporary directory, its request will not be completed
+                print('Post-processing failed for {}: {}'.format(tmp_filename, exc))
+                if self.metrics:
+                    self.metrics.inc('postprocess_failures_total')
+            finally:
+                q.release(size)
+                q.task_done()
+                if self.pbar:
+                    self.pbar.update(1)
+
+    def start_file_writing_workers(self):
+        if self.postprocess_mode() == 'process':
+            workers = int(self.config['output'].get('postprocess_workers', os.cpu_count()))
+            # Spawned rather than forked: the workers start on the first file, while the server, writer
+            # and SCU threads run and may hold locks that a forked child would never see released
+            self.postprocess_pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_postprocess_worker, initargs=(self.config, self.anonymization_enabled))
+        else:
+            workers = int(self.config['output'].get('postprocess_workers', self.config['request']['threads']))
+        self.file_writing_workers = []
+        for i in range(workers):
+            worker = Thread(target=self.write_file, args=(i,self.writing_queue,))
+            worker.setDaemon(True)
+            worker.start()
+            self.file_writing_workers.append(worker)
+
+    def start_server(self, listen=True):
+        """
+        Start receiving files. With listen=False, no server is started and the files are received
+        by handle_store on the associations of the SCU (C-GET).
+        """
+        # Create a temporary directory to store files prior to anonymization
+        os.makedirs(self.temp_dir, exist_ok = True)
+        self.started = True
+        if listen and self.context:
+            self.start_listeners()
+        elif listen:
+            print('Starting local storage SCP server on port {}'.format(self.config['local']['port']))
+            handlers = [(evt.EVT_C_STORE, self.handle_store), (evt.EVT_C_ECHO, self.handle_echo)]
+            self.scp = self.ae.start_server(('', self.config['local']['port']), block=False, evt_handlers=handlers)
+
+    def start_listeners(self):
+        print('Starting {} local storage SCP listeners on ports {}'.format(len(self.listeners),
+            ', '.join(str(port) for aet, port in self.listeners)))
+        self.received = self.context.Queue()
+        self.listeners_stopped = self.context.Event()
+        ready = self.context.Semaphore(0)
+        for aet, port in self.listeners:
+            process = self.context.Process(target=run_listener, args=(self.config, aet, port,
+                self.writing_queue.budget, self.received, ready, self.listeners_stopped))
+            process.start()
+            self.listener_processes.append(process)
+        # C-MOVE requests are sent once all the listeners accept associations
+        for process in self.listener_processes:
+            while not ready.acquire(timeout=1.0):
+                if not all(x.is_alive() for x in self.listener_processes):
+                    self.listeners_stopped.set()
+                    raise RuntimeError('A local storage SCP listener failed to start')
+        self.receiving_thread = Thread(target=self.receive_files)
+        self.receiving_thread.daemon = True
+        self.receiving_thread.start()
+
+    def receive_files(self):
+        """
+        Queue the files received by the listeners for post-processing, until all of them stopped
+        """
+        running = len(self.listener_processes)
+        while running:
+            item = self.received.get()
+            if item is None:
+                running -= 1
+                continue
+            self.file_received(item[1])
+            self.writing_queue.put(item)
+
+    def stop_listeners(self):
+        self.listeners_stopped.set()
+        for process in self.listener_processes:
+            process.join()
+        self.receiving_thread.join()
+        self.listener_processes = []
+
+    def file_received(self, size):
+        super().file_received(size)
+        if self.metrics:
+            self.metrics.inc('received_instances_total')
+            self.metrics.inc('received_bytes_total', size)
+
+    def file_refused(self):
+        if self.metrics:
+            self.metrics.inc('refused_instances_total')
+
+    def register_metrics(self, metrics):
+        """
+        Report the metrics of the storage SCP and of its post-processing queue
+        """
+        self.metrics = metrics
+        metrics.gauge('postprocess_queue_files', self.writing_queue.qsize)
+        metrics.gauge('postprocess_queue_bytes', lambda: self.writing_queue.budget.pending[1])
+
+    def next_destination(self):
+        """
+        Returns the AE title of the listener that receives the instances of the next C-MOVE request
+        """
+        with self.destination_lock:
+            return next(self.destinations)
+
+    def stop_server(self):
+        if not self.started:
+            # Not started or already stopped
+            return
+        self.started = False
+        if self.listener_processes:
+            # The files received by the listeners are queued before waiting for the post-processing
+            self.stop_listeners()
+        # The worker threads update the progress bar as they finish the remaining files
+        self.pbar = tqdm.tqdm(total=self.writing_queue.unfinished_tasks, 
+            desc='Post-processing ', 
+            unit='files',
+            disable=not self.config['output'].get('progress', True))
+        self.writing_queue.join()
+        self.pbar.close()
+        self.pbar = None
+        if self.postprocess_pool:
+            self.postprocess_pool.shutdown()
+        if self.tracker:
+            incomplete = self.tracker.fail_incomplete()
+            if incomplete:
+                print('{} requests did not receive all their instances and are marked as failed'.format(incomplete))
+        time_elapsed = time. time() - self.time_start
+        print('Stopping local storage SCP server: {} files transferred in {:.1f} seconds ({:.2f} files/s)'.format(self.file_count, time_elapsed, self.file_count/time_elapsed))
+        if self.scp:
+            self.scp.shutdown()
+            self.scp = None
+        # Remove temporary directory if empty
+        if not os.listdir(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
@@ -11,19 +11,35 @@ import signal
 import threading
 import tqdm
 import concurrent.futures
-import numpy as np
 import inquirer
-import ast
 import sys
+from queue import Queue, Empty
+from .writer import ResultWriter
+from .columnar import dataset_to_row
+from .association import AssociationPool, AssociationError
+from .ratelimit import RateLimiter
+from .tracking import MoveTracker
+from .planning import RequestPlanner
+from .cache import FindCache, CACHE_ONLY
+from .splitting import RangeSplitter
+from .manifest import InstanceManifest, ManifestFilter
+from .metrics import Metrics
+from .profiling import Profiler
+from .ingest import WorkQueue, RequestFeeder
+from .state import (
+    RequestStore, request_store_path, remove_request_store,
+    PENDING, IN_FLIGHT, COMPLETED, FAILED
+)
 
 from pydicom.uid import (
     ExplicitVRLittleEndian, ImplicitVRLittleEndian, ExplicitVRBigEndian,
+    DeflatedExplicitVRLittleEndian, PILSupportedCompressedPixelTransferSyntaxes,
     generate_uid
 )
 
 from pynetdicom import (
-    AE, QueryRetrievePresentationContexts,
-    BasicWorklistManagementPresentationContexts,
+    AE, QueryRetrievePresentationContexts, StoragePresentationContexts, build_role,
+    BasicWorklistManagementPresentationContexts, VerificationPresentationContexts,
     PYNETDICOM_UID_PREFIX,
     PYNETDICOM_IMPLEMENTATION_UID,
     PYNETDICOM_IMPLEMENTATION_VERSION
@@ -37,9 +53,18 @@ from pynetdicom.sop_class import (
     PatientStudyOnlyQueryRetrieveInformationModelFind,
     PatientRootQueryRetrieveInformationModelMove,
     StudyRootQueryRetrieveInformationModelMove,
-    PatientStudyOnlyQueryRetrieveInformationModelMove
+    PatientStudyOnlyQueryRetrieveInformationModelMove,
+    PatientRootQueryRetrieveInformationModelGet,
+    StudyRootQueryRetrieveInformationModelGet,
+    PatientStudyOnlyQueryRetrieveInformationModelGet
 )
 
+# Transfer syntaxes accepted for the instances received with C-GET, as by the storage SCP
+STORAGE_TRANSFER_SYNTAXES = [ImplicitVRLittleEndian,
+    ExplicitVRLittleEndian,
+    DeflatedExplicitVRLittleEndian,
+    ExplicitVRBigEndian] + PILSupportedCompressedPixelTransferSyntaxes
+
 continue_extraction = True
 
 def sigint_handler(signal, frame):
@@ -52,27 +77,19 @@ def watch_sigint():
     signal.signal(signal.SIGINT, sigint_handler)
     
 
-class hashabledict(dict):
-    def __hash__(self):
-        return hash(tuple(sorted(self.items())))
-
-def dataset_to_csv(ds, filepath, fieldnames):
+def dataset_to_csv(ds, filepath, fieldnames, writer=None):
+    if writer and writer.columnar:
+        # Typed values, written as columns by the writer thread
+        writer.write(filepath, fieldnames, dataset_to_row(ds, fieldnames))
+        return
     write_dict = {}
     for key in fieldnames:
         write_dict[key] = str(ds[key].value)
 
-    dict_to_csv(write_dict, filepath, fieldnames)
-
-def request_from_csv(filepath):
-    if os.path.exists(filepath):
-        with open(filepath, 'r') as csvfile:
-            reader = csv.DictReader(csvfile)
-            rows = []
-            for row in reader:
-                rows.append(hashabledict(row))
-        return rows
+    if writer:
+        writer.write(filepath, fieldnames, write_dict)
     else:
-        return []
+        dict_to_csv(write_dict, filepath, fieldnames)
 
 def dict_to_csv(write_dict, filepath, fieldnames):
     if os.path.exists(filepath):
@@ -85,20 +102,10 @@ def dict_to_csv(write_dict, filepath, fieldnames):
             writer.writeheader()
             writer.writerow(write_dict)
 
-def add_element_to_list(element_list, key, value):
-    match_elements = [x if ((x.partition('=')[0] == key) or (x == key)) else None for x in element_list]
-    if match_elements.count(None) != len(match_elements):
-        theVal = [f'{key}={value}' if ((x.partition('=')[0] == key) or (x == key)) else x for x in element_list]
-        return theVal
-    else:
-        theVal = f'{key}={value}'
-        element_list.append(theVal)
-        return element_list
-
 def create_dataset(request):
     ds = Dataset()
     try:
-        elements = [ElementPath(path) for path in request['elements']]
+        elements = [ElementPath(path) for path in request.elements]
         for elem in elements:
             ds = elem.update(ds)
     except Exception as exc:
@@ -106,58 +113,25 @@ def create_dataset(request):
     return ds
 
 def create_requests(config):
-    requests = []
-    if 'elements_batch_file' in config['request']:
-        if os.path.exists(config['request']['elements_batch_file']):
-            with open(config['request']['elements_batch_file'], newline='') as csvfile:
-                reader = csv.DictReader(csvfile, dialect='excel')
-                for row in reader:
-                    row_request = config['request'].copy()
-                    for key in row:
-                        row_request['elements'] = add_element_to_list(row_request['elements'], key, row[key])
-                    row_request['elements'] = sorted(row_request['elements'])
-                    requests.append(row_request)
-        else:
-            requests.append(config['request'])
-    else:
-        requests.append(config['request'])
-
-    
-    filepath_requests = os.path.join(config['output']['directory'], 'requests.whole')
-    filepath_requests_completed = os.path.join(config['output']['directory'], 'requests.completed')
-    filepath_requests_failed = os.path.join(config['output']['directory'], 'requests.failed')
-    if os.path.exists(filepath_requests):
-        os.remove(filepath_requests)
-    if os.path.exists(filepath_requests_completed):
-        os.remove(filepath_requests_completed)
-    if os.path.exists(filepath_requests_failed):
-        os.remove(filepath_requests_failed)
-
-    for request in requests:
-        dict_to_csv(request, filepath_requests, request.keys())
-
-    return requests
+    """
+    Creates an empty request store for a new extraction, the requests are added to it as the
+    elements_batch_file is read
+    """
+    os.makedirs(config['output']['directory'], exist_ok=True)
+    remove_request_store(request_store_path(config))
 
 def pending_requests(config):
     """
-    Returns pending requests to enable resuming
+    Returns the states of the requests to send to resume an extraction, None if the extraction
+    must be created again
     """
-    filepath_requests = os.path.join(config['output']['directory'], 'requests.whole')
-    filepath_requests_completed = os.path.join(config['output']['directory'], 'requests.completed')
-
-    reqs1 = request_from_csv(filepath_requests)
-    reqs2 = []
-    if os.path.isfile(filepath_requests_completed):
-        reqs2 = request_from_csv(filepath_requests_completed)
-
-    requests = list(set(reqs1) - set(reqs2))
-    for request in requests:
-        request['elements'] = list(sorted(ast.literal_eval(request['elements'])))
-        request['throttle_time'] = float(request['throttle_time'])
-        request['threads'] = int(request['threads'])
+    store = RequestStore(request_store_path(config))
+    store.reset_in_flight()
+    pending_count = store.count(PENDING)
+    store.close()
     
     questions = []
-    if requests:
+    if pending_count:
         questions = [
         inquirer.List('resume',
                         message="A partial extraction was detected. Do you want to resume or overwrite?",
@@ -174,15 +148,14 @@ def pending_requests(config):
 
     answers = inquirer.prompt(questions)
     if answers['resume'] == 'Overwrite':
-        requests = create_requests(config)
-    return requests
+        return None
+    return [PENDING] if pending_count else []
 
 def failed_requests(config):
     """
-    Returns failed requests to enable re-trying
+    Returns the states of the requests to send to re-try failed requests, None if the extraction
+    must be created again
     """
-    filepath_requests_failed = os.path.join(config['output']['directory'], 'requests.failed')
-
     questions = [
     inquirer.List('failed',
                     message="Failed requests from a previous extraction were detected. Do you want to re-try the failed requests?",
@@ -191,62 +164,154 @@ def failed_requests(config):
     ]
     answers = inquirer.prompt(questions)
 
-    requests = []
     if answers['failed'] == 'Remove failed requests':
-        requests = pending_requests(config)
-    else:
-        reqs1 = request_from_csv(filepath_requests_failed)
-        requests = list(set(reqs1))
-        for request in requests:
-            request['elements'] = list(sorted(ast.literal_eval(request['elements'])))
-            request['throttle_time'] = float(request['throttle_time'])
-            request['threads'] = int(request['threads'])
-    
-    if os.path.exists(filepath_requests_failed):
-        os.remove(filepath_requests_failed)
-    
-    return requests
-
-def thread_scu_function(config, pbar, requests):
+        store = RequestStore(request_store_path(config))
+        store.remove(FAILED)
+        store.close()
+        return pending_requests(config)
+    return [FAILED]
+
+def has_failed_requests(config):
+    filepath_store = request_store_path(config)
+    if not os.path.isfile(filepath_store):
+        return False
+    store = RequestStore(filepath_store)
+    failed_count = store.count(FAILED)
+    store.close()
+    return failed_count > 0
+
+def create_worker_scu(config, pbar, writer, pool, limiter, tracker, cache, splitter, destination=None, manifest_filter=None, metrics=None, profiler=None):
     scu = SCU(config)
     scu.pbar = pbar
-    scu.process_requests_batch(list(requests))
+    scu.writer = writer
+    scu.pool = pool
+    scu.limiter = limiter
+    scu.tracker = tracker
+    scu.cache = cache
+    scu.splitter = splitter
+    scu.destination = destination
+    scu.manifest_filter = manifest_filter
+    scu.metrics = metrics
+    if profiler is not None:
+        scu.profiler = profiler
+    return scu
+
+def thread_scu_function(config, pbar, writer, pool, limiter, tracker, cache, splitter, work_queue, destination=None, manifest_filter=None, metrics=None, profiler=None):
+    scu = create_worker_scu(config, pbar, writer, pool, limiter, tracker, cache, splitter, destination, manifest_filter, metrics, profiler)
+    scu.process_request_queue(work_queue)
     return
 
-def process_request_batch(config):
+def process_request_batch(config, limiter=None, scp=None, owner=None):
 
-    requests = []
-    filepath_requests = os.path.join(config['output']['directory'], 'requests.whole')
-    filepath_requests_completed = os.path.join(config['output']['directory'], 'requests.completed')
-    filepath_requests_failed = os.path.join(config['output']['directory'], 'requests.failed')
+    filepath_store = request_store_path(config)
+    states = None
 
-    if (os.path.isfile(filepath_requests)):
+    if owner is not None:
+        # Worker of a distributed extraction, the requests are leased from the coordinator's store
+        states = [PENDING]
+    elif (os.path.isfile(filepath_store)):
         # Previous extraction detected
-        if os.path.isfile(filepath_requests_failed):
+        if has_failed_requests(config):
             # Failed requests detected
-            requests = failed_requests(config)
+            states = failed_requests(config)
         else:
             # No failed requests detected, return pending requests
-            requests = pending_requests(config)
+            states = pending_requests(config)
+    if states is None:
+        # No previous extraction detected, or overwritten
+        create_requests(config)
+        states = [PENDING]
+        ingest = True
     else:
-        # No previous extraction detected
-        requests = create_requests(config)
-    
-    if requests:
+        ingest = False
+
+    if states:
         watch_sigint()
-        split_requests = np.array_split(requests, config['request']['threads'])
+        # Requests are pulled from a shared queue by idle SCU threads, while it is fed from the batch file
+        # or the request store
+        work_queue = WorkQueue(int(config['request'].get('max_queued', 10000)))
         print('To stop extraction, press CTRL-C. Extraction can be resumed at a later time.')
-        pbar = tqdm.tqdm(total=len(requests), 
+        pbar = tqdm.tqdm(total=0, 
             desc='Sending {} requests '.format(config['request']['type']), 
-            unit='rqst')
-        fn = lambda x : thread_scu_function(config, pbar, x)
-        if config['request']['threads'] > 1:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=config['request']['threads']) as executor:
-                executor.map(fn, split_requests)
-        else:
-            fn(split_requests[0])
-        pbar.close()
+            unit='rqst',
+            disable=not config['output'].get('progress', True))
+        store = RequestStore(filepath_store)
+        writer = ResultWriter(config, store)
+        writer.start()
+        if limiter is None:
+            limiter = RateLimiter(config)
+        plan = None
+        if config['request']['type'].lower() in ['c-move', 'c-get'] and config['request'].get('collapse_series', False):
+            # Combine the series requests of a study in a single study-level request
+            plan = RequestPlanner(config, SCU(config).establish_association, limiter).plan
+        tracker = None
+        if scp:
+            # C-MOVE and C-GET requests are completed by the storage SCP once their instances are written
+            tracker = MoveTracker(writer.journal)
+            scp.tracker = tracker
+        manifest = None
+        manifest_filter = None
+        if scp and (config.get('manifest') or {}).get('enabled', False):
+            # Instances already on disk are not retrieved again
+            manifest = InstanceManifest(config)
+            manifest_filter = ManifestFilter(config, manifest, limiter)
+            scp.manifest = manifest
+        cache = None
+        if config['request']['type'].lower() == 'c-find' and (config.get('find_cache') or {}).get('enabled', False):
+            cache = FindCache(config)
+        splitter = None
+        if config['request']['type'].lower() == 'c-find' and (config['request'].get('split') or {}).get('enabled', False):
+            splitter = RangeSplitter(config)
+        association_scu = SCU(config)
+        destination = None
+        if scp:
+            association_scu.store_handler = scp.handle_store
+            # C-MOVE requests are spread over the listeners of the storage SCP
+            destination = scp.next_destination
+        pool = AssociationPool(config, association_scu.establish_association, lambda: continue_extraction)
+        metrics = None
+        if (config.get('metrics') or {}).get('enabled', False):
+            metrics = Metrics(config)
+            pool.metrics = metrics
+            metrics.gauge('work_queue_requests', work_queue.qsize)
+            metrics.gauge('writer_queue_rows', writer.queue.qsize)
+            metrics.gauge('open_associations', lambda: pool.open_count)
+            if scp:
+                scp.register_metrics(metrics)
+            metrics.start()
+        # Sampled timing spans of the requests and received files, no-ops unless enabled
+        profiler = Profiler(config)
+        if scp:
+            scp.profiler = profiler
+        feeder = RequestFeeder(config, store, work_queue, states, ingest, pbar, plan, owner)
+        feeder.start()
+        try:
+            if config['request']['threads'] > 1:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=config['request']['threads']) as executor:
+                    for i in range(config['request']['threads']):
+                        executor.submit(thread_scu_function, config, pbar, writer, pool, limiter, tracker, cache, splitter, work_queue, destination, manifest_filter, metrics, profiler)
+            else:
+                thread_scu_function(config, pbar, writer, pool, limiter, tracker, cache, splitter, work_queue, destination, manifest_filter, metrics, profiler)
+        finally:
+            # Make sure queued rows and request states reach the disk, including on CTRL-C
+            feeder.stop()
+            pool.close()
+            if cache:
+                cache.close()
+            if scp:
+                # Received files are post-processed before the last request states are written
+                scp.stop_server()
+            if manifest:
+                manifest.close()
+            profiler.stop()
+            if metrics:
+                metrics.stop()
+            writer.stop()
+            store.close()
+            pbar.close()
     else:
+        if scp:
+            scp.stop_server()
         print('No further requests pending')
         
     
@@ -272,9 +337,28 @@ class SCU(object):
     """
     def __init__(self, config):
         self.config = config
-        self.ae = self.create_ae()
         self.query_model = self.create_query_model()
+        self.ae = self.create_ae()
         self.pbar = None
+        self.writer = None
+        self.pool = None
+        self.limiter = None
+        self.tracker = None
+        self.cache = None
+        self.splitter = None
+        self.work_queue = None
+        # C-STORE handler of the storage SCP for the instances received with C-GET
+        self.store_handler = None
+        # Returns the move destination of a C-MOVE request, the local AE title by default
+        self.destination = None
+        # Skips or narrows the requests whose instances are already on disk
+        self.manifest_filter = None
+        self.metrics = None
+        # Timing spans of the requests, disabled unless set by the requests batch
+        self.profiler = Profiler()
+        self.request_start = None
+        self.first_response_latency = None
+        self.association = None
         
     def create_ae(self):
         # Create application entity
@@ -290,14 +374,50 @@ class SCU(object):
             ae.requested_contexts = QueryRetrievePresentationContexts
                 
         elif self.config['request']['type'].lower() == 'c-echo':
-            ae.requested_contexts = [VerificationSOPClass]
+            ae.requested_contexts = VerificationPresentationContexts
 
         elif self.config['request']['type'].lower() == 'c-move':
             ae.requested_contexts = QueryRetrievePresentationContexts
 
+        elif self.config['request']['type'].lower() == 'c-get':
+            ae.add_requested_context(self.query_model)
+            # Used to combine series requests
+            if self.config['request']['model'] == 'patient':
+                ae.add_requested_context(PatientRootQueryRetrieveInformationModelFind)
+            else:
+                ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)
+            # The PACS sends the instances with C-STORE requests on the same association
+            for sop_class in self.storage_sop_classes():
+                ae.add_requested_context(sop_class, STORAGE_TRANSFER_SYNTAXES)
+
+        # C-ECHO is used to keep idle associations of the pool alive
+        if self.config['request']['type'].lower() != 'c-echo':
+            ae.add_requested_context(VerificationSOPClass)
+
         return ae
 
+    def storage_sop_classes(self):
+        """
+        Returns the storage SOP classes accepted from the PACS with C-GET, request.storage_sop_classes
+        restricts them to a list of UIDs
+        """
+        if self.config['request'].get('storage_sop_classes'):
+            sop_classes = [str(x) for x in self.config['request']['storage_sop_classes']]
+        else:
+            sop_classes = [cx.abstract_syntax for cx in StoragePresentationContexts]
+        # At most 128 presentation contexts can be requested, including the query models and verification
+        return sop_classes[:125]
+
     def establish_association(self):
+        if self.config['request']['type'].lower() == 'c-get':
+            # Storage SCP role for the C-STORE sub-operations of the C-GET requests
+            roles = [build_role(sop_class, scp_role=True) for sop_class in self.storage_sop_classes()]
+            return self.ae.associate(self.config['pacs']['hostname'], 
+                self.config['pacs']['port'],  
+                ae_title=self.config['pacs']['aet'],
+                max_pdu=16382,
+                ext_neg=roles,
+                evt_handlers=[(evt.EVT_C_STORE, self.store_handler)])
         return self.ae.associate(self.config['pacs']['hostname'], 
             self.config['pacs']['port'],  
             ae_title=self.config['pacs']['aet'],
@@ -319,19 +439,6 @@ class SCU(object):
                         self.pbar.set_description('Sending {} requests (will pause at {})'.format(self.config['request']['type'], self.config['schedule']['end_time']))
                     
 
-    def retry_association(self):
-
-        for i in range(100):
-            if not self.association.is_established:
-                time.sleep(1)
-                print('Re-trying association')
-                self.association = self.establish_association()
-            else:
-                return
-        
-        sys.exit(1)
-
-
     def create_query_model(self):
         request = self.config['request']
         query_model = None
@@ -349,101 +456,334 @@ class SCU(object):
                 query_model = PatientStudyOnlyQueryRetrieveInformationModelMove
             else:
                 query_model = PatientRootQueryRetrieveInformationModelMove
+        elif request['type'].lower() == 'c-get':
+            if request['model'] == 'study':
+                query_model = StudyRootQueryRetrieveInformationModelGet
+            elif self.config['request']['model'] == 'psonly':
+                query_model = PatientStudyOnlyQueryRetrieveInformationModelGet
+            else:
+                query_model = PatientRootQueryRetrieveInformationModelGet
         return query_model
 
-    def process_requests_batch(self, requests):
+    def process_request_queue(self, work_queue):
         global continue_extraction
 
-        self.association = self.establish_association()
-        for request in requests:
-            if continue_extraction:
-                self.wait_until_scheduled_time()
-                self.process_request(request)
-                time.sleep(request['throttle_time'])
-        self.association.release()
+        self.work_queue = work_queue
+        while continue_extraction:
+            try:
+                request = work_queue.get(timeout=0.1)
+            except Empty:
+                if work_queue.is_drained():
+                    # No request left to read and no request in flight can add sub-requests to the queue
+                    break
+                continue
+            try:
+                done = self.send_request(request)
+            except AssociationError as exc:
+                print(exc)
+                work_queue.put(request)
+                break
+            finally:
+                work_queue.task_done()
+            if not done:
+                # The in-flight request goes back to the queue to be sent on another association
+                work_queue.put(request)
+                continue
+            time.sleep(self.config['request']['throttle_time'])
+
+    def send_request(self, request):
+        """
+        Sends a request on an association of the pool. Returns False if the association was lost 
+        and the request should be sent again.
+        """
+        self.wait_until_scheduled_time()
+        if self.cache and self.send_cached(request):
+            return True
+        if self.limiter:
+            self.limiter.acquire_request()
+        with self.profiler.span('acquire_association'):
+            pooled = self.pool.acquire()
+        self.association = pooled.association
+        self.journal(request, IN_FLIGHT)
+        time_start = time.time()
+        self.request_start = time_start
+        self.first_response_latency = None
+        try:
+            status = self.process_request(request)
+        except AssociationError:
+            if self.limiter:
+                self.limiter.record(time.time() - time_start, None)
+            if self.metrics:
+                self.metrics.inc('association_lost_total', type=self.config['request']['type'].lower())
+            self.pool.release(pooled, healthy=False)
+            self.association = None
+            if self.tracker:
+                self.tracker.discard(request.id)
+            max_attempts = int((self.config.get('association') or {}).get('max_request_attempts', 3))
+            request.attempts += 1
+            if request.attempts < max_attempts:
+                return False
+            print('Association lost {} times while sending request, giving up'.format(request.attempts))
+            if self.pbar:
+                self.pbar.update(1)
+            self.journal(request, FAILED)
+            return True
+        if self.limiter:
+            # The total time of a C-FIND, C-MOVE or C-GET grows with the number of matches or instances,
+            # the time until the first response is the latency of the PACS itself
+            latency = self.first_response_latency
+            self.limiter.record(latency if latency is not None else time.time() - time_start, status)
+        if self.metrics:
+            request_type = self.config['request']['type'].lower()
+            self.metrics.observe('request_seconds', time.time() - time_start, type=request_type)
+            self.metrics.inc('requests_total', type=request_type,
+                status='0x{:04X}'.format(status) if isinstance(status, int) else 'none')
+        self.pool.release(pooled)
+        self.association = None
+        return True
         
     
     def process_request(self, request):
-        if request['type'].lower() == 'c-find':
-            self.send_find(request)
-        if request['type'].lower() == 'c-move':
-            self.send_move(request)
-        return
-    
+        """
+        Sends a request and returns its final status
+        """
+        if self.config['request']['type'].lower() == 'c-find':
+            with self.profiler.span('send_find', request=request.id):
+                return self.send_find(request)
+        if self.config['request']['type'].lower() == 'c-move':
+            with self.profiler.span('send_move', request=request.id):
+                return self.send_move(request)
+        if self.config['request']['type'].lower() == 'c-get':
+            with self.profiler.span('send_get', request=request.id):
+                return self.send_get(request)
+        if self.config['request']['type'].lower() == 'c-echo':
+            with self.profiler.span('send_echo', request=request.id):
+                return self.send_echo(request)
+        return None
+
+    def journal(self, request, state):
+        if self.writer:
+            # A combined request journals the state of every request it replaces
+            for member in request.request_ids():
+                self.writer.journal(member, state)
     
+    def send_cached(self, request):
+        """
+        Serves a C-FIND request from the cache as if the responses came from the PACS. Returns False
+        if the request must be sent to the PACS.
+        """
+        if self.config['request']['type'].lower() != 'c-find':
+            return False
+        identifier = create_dataset(request)
+        responses = self.cache.get(identifier, self.query_model)
+        if responses is None:
+            if self.cache.policy != CACHE_ONLY:
+                return False
+            print('Request not found in the C-FIND cache')
+            self.journal(request, FAILED)
+        else:
+            keywords = [ElementPath(path).keyword for path in request.elements]
+            path = os.path.join(self.config['output']['directory'], self.config['output']['database_file'])
+            for rsp_identifier in responses:
+                dataset_to_csv(rsp_identifier, path, keywords, self.writer)
+            self.journal(request, COMPLETED)
+        if self.splitter:
+            self.splitter.done(request)
+        if self.pbar:
+            self.pbar.update(1)
+        return True
+
     def send_find(self, request):
         
-        identifier = create_dataset(request)
+        with self.profiler.span('create_dataset'):
+            identifier = create_dataset(request)
     
-        keywords = [ElementPath(path).keyword for path in request['elements']]
+        keywords = [ElementPath(path).keyword for path in request.elements]
+        path = os.path.join(self.config['output']['directory'], self.config['output']['database_file'])
+        # Responses are written once the final status is received, so that a request re-sent after
+        # the association was lost does not write them twice
+        kept = []
 
         if not self.association.is_established:
-            self.retry_association()
-        
-        if self.association.is_established:
-            responses = self.association.send_c_find(identifier, self.query_model)
-                    
-            for (status, rsp_identifier) in responses:
-                if 'Status' in status:
-                    
-                    if status and status.Status in [0xFF00, 0xFF01]:
-                        # Status pending
-                        path = os.path.join(self.config['output']['directory'], self.config['output']['database_file'])
-                        dataset_to_csv(rsp_identifier, path, keywords)
-                    else:
-                        if self.pbar:
-                            self.pbar.update(1)
-                        if hasattr(status, 'Status'):
-                            identifier.Status = hex(status.Status)
-                        else:
-                            identifier.Status = 'timeout'
-                        # Status Success, Warning, Cancel, Failure
-                        if identifier.Status in [hex(0x0000)]:
-                            filepath_requests_completed = os.path.join(self.config['output']['directory'], 'requests.completed')
-                            dict_to_csv(request, filepath_requests_completed, request.keys())
-                        else:
-                            print('Failed with code ', hex(status.Status))
-                            filepath_requests_failed = os.path.join(self.config['output']['directory'], 'requests.failed')
-                            dict_to_csv(request, filepath_requests_failed, request.keys())
+            raise AssociationError('Association lost before c-find')
 
+        responses = self.timed_responses(self.association.send_c_find(identifier, self.query_model), 'c-find')
                 
-                    
+        for (status, rsp_identifier) in responses:
+            if 'Status' not in status:
+                # Association aborted or DIMSE timeout
+                raise AssociationError('Association lost during c-find')
+                
+            if status.Status in [0xFF00, 0xFF01]:
+                # Status pending
+                kept.append(rsp_identifier)
+            else:
+                if self.splitter:
+                    if self.splitter.should_split(len(kept), status.Status):
+                        if self.send_split(request, kept):
+                            # Truncated responses are discarded, the sub-requests return them
+                            return status.Status
+                        # Failed so that it is sent again when failed requests are re-tried
+                        print('C-FIND responses truncated and the request cannot be split further: {}'
+                            .format(', '.join(request.elements)))
+                        self.splitter.done(request)
+                        if self.pbar:
+                            self.pbar.update(1)
+                        self.journal(request, FAILED)
+                        return status.Status
+                    for rsp_identifier in kept:
+                        if self.splitter.is_new(rsp_identifier, keywords, request):
+                            dataset_to_csv(rsp_identifier, path, keywords, self.writer)
+                    self.splitter.done(request)
+                else:
+                    for rsp_identifier in kept:
+                        dataset_to_csv(rsp_identifier, path, keywords, self.writer)
+                if self.pbar:
+                    self.pbar.update(1)
+                if self.cache and status.Status == 0x0000:
+                    self.cache.put(identifier, self.query_model, kept)
+                identifier.Status = hex(status.Status)
+                # Status Success, Warning, Cancel, Failure
+                if identifier.Status in [hex(0x0000)]:
+                    self.journal(request, COMPLETED)
+                else:
+                    print('Failed with code ', hex(status.Status))
+                    self.journal(request, FAILED)
+                return status.Status
+
+    def send_split(self, request, responses=()):
+        """
+        Replaces a request by its sub-requests in the request store and the work queue. Returns False
+        if the request cannot be split further.
+        """
+        sub_requests = self.splitter.split(request, responses)
+        if not sub_requests or self.work_queue is None:
+            return False
+        if self.writer and self.writer.store:
+            # Sub-requests are pending requests of the extraction, so that they are resumed
+            self.writer.store.add(sub_requests)
+        if not self.work_queue.leased:
+            # Otherwise they are leased from the request store by any worker
+            self.splitter.register(request, sub_requests)
+            for sub_request in sub_requests:
+                self.work_queue.put(sub_request)
+            if self.pbar:
+                self.pbar.total += len(sub_requests) - 1
+                self.pbar.refresh()
+        self.journal(request, COMPLETED)
+        return True
+
+    def send_echo(self, request):
+        if not self.association.is_established:
+            raise AssociationError('Association lost before c-echo')
+        status = self.association.send_c_echo()
+        if 'Status' not in status:
+            raise AssociationError('Association lost during c-echo')
+        if self.pbar:
+            self.pbar.update(1)
+        self.journal(request, COMPLETED if status.Status == 0x0000 else FAILED)
+        return status.Status
 
     def send_move(self, request):
-        
-        identifier = create_dataset(request)
+        return self.send_retrieve(request, 'c-move')
+
+    def send_get(self, request):
+        return self.send_retrieve(request, 'c-get')
+
+    def send_retrieve(self, request, request_type):
+        """
+        Sends a C-MOVE or C-GET request. The instances are received by the storage SCP, through
+        another association for a C-MOVE and on the same association for a C-GET.
+        """
+        with self.profiler.span('create_dataset'):
+            identifier = create_dataset(request)
     
-        keywords = [ElementPath(path).keyword for path in request['elements']]
+        keywords = [ElementPath(path).keyword for path in request.elements]
 
         if not self.association.is_established:
-            self.retry_association()
-        
-        if self.association.is_established:
-            responses = self.association.send_c_move(identifier, self.config['local']['aet'], self.query_model)
-
-            for (status, rsp_identifier) in responses:
+            raise AssociationError('Association lost before {}'.format(request_type))
+
+        retrieve_identifier = identifier
+        if self.manifest_filter:
+            with self.profiler.span('manifest_filter'):
+                retrieve_identifier = self.manifest_filter.narrow(self.association, identifier)
+            if retrieve_identifier is None:
+                # All the instances are already in the output directory
+                if self.metrics:
+                    self.metrics.inc('requests_skipped_total', type=request_type)
+                if self.pbar:
+                    self.pbar.update(1)
+                self.journal(request, COMPLETED)
+                return 0x0000
+
+        tracked = False
+        if self.tracker:
+            # Instances received from now on are correlated to the request, if it has a unique key
+            tracked = self.tracker.begin(request.id, retrieve_identifier, request.members)
+
+        # The C-FIND requests of the manifest are not included in the first response time
+        self.request_start = time.time()
+        if request_type == 'c-get':
+            responses = self.association.send_c_get(retrieve_identifier, self.query_model)
+        else:
+            move_aet = self.destination() if self.destination else self.config['local']['aet']
+            responses = self.association.send_c_move(retrieve_identifier, move_aet, self.query_model)
+        responses = self.timed_responses(responses, request_type)
+
+        for (status, rsp_identifier) in responses:
+            if 'Status' not in status:
+                # Association aborted or DIMSE timeout
+                raise AssociationError('Association lost during {}'.format(request_type))
+            
+            if status.Status in [0xFF00]:
+                # Status pending
+                pass
+            else:
+                # Status Success, Warning, Cancel, Failure
+                if self.pbar:
+                    self.pbar.update(1)
+                identifier.Status = hex(status.Status)
+                keywords.append('Status')
+                path = os.path.join(self.config['output']['directory'], self.config['output']['database_file'])
+                dataset_to_csv(identifier, path, keywords, self.writer)
                 
-                if status and status.Status in [0xFF00]:
-                    # Status pending
-                    pass
-                else:
-                    # Status Success, Warning, Cancel, Failure
-                    if self.pbar:
-                        self.pbar.update(1)
-                    if hasattr(status, 'Status'):
-                        identifier.Status = hex(status.Status)
-                    else:
-                        identifier.Status = 'timeout'
-                    keywords.append('Status')
-                    path = os.path.join(self.config['output']['directory'], self.config['output']['database_file'])
-                    dataset_to_csv(identifier, path, keywords)
-                    
-                    if identifier.Status in [hex(0x0000)]:
-                        filepath_requests_completed = os.path.join(self.config['output']['directory'], 'requests.completed')
-                        dict_to_csv(request, filepath_requests_completed, request.keys())
+                if identifier.Status in [hex(0x0000)]:
+                    if tracked:
+                        # Completed once all the instances have been post-processed
+                        self.tracker.end(request.id, self.expected_instances(status))
                     else:
-                        filepath_requests_failed = os.path.join(self.config['output']['directory'], 'requests.failed')
-                        dict_to_csv(request, filepath_requests_failed, request.keys())
+                        self.journal(request, COMPLETED)
+                else:
+                    if tracked:
+                        self.tracker.discard(request.id)
+                    self.journal(request, FAILED)
+                return status.Status
+
+    def timed_responses(self, responses, request_type):
+        """
+        Yields the responses of a request, the time until the first one is recorded for the rate
+        limiter and in the metrics
+        """
+        first = True
+        for response in responses:
+            if first:
+                self.first_response_latency = time.time() - self.request_start
+                if self.metrics:
+                    self.metrics.observe('first_response_seconds', self.first_response_latency, type=request_type)
+            first = False
+            yield response
+
+    def expected_instances(self, status):
+        """
+        Returns the number of instances stored by the sub-operations of a C-MOVE or C-GET, None if the
+        final response does not report it
+        """
+        if 'NumberOfCompletedSuboperations' not in status:
+            return None
+        expected = status.NumberOfCompletedSuboperations
+        if 'NumberOfWarningSuboperations' in status:
+            expected += status.NumberOfWarningSuboperations
+        return expected
                   
 
                     
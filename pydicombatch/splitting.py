@@ -0,0 +1,172 @@
+import datetime
+import threading
+from .state import Request
+
+DATE_FORMAT = '%Y%m%d'
+FIRST_DATE = '19000101'
+# Characters that cannot follow a PatientID prefix in a sub-request: wildcards and the value separator
+RESERVED_CHARACTERS = '*?\\'
+
+
+def element_value(elements, keyword):
+    """
+    Returns the value of an element of a list in the format Keyword=value, None if it is missing
+    """
+    for x in elements:
+        key, _, value = x.partition('=')
+        if key.strip() == keyword:
+            return value.strip()
+    return None
+
+def replace_element(elements, keyword, value):
+    return sorted('{}={}'.format(keyword, value) if x.partition('=')[0].strip() == keyword else x
+        for x in elements)
+
+
+class RangeSplitter(object):
+    """ RangeSplitter class
+    This class splits C-FIND requests whose responses are truncated by the PACS (at max_results
+    matches) or refused as out of resources. The request is bisected on the first range key of its
+    elements that can still be split: a StudyDate or StudyTime range, or a PatientID prefix. A
+    PatientID prefix is followed by the characters of prefix_alphabet and by the characters seen
+    after it in the truncated responses. Rows already written by another sub-request of the same
+    split request are not written again, the rows of a split request are kept until all its
+    sub-requests are done.
+    """
+
+    def __init__(self, config):
+        options = config['request'].get('split') or {}
+        self.max_results = int(options.get('max_results', 0))
+        self.keys = options.get('keys', ['StudyDate', 'StudyTime', 'PatientID'])
+        self.alphabet = str(options.get('prefix_alphabet', '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+        self.lock = threading.Lock()
+        # Lineage: [sub-requests not done yet, rows written]
+        self.lineages = {}
+        self.warned = False
+
+    def should_split(self, count, status):
+        if (status >> 8) == 0xA7:
+            # Out of resources
+            return True
+        return self.max_results > 0 and count >= self.max_results
+
+    def split(self, request, responses=()):
+        """
+        Returns the sub-requests covering a request, an empty list if it cannot be split further.
+        responses are the truncated responses of the request.
+        """
+        for keyword in self.keys:
+            value = element_value(request.elements, keyword)
+            if value is None:
+                # Range keys are only added to the requests that return them
+                continue
+            if keyword == 'StudyDate':
+                values = self.split_date(value)
+            elif keyword == 'StudyTime':
+                values = self.split_time(value)
+            elif keyword == 'PatientID':
+                values = self.split_prefix(value, responses)
+            else:
+                values = []
+            if values:
+                return [self.sub_request(request, keyword, x) for x in values]
+        return []
+
+    def sub_request(self, request, keyword, value):
+        return Request(replace_element(request.elements, keyword, value), priority=request.priority,
+            lineage=request.lineage or request.id)
+
+    def register(self, request, sub_requests):
+        """
+        Count the sub-requests replacing a request in the lineage of their rows
+        """
+        with self.lock:
+            lineage = self.lineages.setdefault(request.lineage or request.id, [1, set()])
+            lineage[0] += len(sub_requests) - 1
+
+    def done(self, request):
+        """
+        Forget the rows of a lineage once its last sub-request is done
+        """
+        if request.lineage is None:
+            return
+        with self.lock:
+            lineage = self.lineages.get(request.lineage)
+            if lineage is None:
+                return
+            lineage[0] -= 1
+            if lineage[0] <= 0:
+                del self.lineages[request.lineage]
+
+    def split_date(self, value):
+        start, separator, end = value.partition('-')
+        if not separator:
+            if value:
+                # Single date
+                return []
+            start, end = '', ''
+        start = datetime.datetime.strptime(start or FIRST_DATE, DATE_FORMAT).date()
+        end = datetime.datetime.strptime(end, DATE_FORMAT).date() if end else datetime.date.today()
+        if start >= end:
+            return []
+        middle = start + (end - start) // 2
+        return ['{}-{}'.format(start.strftime(DATE_FORMAT), middle.strftime(DATE_FORMAT)),
+            '{}-{}'.format((middle + datetime.timedelta(days=1)).strftime(DATE_FORMAT), end.strftime(DATE_FORMAT))]
+
+    def split_time(self, value):
+        start, separator, end = value.partition('-')
+        if not separator and value:
+            # Single time
+            return []
+        seconds = lambda x: int(x[0:2] or 0) * 3600 + int(x[2:4] or 0) * 60 + int(x[4:6] or 0)
+        time_str = lambda x: '{:02d}{:02d}{:02d}'.format(x // 3600, x // 60 % 60, x % 60)
+        start = seconds(start.split('.')[0]) if start else 0
+        end = seconds(end.split('.')[0]) if end else 86399
+        if start >= end:
+            return []
+        middle = (start + end) // 2
+        # Times with a fraction of a second after the middle are in the first range
+        return ['{}-{}.999999'.format(time_str(start), time_str(middle)),
+            '{}-{}'.format(time_str(middle + 1), time_str(end))]
+
+    def split_prefix(self, value, responses=()):
+        if value and not value.endswith('*'):
+            # Exact PatientID
+            return []
+        prefix = value.rstrip('*')
+        alphabet = list(self.alphabet)
+        for ds in responses:
+            patient_id = str(ds.get('PatientID', '') or '')
+            if patient_id.startswith(prefix) and len(patient_id) > len(prefix):
+                character = patient_id[len(prefix)]
+                if character not in alphabet and character not in RESERVED_CHARACTERS:
+                    alphabet.append(character)
+        with self.lock:
+            warn, self.warned = not self.warned, True
+        if warn:
+            print('Splitting C-FIND requests on PatientID prefixes: patient IDs continuing with a character '
+                'other than {} or those seen in the truncated responses are not queried, set '
+                'request.split.prefix_alphabet to cover them'.format(self.alphabet))
+        values = [prefix + x + '*' for x in alphabet]
+        if prefix:
+            # The PatientID equal to the prefix itself
+            values.append(prefix)
+        return values
+
+    def is_new(self, ds, keywords, request):
+        """
+        Returns True if a response row was not written yet by another sub-request of the lineage of
+        a request. Requests that were not split, or were resumed from the request store, are not
+        tracked.
+        """
+        if request.lineage is None:
+            return True
+        row = tuple(str(ds[keyword].value) for keyword in keywords)
+        with self.lock:
+            lineage = self.lineages.get(request.lineage)
+            if lineage is None:
+                return True
+            if row in lineage[1]:
+                return False
+            lineage[1].add(row)
+            return True
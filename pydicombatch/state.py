@@ -0,0 +1,217 @@
+import os
+import time
+import json
+import hashlib
+import sqlite3
+import threading
+
+PENDING = 'pending'
+IN_FLIGHT = 'in-flight'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+
+def request_store_path(config):
+    return os.path.join(config['output']['directory'], 'requests.db')
+
+def remove_request_store(filepath):
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(filepath + suffix):
+            os.remove(filepath + suffix)
+
+def request_id(elements):
+    """
+    Returns a stable identifier for a request based on its elements
+    """
+    return hashlib.sha1(json.dumps(sorted(elements)).encode('utf-8')).hexdigest()
+
+
+class Request(object):
+    """ Request class
+    A request of the batch: its elements in the format Keyword=value, an id computed once from them
+    and the bookkeeping needed to send it. The settings shared by all the requests (type, model,
+    throttle_time...) are read from the request section of the configuration. A request combining
+    several requests of the batch journals the state of its members. The sub-requests of a split
+    request keep the id of the request they were split from (lineage).
+    """
+    __slots__ = ['id', 'elements', 'priority', 'attempts', 'members', 'lineage']
+
+    def __init__(self, elements, id=None, priority=0.0, members=None, lineage=None):
+        self.elements = tuple(sorted(elements))
+        self.id = id or request_id(self.elements)
+        self.priority = priority
+        self.attempts = 0
+        self.members = members
+        self.lineage = lineage
+
+    def request_ids(self):
+        return self.members or [self.id]
+
+
+class RequestStore(object):
+    """ RequestStore class
+    This class keeps the state (pending, in-flight, completed, failed) of every request of an
+    extraction in a SQLite database, so that resuming and re-trying are index lookups. In distributed
+    mode, the processes sharing the database lease batches of requests for a limited time.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        # Other processes may hold the database lock in distributed mode
+        self.connection = sqlite3.connect(filepath, check_same_thread=False, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS requests ('
+            'id TEXT PRIMARY KEY, seq INTEGER, priority REAL, elements TEXT, state TEXT, '
+            'lease_owner TEXT, lease_expires REAL)')
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(requests)')]
+        if 'lease_owner' not in columns:
+            # Request store of a previous version
+            self.connection.execute('ALTER TABLE requests ADD COLUMN lease_owner TEXT')
+            self.connection.execute('ALTER TABLE requests ADD COLUMN lease_expires REAL')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS requests_state ON requests (state, priority DESC, seq)')
+        self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def add(self, requests):
+        """
+        Add requests as pending, requests already in the store are ignored. Returns the requests
+        that were added.
+        """
+        unique_requests = {}
+        for request in requests:
+            unique_requests.setdefault(request.id, request)
+        requests = list(unique_requests.values())
+        with self.lock:
+            # Other processes sharing the database cannot add requests with the same seq
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                seq = self.connection.execute('SELECT COALESCE(MAX(seq), -1) + 1 FROM requests').fetchone()[0]
+                self.connection.executemany('INSERT OR IGNORE INTO requests (id, seq, priority, elements, state) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    ((request.id, seq + i, request.priority, json.dumps(list(request.elements)), PENDING)
+                        for i, request in enumerate(requests)))
+                added = set(row[0] for row in
+                    self.connection.execute('SELECT id FROM requests WHERE seq >= ?', (seq,)))
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+        return [request for request in requests if request.id in added]
+
+    def select(self, states):
+        """
+        Returns (id, elements) of the requests in the given states, highest priority first and
+        then in insertion order
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT id, elements FROM requests WHERE state IN ({}) '
+                'ORDER BY priority DESC, seq'
+                .format(','.join('?' * len(states))), states).fetchall()
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def iterate(self, states, batch_size=10000):
+        """
+        Yields batches of (id, elements) of the requests in the given states, in the order of select,
+        without loading all of them at once. Requests added during the iteration are not returned.
+        """
+        placeholders = ','.join('?' * len(states))
+        with self.lock:
+            last_seq = self.connection.execute('SELECT COALESCE(MAX(seq), -1) FROM requests').fetchone()[0]
+        position = None
+        while True:
+            with self.lock:
+                if position is None:
+                    rows = self.connection.execute('SELECT id, elements, priority, seq FROM requests '
+                        'WHERE state IN ({}) AND seq <= ? ORDER BY priority DESC, seq LIMIT ?'
+                        .format(placeholders), list(states) + [last_seq, batch_size]).fetchall()
+                else:
+                    rows = self.connection.execute('SELECT id, elements, priority, seq FROM requests '
+                        'WHERE state IN ({}) AND seq <= ? AND (priority < ? OR (priority = ? AND seq > ?)) '
+                        'ORDER BY priority DESC, seq LIMIT ?'
+                        .format(placeholders), list(states) + [last_seq, position[0], position[0], position[1], batch_size]).fetchall()
+            if not rows:
+                return
+            yield [(row[0], json.loads(row[1])) for row in rows]
+            position = (rows[-1][2], rows[-1][3])
+
+    def count(self, *states):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM requests WHERE state IN ({})'
+                .format(','.join('?' * len(states))), states).fetchone()[0]
+
+    def set_states(self, updates):
+        """
+        Apply a batch of (request id, state) updates in a single transaction
+        """
+        with self.lock:
+            self.connection.executemany('UPDATE requests SET state = ? WHERE id = ?',
+                ((state, request_id) for request_id, state in updates))
+            self.connection.commit()
+
+    def reset_in_flight(self):
+        """
+        Requests that were in flight when the extraction stopped are pending again
+        """
+        with self.lock:
+            self.connection.execute('UPDATE requests SET state = ? WHERE state = ?', (PENDING, IN_FLIGHT))
+            self.connection.commit()
+
+    def lease(self, owner, count, duration):
+        """
+        Lease up to count pending requests to owner for duration seconds and return their
+        (id, elements). Requests whose lease expired, e.g. because their process stopped, are leased
+        again.
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.connection.execute('SELECT id, elements FROM requests '
+                    'WHERE state IN (?, ?) AND (lease_expires IS NULL OR lease_expires < ?) '
+                    'ORDER BY priority DESC, seq LIMIT ?', (PENDING, IN_FLIGHT, now, count)).fetchall()
+                self.connection.executemany('UPDATE requests SET state = ?, lease_owner = ?, lease_expires = ? '
+                    'WHERE id = ?', ((PENDING, owner, now + duration, row[0]) for row in rows))
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def renew(self, owner, duration):
+        """
+        Extend the leases of the unfinished requests of owner
+        """
+        with self.lock:
+            self.connection.execute('UPDATE requests SET lease_expires = ? WHERE lease_owner = ? AND state IN (?, ?)',
+                (time.time() + duration, owner, PENDING, IN_FLIGHT))
+            self.connection.commit()
+
+    def release_leases(self, owner=None):
+        """
+        Release the leases of owner, or all the leases
+        """
+        with self.lock:
+            if owner is None:
+                self.connection.execute('UPDATE requests SET lease_owner = NULL, lease_expires = NULL')
+            else:
+                self.connection.execute('UPDATE requests SET lease_owner = NULL, lease_expires = NULL '
+                    'WHERE lease_owner = ?', (owner,))
+            self.connection.commit()
+
+    def requeue(self, state):
+        """
+        Requests in the given state are pending again
+        """
+        with self.lock:
+            self.connection.execute('UPDATE requests SET state = ? WHERE state = ?', (PENDING, state))
+            self.connection.commit()
+
+    def remove(self, state):
+        with self.lock:
+            self.connection.execute('DELETE FROM requests WHERE state = ?', (state,))
+            self.connection.commit()
@@ -0,0 +1,109 @@
+import threading
+from .state import COMPLETED, FAILED
+
+# Identifiers used to correlate received instances to C-MOVE requests
+TRACKING_KEYWORDS = ['PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID']
+
+# A request is only tracked if its identifier has one of these, a PatientID alone would match the
+# instances of every concurrent request for the same patient
+UNIQUE_KEYWORDS = ['StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID']
+
+
+class TrackedMove(object):
+    """ TrackedMove class
+    The identifiers, expected and written instance counts of a C-MOVE request. The request is ended
+    once its final response was received.
+    """
+
+    def __init__(self, request_id, keys, members=None):
+        self.request_id = request_id
+        self.keys = keys
+        self.members = members or [request_id]
+        self.expected = None
+        self.written = 0
+        self.ended = False
+
+    def matches(self, uids):
+        return all(uids.get(keyword) in values for keyword, values in self.keys.items())
+
+
+class MoveTracker(object):
+    """ MoveTracker class
+    This class correlates the instances post-processed by the storage SCP to the C-MOVE requests that
+    caused them, using the unique keys of the C-MOVE identifiers. A request is journaled as completed
+    only once its final C-MOVE response was received and as many instances as the completed and
+    warning sub-operations it reports were written to the output directory.
+    """
+
+    def __init__(self, journal):
+        self.journal = journal
+        self.lock = threading.Lock()
+        self.moves = {}
+
+    def begin(self, request_id, identifier, members=None):
+        """
+        Start tracking a C-MOVE request before it is sent, members are the ids journaled for a
+        combined request. Returns False if the identifier has no unique key to correlate instances,
+        the request is then not tracked.
+        """
+        keys = {}
+        for keyword in TRACKING_KEYWORDS:
+            if keyword in identifier and identifier[keyword].VM > 0:
+                value = identifier[keyword].value
+                values = value if identifier[keyword].VM > 1 else [value]
+                keys[keyword] = set(str(x) for x in values)
+        if not any(keyword in keys for keyword in UNIQUE_KEYWORDS):
+            return False
+        with self.lock:
+            self.moves[request_id] = TrackedMove(request_id, keys, members)
+        return True
+
+    def end(self, request_id, expected):
+        """
+        Record the number of instances reported by the final C-MOVE response. If expected is None,
+        the request is completed immediately.
+        """
+        with self.lock:
+            move = self.moves.get(request_id)
+            if move is None:
+                return
+            move.expected = expected
+            move.ended = True
+            self.check(move)
+
+    def discard(self, request_id):
+        with self.lock:
+            self.moves.pop(request_id, None)
+
+    def instance_written(self, uids):
+        """
+        Record an instance written to the output directory, uids are its original identifiers
+        """
+        with self.lock:
+            candidates = [move for move in self.moves.values() if move.matches(uids)]
+            if not candidates:
+                return
+            # The most specific request, e.g. a series rather than its study
+            move = max(candidates, key=lambda x: len(x.keys))
+            move.written += 1
+            self.check(move)
+
+    def check(self, move):
+        # Called with the lock held, instances may be written before the final response
+        if move.ended and (move.expected is None or move.written >= move.expected):
+            del self.moves[move.request_id]
+            for member in move.members:
+                self.journal(member, COMPLETED)
+
+    def fail_incomplete(self):
+        """
+        Journal as failed the requests whose final response was received but some instances were
+        never written. Returns their number.
+        """
+        with self.lock:
+            incomplete = [move for move in self.moves.values() if move.ended]
+            for move in incomplete:
+                del self.moves[move.request_id]
+                for member in move.members:
+                    self.journal(member, FAILED)
+        return len(incomplete)
@@ -0,0 +1,136 @@
+import os
+import csv
+import time
+from queue import Queue, Empty
+from threading import Thread
+from .columnar import ColumnarResultFile, COLUMNAR_FORMATS, import_pyarrow
+
+
+class ResultWriter(object):
+    """ ResultWriter class
+    This class owns the open handles of the result files and the request store. Rows and request
+    states are queued by the SCU threads and written in batches by a single thread, so rows from
+    different threads are never interleaved and files are not re-opened for every row. With a
+    columnar output.database_format, the rows are typed values written as Parquet or Arrow parts and
+    request states are only committed once the rows queued before them are in a part.
+    """
+
+    def __init__(self, config, store=None):
+        self.config = config
+        self.store = store
+        self.flush_interval = float(config['output'].get('flush_interval', 1.0))
+        self.fsync = bool(config['output'].get('fsync', False))
+        self.database_format = str(config['output'].get('database_format', 'csv')).lower()
+        self.columnar = self.database_format in COLUMNAR_FORMATS
+        if self.columnar:
+            # Fail before the extraction starts if pyarrow is missing
+            import_pyarrow(self.database_format)
+        elif self.database_format != 'csv':
+            raise ValueError('Unknown output.database_format: {}'.format(self.database_format))
+        self.queue = Queue()
+        self.files = {}
+        self.columnar_files = {}
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Write all queued rows, flush and close the files
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def write(self, filepath, fieldnames, row):
+        self.queue.put((filepath, list(fieldnames), row))
+
+    def journal(self, request_id, state):
+        self.queue.put((None, request_id, state))
+
+    def open_file(self, filepath, fieldnames):
+        if self.columnar:
+            resultfile = ColumnarResultFile(self.config, filepath, fieldnames)
+            self.columnar_files[filepath] = resultfile
+            return resultfile
+        csvfile = open(filepath, 'a', newline='')
+        writer = csv.DictWriter(csvfile, fieldnames=sorted(fieldnames), dialect='excel')
+        if csvfile.tell() == 0:
+            writer.writeheader()
+        self.files[filepath] = (csvfile, writer)
+        return writer
+
+    def flush(self, force=False):
+        for csvfile, _ in self.files.values():
+            csvfile.flush()
+            if self.fsync:
+                os.fsync(csvfile.fileno())
+        for resultfile in self.columnar_files.values():
+            resultfile.flush(force)
+
+    def buffered_rows(self):
+        """
+        Returns True if rows of the columnar files are not written yet
+        """
+        return any(resultfile.buffered for resultfile in self.columnar_files.values())
+
+    def close(self):
+        self.flush(force=True)
+        for csvfile, _ in self.files.values():
+            csvfile.close()
+        for resultfile in self.columnar_files.values():
+            resultfile.close()
+        self.files = {}
+        self.columnar_files = {}
+
+    def run(self):
+        last_flush = time.time()
+        states = []
+        running = True
+        while running:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except Empty:
+                item = False
+
+            # Drain everything that is currently queued into a single batch
+            batch = []
+            while item is not None:
+                if item is not False:
+                    batch.append(item)
+                try:
+                    item = self.queue.get_nowait()
+                except Empty:
+                    break
+            if item is None:
+                running = False
+
+            for filepath, fieldnames, row in batch:
+                if filepath is None:
+                    states.append((fieldnames, row))
+                    continue
+                if filepath in self.files:
+                    writer = self.files[filepath][1]
+                elif filepath in self.columnar_files:
+                    writer = self.columnar_files[filepath]
+                else:
+                    writer = self.open_file(filepath, fieldnames)
+                writer.writerow(row)
+
+            if time.time() - last_flush >= self.flush_interval or not running:
+                # Result rows reach the disk before the state of their request is committed
+                self.flush(force=not running)
+                if self.buffered_rows():
+                    # Kept until the next part of the columnar files is written
+                    last_flush = time.time()
+                    continue
+                if states and self.store:
+                    self.store.set_states(states)
+                states = []
+                last_flush = time.time()
+
+        self.close()
@@ -0,0 +1,100 @@
+import os
+import pytest
+from pydicom.dataset import Dataset
+from pydicombatch.anonymizer import Anonymizer, AnonymizationError, usmd5
+
+CONFIG_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config')
+
+
+def create_anonymizer(tmp_path, elements, lookup_table=None, extra=''):
+    script = tmp_path / 'test.script'
+    script.write_text('<script>\n <p t="UIDROOT">9</p>\n <p t="DATEINC">-10</p>\n{}{}</script>\n'.format(
+        ''.join(' <e en="T" t="{}" n="">{}</e>\n'.format(tag, value) for tag, value in elements.items()), extra))
+    lut = None
+    if lookup_table is not None:
+        lut = tmp_path / 'lookup-table.properties'
+        lut.write_text(''.join('{} = {}\n'.format(key, value) for key, value in lookup_table.items()))
+        lut = str(lut)
+    return Anonymizer(str(script), lut)
+
+def create_dataset():
+    ds = Dataset()
+    ds.PatientID = '12345'
+    ds.PatientName = 'DOE^JOHN'
+    ds.StudyDate = '20200115'
+    ds.StudyInstanceUID = '1.2.3.4'
+    ds.AccessionNumber = 'ACC1'
+    ds.ImageType = ['ORIGINAL', 'PRIMARY']
+    return ds
+
+
+def test_keep_remove_and_empty(tmp_path):
+    anonymizer = create_anonymizer(tmp_path, {
+        '00100020': '@keep()', '00100010': '@remove()', '00080050': '@empty()'})
+    ds = anonymizer.anonymize(create_dataset())
+    assert ds.PatientID == '12345'
+    assert 'PatientName' not in ds
+    assert ds.AccessionNumber == ''
+
+def test_hash_functions(tmp_path):
+    anonymizer = create_anonymizer(tmp_path, {
+        '0020000d': '@hashuid(@UIDROOT,this)', '00080050': '@hash(this,6)', '00100020': '@hashptid(@SITEID,this)'})
+    ds = anonymizer.anonymize(create_dataset())
+    assert ds.StudyInstanceUID == '9.' + usmd5('1.2.3.4')
+    assert ds.AccessionNumber == usmd5('ACC1')[:6]
+    assert ds.PatientID == usmd5('[]12345')
+
+def test_dates_refer_to_the_original_values(tmp_path):
+    anonymizer = create_anonymizer(tmp_path, {
+        '00080020': '@incrementdate(this,@DATEINC)', '00080050': '@always()@incrementdate(StudyDate,0)'})
+    ds = anonymizer.anonymize(create_dataset())
+    assert ds.StudyDate == '20200105'
+    assert ds.AccessionNumber == '20200115'
+
+def test_lookup(tmp_path):
+    anonymizer = create_anonymizer(tmp_path, {'00100020': '@lookup(this,ptid)'}, {'ptid/12345': 'ANON1'})
+    assert anonymizer.anonymize(create_dataset()).PatientID == 'ANON1'
+    ds = create_dataset()
+    ds.PatientID = 'unknown'
+    with pytest.raises(AnonymizationError):
+        anonymizer.anonymize(ds)
+
+def test_lookup_with_default_action(tmp_path):
+    anonymizer = create_anonymizer(tmp_path, {'00100020': '@lookup(this,ptid,remove)'}, {})
+    assert 'PatientID' not in anonymizer.anonymize(create_dataset())
+
+def test_if_conditions(tmp_path):
+    anonymizer = create_anonymizer(tmp_path, {
+        '00100010': '@if(this,contains,DOE){@empty()}{@keep()}',
+        '00100020': '@if(this,equals,99){@remove()}{@keep()}',
+        '00080050': '@if(this,isblank){@remove()}{NEW}'})
+    ds = anonymizer.anonymize(create_dataset())
+    assert ds.PatientName == ''
+    assert ds.PatientID == '12345'
+    assert ds.AccessionNumber == 'NEW'
+
+def test_multiple_values_use_the_dicom_separator(tmp_path):
+    anonymizer = create_anonymizer(tmp_path, {
+        '00080008': '@if(this,equals,ORIGINAL\\PRIMARY){@append(){DERIVED}}{@keep()}',
+        '00081030': '@always()@param(@UIDROOT)'})
+    ds = anonymizer.anonymize(create_dataset())
+    assert list(ds.ImageType) == ['ORIGINAL', 'PRIMARY', 'DERIVED']
+    assert ds.StudyDescription == '9'
+
+def test_unspecified_and_private_elements_are_removed(tmp_path):
+    anonymizer = create_anonymizer(tmp_path, {'00100020': '@keep()'},
+        extra=' <r en="T" t="privategroups"></r>\n <r en="T" t="unspecifiedelements"></r>\n')
+    ds = create_dataset()
+    ds.add_new(0x00091001, 'LO', 'private')
+    ds = anonymizer.anonymize(ds)
+    assert [elem.keyword for elem in ds] == ['PatientID']
+
+def test_sample_script(tmp_path):
+    anonymizer = Anonymizer(os.path.join(CONFIG_DIRECTORY, 'sample-dicom-anonymizer.script'),
+        os.path.join(CONFIG_DIRECTORY, 'sample-lookup-table.properties'))
+    ds = create_dataset()
+    ds.SOPInstanceUID = '1.2.3.4.5'
+    ds.PatientID = next(key.split('/', 1)[1] for key in anonymizer.lookup_table if key.startswith('ptid/'))
+    ds = anonymizer.anonymize(ds)
+    assert ds.SOPInstanceUID != '1.2.3.4.5'
+    assert 'PatientName' not in ds or ds.PatientName != 'DOE^JOHN'
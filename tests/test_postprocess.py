@@ -0,0 +1,59 @@
+import os
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian
+from pydicombatch.postprocess import OutputPathTemplate
+
+
+def create_template(tmp_path, directory_structure='PatientID/StudyInstanceUID', filename='InstanceNumber'):
+    return OutputPathTemplate({'output': {'directory': str(tmp_path / 'output'),
+        'directory_structure': directory_structure, 'filename': filename}})
+
+def write_instance(tmp_path, sop_instance_uid, instance_number=1, patient_id='P1'):
+    ds = Dataset()
+    ds.PatientID = patient_id
+    ds.StudyInstanceUID = '1.2.3'
+    ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
+    ds.SOPInstanceUID = sop_instance_uid
+    ds.InstanceNumber = instance_number
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+    ds.file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    filepath = str(tmp_path / '{}.tmp'.format(sop_instance_uid))
+    ds.save_as(filepath, write_like_original=False)
+    return filepath, ds
+
+
+def test_move_to_directory_structure(tmp_path):
+    template = create_template(tmp_path)
+    tmp_filename, ds = write_instance(tmp_path, '1.2.3.1', 7)
+    filepath = template.move(tmp_filename, ds)
+    assert filepath == str(tmp_path / 'output' / 'P1' / '1.2.3' / '7.dcm')
+    assert os.path.isfile(filepath)
+    assert not os.path.exists(tmp_filename)
+
+def test_colliding_names_get_a_suffix(tmp_path):
+    template = create_template(tmp_path)
+    paths = []
+    for sop_instance_uid in ['1.2.3.1', '1.2.3.2', '1.2.3.3']:
+        # Same InstanceNumber for different instances
+        tmp_filename, ds = write_instance(tmp_path, sop_instance_uid, 1)
+        paths.append(template.move(tmp_filename, ds))
+    assert [os.path.basename(x) for x in paths] == ['1.dcm', '1_1.dcm', '1_2.dcm']
+
+def test_same_instance_received_again_is_replaced(tmp_path):
+    template = create_template(tmp_path)
+    tmp_filename, ds = write_instance(tmp_path, '1.2.3.1', 1)
+    first = template.move(tmp_filename, ds)
+    tmp_filename, ds = write_instance(tmp_path, '1.2.3.1', 1)
+    assert template.move(tmp_filename, ds) == first
+    assert os.listdir(os.path.dirname(first)) == ['1.dcm']
+
+def test_path_components_are_sanitized(tmp_path):
+    template = create_template(tmp_path, filename='SOPInstanceUID')
+    tmp_filename, ds = write_instance(tmp_path, '1.2.3.1', patient_id='../A/B:C')
+    ds.StudyInstanceUID = ''
+    filepath = template.move(tmp_filename, ds)
+    assert filepath == str(tmp_path / 'output' / '.._A_B_C' / 'UNKNOWN' / '1.2.3.1.dcm')
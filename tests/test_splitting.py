@@ -0,0 +1,82 @@
+import datetime
+import pytest
+from pydicom.dataset import Dataset
+from pydicombatch.splitting import RangeSplitter
+from pydicombatch.state import Request
+
+
+@pytest.fixture
+def splitter():
+    return RangeSplitter({'request': {'split': {'enabled': True, 'max_results': 1000, 'prefix_alphabet': '012'}}})
+
+def responses(*patient_ids):
+    datasets = []
+    for patient_id in patient_ids:
+        ds = Dataset()
+        ds.PatientID = patient_id
+        datasets.append(ds)
+    return datasets
+
+
+def test_should_split(splitter):
+    assert splitter.should_split(1000, 0x0000)
+    assert not splitter.should_split(999, 0x0000)
+    # Out of resources
+    assert splitter.should_split(0, 0xA700)
+
+def test_split_date(splitter):
+    assert splitter.split_date('20200101-20200110') == ['20200101-20200105', '20200106-20200110']
+    assert splitter.split_date('20200101-20200102') == ['20200101-20200101', '20200102-20200102']
+    assert splitter.split_date('20200101') == []
+    assert splitter.split_date('20200101-20200101') == []
+
+def test_split_open_date_range(splitter):
+    start, end = splitter.split_date('')
+    assert start.startswith('19000101-')
+    assert end.endswith(datetime.date.today().strftime('%Y%m%d'))
+
+def test_split_time(splitter):
+    assert splitter.split_time('080000-090000') == ['080000-083000.999999', '083001-090000']
+    assert splitter.split_time('-') == ['000000-115959.999999', '120000-235959']
+    assert splitter.split_time('080000') == []
+
+def test_split_prefix(splitter):
+    assert splitter.split_prefix('*') == ['0*', '1*', '2*']
+    assert splitter.split_prefix('AB*') == ['AB0*', 'AB1*', 'AB2*', 'AB']
+    assert splitter.split_prefix('AB') == []
+
+def test_split_prefix_adds_the_characters_of_the_responses(splitter):
+    values = splitter.split_prefix('AB*', responses('ABx1', 'AB_2', 'AB0', 'AB', 'AC1', 'AB?'))
+    assert values == ['AB0*', 'AB1*', 'AB2*', 'ABx*', 'AB_*', 'AB']
+
+def test_split_uses_the_first_splittable_key(splitter):
+    request = Request(['PatientID=*', 'StudyDate=20200101', 'StudyTime=080000-090000'], priority=2.0)
+    sub_requests = splitter.split(request)
+    assert [x.elements for x in sub_requests] == [
+        ('PatientID=*', 'StudyDate=20200101', 'StudyTime=080000-083000.999999'),
+        ('PatientID=*', 'StudyDate=20200101', 'StudyTime=083001-090000')]
+    assert all(x.priority == 2.0 and x.lineage == request.id for x in sub_requests)
+    assert splitter.split(Request(['PatientID=1', 'StudyDate=20200101'])) == []
+
+def test_rows_are_deduplicated_within_a_lineage(splitter):
+    request = Request(['StudyDate=20200101-20200110', 'PatientID'])
+    sub_requests = splitter.split(request)
+    splitter.register(request, sub_requests)
+    row, = responses('1')
+    assert splitter.is_new(row, ['PatientID'], sub_requests[0])
+    assert not splitter.is_new(row, ['PatientID'], sub_requests[1])
+    # Requests that were not split are not tracked
+    assert splitter.is_new(row, ['PatientID'], Request(['PatientID=1']))
+
+def test_lineage_is_forgotten_once_its_sub_requests_are_done(splitter):
+    request = Request(['StudyDate=20200101-20200110', 'PatientID'])
+    sub_requests = splitter.split(request)
+    splitter.register(request, sub_requests)
+    nested = splitter.split(sub_requests[0])
+    splitter.register(sub_requests[0], nested)
+    assert all(x.lineage == request.id for x in nested)
+    for sub_request in nested:
+        splitter.done(sub_request)
+    assert request.id in splitter.lineages
+    splitter.done(sub_requests[1])
+    assert splitter.lineages == {}
@@ -0,0 +1,115 @@
+import multiprocessing
+import pytest
+from pydicombatch.state import RequestStore, Request, PENDING, COMPLETED, FAILED
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = RequestStore(str(tmp_path / 'requests.db'))
+    yield store
+    store.close()
+
+def patient_requests(*patient_ids):
+    return [Request(['PatientID={}'.format(x), 'QueryRetrieveLevel=STUDY']) for x in patient_ids]
+
+
+def test_request_id_does_not_depend_on_element_order():
+    assert Request(['PatientID=1', 'QueryRetrieveLevel=STUDY']).id == Request(['QueryRetrieveLevel=STUDY', 'PatientID=1']).id
+    assert Request(['PatientID=1']).id != Request(['PatientID=2']).id
+
+def test_add_returns_the_new_requests(store):
+    added = store.add(patient_requests('1', '2', '2'))
+    assert [x.elements for x in added] == [x.elements for x in patient_requests('1', '2')]
+    assert store.count(PENDING) == 2
+
+    added = store.add(patient_requests('2', '3'))
+    assert [x.elements for x in added] == [x.elements for x in patient_requests('3')]
+    assert store.count(PENDING) == 3
+
+def test_select_orders_by_priority_then_insertion(store):
+    low, high, other = patient_requests('1', '2', '3')
+    high.priority = 1.0
+    store.add([low, high, other])
+    assert [x[0] for x in store.select([PENDING])] == [high.id, low.id, other.id]
+
+def test_set_states(store):
+    requests = patient_requests('1', '2', '3')
+    store.add(requests)
+    store.set_states([(requests[0].id, COMPLETED), (requests[1].id, FAILED)])
+    assert store.count(PENDING) == 1
+    assert store.count(COMPLETED, FAILED) == 2
+    store.remove(FAILED)
+    assert [x[0] for x in store.select([PENDING, COMPLETED, FAILED])] == [requests[0].id, requests[2].id]
+
+def test_iterate_returns_batches_in_select_order(store):
+    requests = patient_requests(*[str(x) for x in range(25)])
+    requests[10].priority = 1.0
+    store.add(requests)
+    batches = list(store.iterate([PENDING], batch_size=10))
+    assert [len(x) for x in batches] == [10, 10, 5]
+    assert [x for batch in batches for x in batch] == store.select([PENDING])
+
+def test_iterate_skips_requests_added_during_the_iteration(store):
+    store.add(patient_requests('1', '2', '3'))
+    ids = []
+    for batch in store.iterate([PENDING], batch_size=2):
+        ids += [x[0] for x in batch]
+        store.add(patient_requests('new{}'.format(len(ids))))
+    assert len(ids) == 3
+    assert store.count(PENDING) == 5
+
+def test_lease_gives_each_request_to_one_owner(store):
+    store.add(patient_requests('1', '2', '3'))
+    first = store.lease('worker0', 2, 60)
+    second = store.lease('worker1', 2, 60)
+    assert len(first) == 2
+    assert len(second) == 1
+    assert not set(x[0] for x in first) & set(x[0] for x in second)
+    assert store.lease('worker2', 2, 60) == []
+
+def test_expired_leases_are_leased_again(store):
+    store.add(patient_requests('1', '2'))
+    leased = store.lease('worker0', 2, -1)
+    assert sorted(store.lease('worker1', 2, 60)) == sorted(leased)
+
+def test_renew_extends_the_unfinished_leases(store):
+    requests = patient_requests('1', '2')
+    store.add(requests)
+    store.lease('worker0', 2, -1)
+    store.set_states([(requests[0].id, COMPLETED)])
+    store.renew('worker0', 60)
+    assert store.lease('worker1', 2, 60) == []
+    store.release_leases('worker0')
+    assert [x[0] for x in store.lease('worker1', 2, 60)] == [requests[1].id]
+
+def test_requeue(store):
+    requests = patient_requests('1', '2')
+    store.add(requests)
+    store.set_states([(requests[0].id, FAILED)])
+    store.requeue(FAILED)
+    assert store.count(PENDING) == 2
+
+def add_requests(filepath, worker):
+    store = RequestStore(filepath)
+    added = []
+    for i in range(50):
+        # The shared requests are added by every worker
+        requests = patient_requests('{}-{}'.format(worker, i), 'shared{}'.format(i))
+        added += [x.id for x in store.add(requests)]
+    store.close()
+    return added
+
+def test_add_from_several_processes(tmp_path):
+    filepath = str(tmp_path / 'requests.db')
+    RequestStore(filepath).close()
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(4) as pool:
+        added = pool.starmap(add_requests, [(filepath, worker) for worker in range(4)])
+    added = [x for ids in added for x in ids]
+    store = RequestStore(filepath)
+    try:
+        # Each request is reported as added by a single process
+        assert len(added) == len(set(added)) == store.count(PENDING) == 250
+        assert store.connection.execute('SELECT COUNT(DISTINCT seq) FROM requests').fetchone()[0] == 250
+    finally:
+        store.close()
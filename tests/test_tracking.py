@@ -0,0 +1,92 @@
+import pytest
+from pydicom.dataset import Dataset
+from pydicombatch.tracking import MoveTracker
+from pydicombatch.state import COMPLETED, FAILED
+
+
+@pytest.fixture
+def journaled():
+    return []
+
+@pytest.fixture
+def tracker(journaled):
+    return MoveTracker(lambda request_id, state: journaled.append((request_id, state)))
+
+def identifier(**values):
+    ds = Dataset()
+    for keyword, value in values.items():
+        setattr(ds, keyword, value)
+    return ds
+
+def instance(patient_id, study, series, sop_instance):
+    return {'PatientID': patient_id, 'StudyInstanceUID': study, 'SeriesInstanceUID': series,
+        'SOPInstanceUID': sop_instance}
+
+
+def test_completed_once_the_expected_instances_are_written(tracker, journaled):
+    assert tracker.begin('series1', identifier(PatientID='P1', StudyInstanceUID='1', SeriesInstanceUID='1.1'))
+    tracker.instance_written(instance('P1', '1', '1.1', '1.1.1'))
+    tracker.end('series1', 2)
+    assert journaled == []
+    tracker.instance_written(instance('P1', '1', '1.1', '1.1.2'))
+    assert journaled == [('series1', COMPLETED)]
+
+def test_not_completed_before_the_final_response(tracker, journaled):
+    tracker.begin('series1', identifier(SeriesInstanceUID='1.1'))
+    tracker.instance_written(instance('P1', '1', '1.1', '1.1.1'))
+    tracker.instance_written(instance('P1', '1', '1.1', '1.1.2'))
+    assert journaled == []
+    tracker.end('series1', None)
+    assert journaled == [('series1', COMPLETED)]
+
+def test_instances_go_to_the_most_specific_request(tracker, journaled):
+    tracker.begin('study1', identifier(PatientID='P1', StudyInstanceUID='1'))
+    tracker.begin('series2', identifier(PatientID='P1', StudyInstanceUID='1', SeriesInstanceUID='1.2'))
+    tracker.end('study1', 1)
+    tracker.end('series2', 1)
+    tracker.instance_written(instance('P1', '1', '1.2', '1.2.1'))
+    assert journaled == [('series2', COMPLETED)]
+    tracker.instance_written(instance('P1', '1', '1.1', '1.1.1'))
+    assert journaled == [('series2', COMPLETED), ('study1', COMPLETED)]
+
+def test_instances_of_other_requests_are_ignored(tracker, journaled):
+    tracker.begin('series1', identifier(SeriesInstanceUID='1.1'))
+    tracker.end('series1', 1)
+    tracker.instance_written(instance('P1', '1', '1.2', '1.2.1'))
+    assert journaled == []
+
+def test_identifier_with_several_values(tracker, journaled):
+    tracker.begin('image', identifier(SeriesInstanceUID='1.1', SOPInstanceUID=['1.1.1', '1.1.2']))
+    tracker.end('image', 2)
+    tracker.instance_written(instance('P1', '1', '1.1', '1.1.3'))
+    tracker.instance_written(instance('P1', '1', '1.1', '1.1.1'))
+    tracker.instance_written(instance('P1', '1', '1.1', '1.1.2'))
+    assert journaled == [('image', COMPLETED)]
+
+def test_requests_without_unique_key_are_not_tracked(tracker, journaled):
+    assert not tracker.begin('patient', identifier(PatientID='P1'))
+    assert not tracker.begin('empty', identifier())
+    tracker.end('patient', 1)
+    assert journaled == []
+
+def test_combined_request_journals_its_members(tracker, journaled):
+    tracker.begin('study1', identifier(StudyInstanceUID='1'), members=['series1', 'series2'])
+    tracker.end('study1', 0)
+    assert journaled == [('series1', COMPLETED), ('series2', COMPLETED)]
+
+def test_fail_incomplete_only_fails_ended_requests(tracker, journaled):
+    tracker.begin('series1', identifier(SeriesInstanceUID='1.1'))
+    tracker.begin('series2', identifier(SeriesInstanceUID='1.2'))
+    tracker.end('series1', 2)
+    tracker.instance_written(instance('P1', '1', '1.1', '1.1.1'))
+    assert tracker.fail_incomplete() == 1
+    assert journaled == [('series1', FAILED)]
+    # Still waiting for its final response
+    tracker.end('series2', 0)
+    assert journaled == [('series1', FAILED), ('series2', COMPLETED)]
+
+def test_discard(tracker, journaled):
+    tracker.begin('series1', identifier(SeriesInstanceUID='1.1'))
+    tracker.discard('series1')
+    tracker.end('series1', 0)
+    assert journaled == []